@@ -45,6 +45,7 @@ def associate_data2label(cache=False):
 
     config = RBMConfig(v_n=n_visible,
                        v2_n=n_visible2,
+                       v2_unit=SoftmaxUnit,
                        h_n=n_hidden,
                        associative=True,
                        cd_type=CLASSICAL,
@@ -68,6 +69,7 @@ def associate_data2label(cache=False):
     # rbm.reconstruct(test_x, 10)
     # rbm.associative = True
 
+    # Exact p(y | x) of the softmax label in one pass, no Gibbs sampling
     y = map(np.argmax, test_y.eval())
     pred = rbm.classify(test_x)
     print y
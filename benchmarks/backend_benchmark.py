@@ -0,0 +1,52 @@
+"""
+Time to first update (graph construction and compilation included) and steady state
+throughput of the theano and numpy RBM backends.
+Run from the project root: python -m benchmarks.backend_benchmark
+"""
+
+import time
+
+import numpy as np
+import theano
+
+from models.rbm import RBM
+from models.rbm_config import *
+
+
+def benchmark(backend, data, v_n, h_n, batch_size, cd_type=CLASSICAL, epochs=1):
+    tr = TrainParam(learning_rate=0.001,
+                    momentum_type=NESTEROV,
+                    momentum=0.5,
+                    weight_decay=0.0001,
+                    batch_size=batch_size,
+                    epochs=epochs)
+    rbm = RBM(RBMConfig(v_n=v_n, h_n=h_n, cd_type=cd_type, train_params=tr, backend=backend))
+    rbm.training = True
+
+    start_time = time.time()
+    train_fn = rbm.get_train_fn(data, None)
+    train_fn(0)
+    first_update = time.time() - start_time
+
+    n_batches = data.get_value(borrow=True).shape[0] / batch_size
+    start_time = time.time()
+    for epoch in xrange(epochs):
+        for i in xrange(n_batches):
+            train_fn(i)
+    throughput = epochs * n_batches * batch_size / (time.time() - start_time)
+
+    return first_update, throughput
+
+
+def run(shapes=[(100, 50), (625, 100), (625, 500), (1250, 500)], batch_size=10, n=1000):
+    np_rand = np.random.RandomState(123)
+    print '{:>6} {:>6} {:>8} {:>18} {:>14}'.format('v_n', 'h_n', 'backend', 'first update (s)', 'samples/sec')
+    for v_n, h_n in shapes:
+        data = theano.shared(np_rand.binomial(n=1, p=0.3, size=(n, v_n)).astype(t_float_x))
+        for backend in [THEANO, NUMPY]:
+            first_update, throughput = benchmark(backend, data, v_n, h_n, batch_size)
+            print '{:>6} {:>6} {:>8} {:>18.3f} {:>14.1f}'.format(v_n, h_n, backend, first_update, throughput)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,62 @@
+"""
+Throughput of training with dropout masks drawn on the compiled graph, compared with
+training without dropout and with the per-minibatch host-side mask the training loop used to build.
+Run from the project root: python -m benchmarks.dropout_benchmark
+"""
+
+import time
+
+import numpy as np
+import theano
+
+from models.rbm import RBM
+from models.rbm_config import *
+
+
+def get_rbm(v_n, h_n, batch_size, dropout):
+    tr = TrainParam(learning_rate=0.001,
+                    momentum_type=NESTEROV,
+                    momentum=0.5,
+                    weight_decay=0.0001,
+                    dropout=dropout,
+                    dropout_rate=0.5,
+                    batch_size=batch_size,
+                    epochs=1)
+    rbm = RBM(RBMConfig(v_n=v_n, h_n=h_n, train_params=tr))
+    rbm.training = True
+    return rbm
+
+
+def time_epoch(rbm, data, host_mask=False, repeat=3):
+    batch_size = rbm.train_parameters.batch_size
+    n_batches = data.get_value(borrow=True).shape[0] / batch_size
+    train_fn = rbm.get_train_fn(data, None)
+    train_fn(0)  # warm up
+
+    best = float('inf')
+    for _ in xrange(repeat):
+        start_time = time.time()
+        for i in xrange(n_batches):
+            if host_mask:
+                rbm.np_rand.binomial(n=1, p=rbm.dropout_rate, size=(batch_size, rbm.h_n)).astype(t_float_x)
+            train_fn(i)
+        best = min(best, time.time() - start_time)
+    return n_batches * batch_size / best
+
+
+def run(v_n=625, h_n=500, batch_size=10, n=2000):
+    np_rand = np.random.RandomState(123)
+    data = theano.shared(np_rand.binomial(n=1, p=0.3, size=(n, v_n)).astype(t_float_x))
+
+    no_dropout = time_epoch(get_rbm(v_n, h_n, batch_size, False), data)
+    on_graph = time_epoch(get_rbm(v_n, h_n, batch_size, True), data)
+    host = time_epoch(get_rbm(v_n, h_n, batch_size, True), data, host_mask=True)
+
+    print 'samples/sec ({}-{}, batch {})'.format(v_n, h_n, batch_size)
+    print '{:>24}: {:.1f}'.format('no dropout', no_dropout)
+    print '{:>24}: {:.1f}'.format('on-graph mask', on_graph)
+    print '{:>24}: {:.1f}'.format('+ host mask per batch', host)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,50 @@
+"""
+Epoch time when minibatches are dispatched one compiled call at a time, in blocks of
+minibatches, or as a whole epoch inside a single compiled scan.
+Run from the project root: python -m benchmarks.epoch_benchmark
+"""
+
+import time
+
+import numpy as np
+import theano
+
+from models.rbm import RBM
+from models.rbm_config import *
+
+
+def time_epoch(batches_per_call, data, v_n, h_n, batch_size, cd_type=CLASSICAL, repeat=3):
+    tr = TrainParam(learning_rate=0.001,
+                    momentum_type=NESTEROV,
+                    momentum=0.5,
+                    weight_decay=0.0001,
+                    sparsity_constraint=True,
+                    sparsity_target=0.1,
+                    batch_size=batch_size,
+                    batches_per_call=batches_per_call,
+                    epochs=1)
+    rbm = RBM(RBMConfig(v_n=v_n, h_n=h_n, cd_type=cd_type, train_params=tr))
+    rbm.train(data)  # compiles
+
+    best = float('inf')
+    for _ in xrange(repeat):
+        start_time = time.time()
+        rbm.train(data)
+        best = min(best, time.time() - start_time)
+    return best
+
+
+def run(v_n=625, h_n=100, batch_size=10, n=2000):
+    np_rand = np.random.RandomState(123)
+    data = theano.shared(np_rand.binomial(n=1, p=0.3, size=(n, v_n)).astype(t_float_x))
+
+    print 'epoch time ({}-{}, batch {}, {} minibatches)'.format(v_n, h_n, batch_size, n / batch_size)
+    for cd_type in [CLASSICAL, PERSISTENT]:
+        for batches_per_call in [1, 10, 0]:
+            label = 'whole epoch' if batches_per_call == 0 else '{} per call'.format(batches_per_call)
+            t = time_epoch(batches_per_call, data, v_n, h_n, batch_size, cd_type)
+            print '{:>12} {:>12}: {:.3f}s'.format(cd_type, label, t)
+
+
+if __name__ == '__main__':
+    run()
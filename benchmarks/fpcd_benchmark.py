@@ -0,0 +1,69 @@
+"""
+Epochs to reach a target reconstruction cost with CD-1, PCD-1 and FPCD-1.
+Run from the project root: python -m benchmarks.fpcd_benchmark
+"""
+
+import time
+
+import numpy as np
+import theano
+
+from models.rbm import RBM
+from models.rbm_config import *
+
+
+def get_data(n=2000, v_n=400, n_modes=10, noise=0.05, seed=123):
+    """Noisy copies of a few random binary prototypes, a small multimodal data set"""
+    np_rand = np.random.RandomState(seed)
+    prototypes = np_rand.binomial(n=1, p=0.3, size=(n_modes, v_n))
+    x = prototypes[np_rand.randint(n_modes, size=n)]
+    flip = np_rand.binomial(n=1, p=noise, size=x.shape)
+    return np.abs(x - flip).astype(t_float_x)
+
+
+def reconstruction_cost(rbm, x):
+    _, h = rbm.numpy_backend.prop_up(x)
+    _, v = rbm.numpy_backend.prop_down(h)
+    v = np.clip(v, 1e-7, 1 - 1e-7)
+    return - np.mean(np.sum(x * np.log(v) + (1 - x) * np.log(1 - v), axis=1))
+
+
+def epochs_to_target(cd_type, data, target, h_n=100, max_epochs=30, batch_size=20, learning_rate=0.001):
+    tr = TrainParam(learning_rate=learning_rate,
+                    momentum_type=NESTEROV,
+                    momentum=0.5,
+                    weight_decay=0.0001,
+                    batch_size=batch_size,
+                    fast_learning_rate=learning_rate,
+                    fast_decay=0.95,
+                    epochs=1)
+    config = RBMConfig(cd_type=cd_type, cd_steps=1, v_n=data.shape[1], h_n=h_n, train_params=tr)
+    rbm = RBM(config)
+
+    x = data[:500]
+    train_data = theano.shared(data)
+    costs = []
+    start_time = time.time()
+    for epoch in xrange(max_epochs):
+        # the compiled function is cached, each call runs one epoch
+        rbm.train(train_data)
+        costs.append(reconstruction_cost(rbm, x))
+        if costs[-1] <= target:
+            break
+    elapsed = time.time() - start_time
+
+    reached = costs[-1] <= target
+    return (epoch + 1 if reached else None), costs, elapsed
+
+
+def run(target=90., max_epochs=30):
+    data = get_data()
+    print 'target reconstruction cost: {}'.format(target)
+    print '{:>16} {:>8} {:>12} {:>10}'.format('cd_type', 'epochs', 'final cost', 'time')
+    for cd_type in [CLASSICAL, PERSISTENT, FAST_PERSISTENT]:
+        epochs, costs, elapsed = epochs_to_target(cd_type, data, target, max_epochs=max_epochs)
+        print '{:>16} {:>8} {:>12.3f} {:>9.1f}s'.format(cd_type, epochs or '>%d' % max_epochs, costs[-1], elapsed)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,71 @@
+"""
+Compile time, graph size and per-minibatch latency of the training function with the CD statistics
+and the sparsity penalty taken by T.grad and in closed form.
+Run from the project root: python -m benchmarks.gradient_benchmark
+"""
+
+import time
+
+import numpy as np
+import theano
+
+from models.rbm import RBM
+from models.rbm_config import *
+
+
+def time_train_fn(closed_form, cd_type=CLASSICAL, v_unit=rbm_units.RBMUnit, v_n=625, h_n=500, batch_size=10,
+                  n_batches=100, repeat=3, h_unit=rbm_units.RBMUnit, sparsity=False):
+    tr = TrainParam(learning_rate=0.001,
+                    momentum_type=NESTEROV,
+                    momentum=0.5,
+                    weight_decay=0.0001,
+                    batch_size=batch_size,
+                    sparsity_constraint=sparsity,
+                    closed_form_gradients=closed_form,
+                    epochs=1)
+    config = RBMConfig(cd_type=cd_type, v_unit=v_unit, v_n=v_n, h_n=h_n, h_unit=h_unit, train_params=tr)
+    rbm = RBM(config)
+
+    np_rand = np.random.RandomState(123)
+    data = np_rand.binomial(n=1, p=0.3, size=(batch_size * n_batches, v_n)).astype(t_float_x)
+
+    start_time = time.time()
+    train_fn = rbm.get_train_fn(theano.shared(data), None)
+    compile_time = time.time() - start_time
+    n_nodes = len(train_fn.maker.fgraph.apply_nodes)
+    train_fn(0)  # warm up
+
+    best = float('inf')
+    for _ in xrange(repeat):
+        start_time = time.time()
+        for i in xrange(n_batches):
+            train_fn(i)
+        best = min(best, time.time() - start_time)
+
+    return compile_time, n_nodes, best / n_batches * 1000.
+
+
+def run(v_n=625, h_n=500):
+    print '{:>11} {:>8} {:>12} {:>10} {:>7} {:>12}'.format('cd_type', 'v_unit', 'gradients', 'compile', 'nodes',
+                                                          'minibatch')
+    for cd_type in [CLASSICAL, PERSISTENT]:
+        for v_unit in [rbm_units.RBMUnit, rbm_units.GaussianVisibleUnit]:
+            for closed_form in [False, True]:
+                compile_time, n_nodes, ms = time_train_fn(closed_form, cd_type, v_unit, v_n, h_n)
+                print '{:>11} {:>8} {:>12} {:>9.2f}s {:>7} {:>10.3f}ms'.format(
+                    cd_type, v_unit.__name__[:8], 'closed form' if closed_form else 'T.grad', compile_time, n_nodes, ms)
+
+    print
+    print 'With the sparsity constraint'
+    print '{:>11} {:>8} {:>12} {:>10} {:>7} {:>12}'.format('cd_type', 'h_unit', 'gradients', 'compile', 'nodes',
+                                                          'minibatch')
+    for h_unit in [rbm_units.RBMUnit, rbm_units.ReLUnit, rbm_units.NReLUnit]:
+        for closed_form in [False, True]:
+            compile_time, n_nodes, ms = time_train_fn(closed_form, CLASSICAL, rbm_units.RBMUnit, v_n, h_n,
+                                                      h_unit=h_unit, sparsity=True)
+            print '{:>11} {:>8} {:>12} {:>9.2f}s {:>7} {:>10.3f}ms'.format(
+                CLASSICAL, h_unit.__name__[:8], 'closed form' if closed_form else 'T.grad', compile_time, n_nodes, ms)
+
+
+if __name__ == '__main__':
+    run()
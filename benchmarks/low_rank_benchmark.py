@@ -0,0 +1,86 @@
+"""
+Speed and quality of low-rank weights (RBMConfig w_rank, W = W_a W_b) against the dense W,
+for the concatenated 50x50 pairs (v_n = 5000).
+Every model trains for the same epochs on the same data. Reported are the parameters of W,
+ms per minibatch of the training function, the speedup over the dense model and the mean field
+reconstruction cross entropy on the training data and on held out data.
+The factors train with scaled gradient descent (RBM.get_factor_scales), its rank x rank Gram matrices
+cost v_n rank^2 per minibatch, which is what limits the speedup at high ranks.
+Run from the project root: python -m benchmarks.low_rank_benchmark
+"""
+
+import time
+
+import numpy as np
+import theano
+import theano.tensor as T
+
+from models.rbm import RBM
+from models.rbm_config import *
+
+
+def get_data(v_n, n, n_prototypes=20, noise=0.05, seed=123):
+    '''Noisy copies of a few random binary images, so there is structure for the model to learn'''
+    np_rand = np.random.RandomState(seed)
+    prototypes = np_rand.binomial(n=1, p=0.3, size=(n_prototypes, v_n))
+    data = prototypes[np_rand.randint(n_prototypes, size=n)]
+    flip = np_rand.binomial(n=1, p=noise, size=data.shape)
+    return np.abs(data - flip).astype(t_float_x)
+
+
+def get_cost_fn(rbm):
+    x = T.matrix('x')
+    _, h_p = rbm.prop_up(x)
+    v_total_input, _ = rbm.prop_down(h_p)
+    return theano.function([x], rbm.get_reconstruction_cost(x, v_total_input))
+
+
+def benchmark(w_rank, train_data, test_data, h_n, batch_size, epochs, learning_rate):
+    tr = TrainParam(learning_rate=learning_rate,
+                    momentum_type=NESTEROV,
+                    momentum=0.5,
+                    weight_decay=0.0001,
+                    batch_size=batch_size,
+                    epochs=epochs)
+    v_n = train_data.shape[1]
+    config = RBMConfig(v_n=v_n, h_n=h_n, w_rank=w_rank, train_params=tr, progress_logger=None)
+    rbm = RBM(config)
+
+    rbm.training = True
+    train_fn = rbm.get_train_fn(theano.shared(train_data), None)
+    mini_batches = len(train_data) / batch_size
+    train_fn(0)  # warm up
+
+    start_time = time.time()
+    for _ in xrange(epochs):
+        for i in xrange(mini_batches):
+            train_fn(i)
+    elapsed = time.time() - start_time
+    rbm.training = False
+
+    cost_fn = get_cost_fn(rbm)
+    return {'params': v_n * w_rank + w_rank * h_n if w_rank else v_n * h_n,
+            'ms_per_batch': elapsed / (epochs * mini_batches) * 1000.,
+            'train_cost': float(cost_fn(train_data)),
+            'test_cost': float(cost_fn(test_data))}
+
+
+def run(v_n=5000, h_n=500, ranks=(None, 250, 100, 50, 10), n_train=2000, n_test=500, batch_size=20, epochs=5,
+        learning_rate=0.001):
+    data = get_data(v_n, n_train + n_test)
+    train_data, test_data = data[:n_train], data[n_train:]
+
+    print '{:>6} {:>10} {:>12} {:>8} {:>11} {:>10}'.format('rank', 'W params', 'minibatch', 'speedup',
+                                                          'train cost', 'test cost')
+    dense_ms = None
+    for w_rank in ranks:
+        result = benchmark(w_rank, train_data, test_data, h_n, batch_size, epochs, learning_rate)
+        dense_ms = result['ms_per_batch'] if dense_ms is None and w_rank is None else dense_ms
+        speedup = dense_ms / result['ms_per_batch'] if dense_ms else float('nan')
+        print '{:>6} {:>10} {:>10.3f}ms {:>7.2f}x {:>11.2f} {:>10.2f}'.format(
+            w_rank or 'dense', result['params'], result['ms_per_batch'], speedup, result['train_cost'],
+            result['test_cost'])
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,50 @@
+"""
+Iterations, matrix multiplies and wall time for mean field association recall to reach a tolerance
+with the plain fixed point iteration, the damped (over-relaxed) and the Anderson solver.
+Run from the project root: python -m benchmarks.mean_field_benchmark
+"""
+
+import time
+
+import numpy as np
+
+from models.rbm import RBM
+from models.rbm_config import *
+
+
+def time_solver(rbm, x, y, solver, tolerance, k, repeat=3):
+    # First call compiles
+    result, iterations = rbm.mean_field_inference_opt(x, y=y, k=k, tolerance=tolerance, solver=solver,
+                                                      return_iterations=True)
+    best = float('inf')
+    for _ in xrange(repeat):
+        start_time = time.time()
+        rbm.mean_field_inference_opt(x, y=y, k=k, tolerance=tolerance, solver=solver)
+        best = min(best, time.time() - start_time)
+    return result, iterations, best
+
+
+def run(v_n=625, h_n=500, n=100, weight_scales=(0.1, 0.15, 0.2), tolerance=1e-5, k=300):
+    print '{:>6} {:>12} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10}'.format('scale', 'solver', 'mean it', 'max it',
+                                                                    'matmuls', 'converged', 'time', 'max diff')
+    np_rand = np.random.RandomState(123)
+    for scale in weight_scales:
+        # Two concatenated images, as the associative networks are trained
+        config = RBMConfig(v_n=v_n * 2, h_n=h_n)
+        rbm = RBM(config)
+        rbm.W.set_value(np_rand.normal(0, scale, (v_n * 2, h_n)).astype(t_float_x))
+        x = np_rand.binomial(n=1, p=0.3, size=(n, v_n)).astype(t_float_x)
+        y = np.zeros((n, v_n), dtype=t_float_x)
+
+        reference = None
+        for solver in [FIXED_POINT, DAMPED, ANDERSON]:
+            result, iterations, t = time_solver(rbm, x, y, solver, tolerance, k)
+            reference = result if reference is None else reference
+            # The batch keeps iterating until its slowest row has converged, two products per iteration
+            print '{:>6} {:>12} {:>9.1f} {:>9} {:>9} {:>9.2f} {:>9.3f}s {:>10.2e}'.format(
+                scale, solver, iterations.mean(), iterations.max(), 2 * iterations.max(), np.mean(iterations < k), t,
+                np.max(np.abs(result - reference)))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,49 @@
+"""
+Per-minibatch latency of the compiled training function for each momentum type.
+Run from the project root: python -m benchmarks.momentum_benchmark
+"""
+
+import time
+
+import numpy as np
+import theano
+
+from models.rbm import RBM
+from models.rbm_config import *
+
+
+def time_minibatch(momentum_type, v_n=625, h_n=500, batch_size=10, n_batches=100, repeat=3):
+    tr = TrainParam(learning_rate=0.001,
+                    momentum_type=momentum_type,
+                    momentum=0.5,
+                    weight_decay=0.0001,
+                    batch_size=batch_size,
+                    epochs=1)
+    config = RBMConfig(v_n=v_n, h_n=h_n, train_params=tr)
+    rbm = RBM(config)
+
+    np_rand = np.random.RandomState(123)
+    data = np_rand.binomial(n=1, p=0.3, size=(batch_size * n_batches, v_n)).astype(t_float_x)
+    train_fn = rbm.get_train_fn(theano.shared(data), None)
+    train_fn(0)  # warm up
+
+    best = float('inf')
+    for _ in xrange(repeat):
+        start_time = time.time()
+        for i in xrange(n_batches):
+            train_fn(i)
+        best = min(best, time.time() - start_time)
+
+    return best / n_batches * 1000.
+
+
+def run(shapes=[(625, 500), (1250, 500)], batch_size=10):
+    print '{:>6} {:>6} {:>12} {:>12}'.format('v_n', 'h_n', CLASSICAL, NESTEROV)
+    for v_n, h_n in shapes:
+        classical = time_minibatch(CLASSICAL, v_n, h_n, batch_size)
+        nesterov = time_minibatch(NESTEROV, v_n, h_n, batch_size)
+        print '{:>6} {:>6} {:>10.3f}ms {:>10.3f}ms'.format(v_n, h_n, classical, nesterov)
+
+
+if __name__ == '__main__':
+    run()
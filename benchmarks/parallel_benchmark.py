@@ -0,0 +1,61 @@
+"""
+Throughput and reconstruction cost of data parallel RBM training against the number of workers.
+Run from the project root: python -m benchmarks.parallel_benchmark
+"""
+
+import multiprocessing as mp
+
+import numpy as np
+import theano
+
+from models.rbm import RBM
+from models.rbm_config import *
+from models.rbm_parallel import ParallelTrainer, HOGWILD, AVERAGE
+
+
+def scaling(data, v_n=1250, h_n=500, batch_size=10, epochs=3, worker_counts=None, modes=[HOGWILD, AVERAGE]):
+    if not worker_counts:
+        worker_counts = [n for n in [1, 2, 4, 8, 16, 32] if n <= mp.cpu_count()]
+
+    x = data.get_value(borrow=True)[:100]
+    results = []
+    for mode in modes:
+        for n_workers in worker_counts:
+            tr = TrainParam(learning_rate=0.001,
+                            momentum_type=NESTEROV,
+                            momentum=0.5,
+                            weight_decay=0.0001,
+                            batch_size=batch_size,
+                            epochs=epochs)
+            rbm = RBM(RBMConfig(v_n=v_n, h_n=h_n, train_params=tr, backend=NUMPY))
+            trainer = ParallelTrainer(rbm, n_workers=n_workers, mode=mode)
+            costs = trainer.train(data)
+
+            # Same measure for every run: squared error of a single mean field reconstruction
+            _, h = rbm.numpy_backend.prop_up(x)
+            _, v = rbm.numpy_backend.prop_down(h)
+            results.append({'mode': mode,
+                            'workers': n_workers,
+                            'samples_per_sec': np.mean([s['samples_per_sec'] for s in trainer.stats]),
+                            'cost': costs[-1],
+                            'reconstruction_error': np.mean((x - v) ** 2)})
+    return results
+
+
+def run(n=5000, v_n=1250, h_n=500):
+    np_rand = np.random.RandomState(123)
+    data = theano.shared(np_rand.binomial(n=1, p=0.3, size=(n, v_n)).astype(t_float_x))
+    results = scaling(data, v_n, h_n)
+
+    print '{:>8} {:>8} {:>12} {:>10} {:>10} {:>14}'.format('mode', 'workers', 'samples/sec', 'speed up',
+                                                          'cost', 'recon error')
+    for r in results:
+        base = [b for b in results if b['mode'] == r['mode']][0]['samples_per_sec']
+        print '{:>8} {:>8} {:>12.1f} {:>10.2f} {:>10.4f} {:>14.5f}'.format(r['mode'], r['workers'],
+                                                                        r['samples_per_sec'],
+                                                                        r['samples_per_sec'] / base,
+                                                                        r['cost'], r['reconstruction_error'])
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,215 @@
+"""
+Training throughput of RBM over a grid of layer sizes, minibatch sizes, CD variants and unit types:
+samples/sec, ms per minibatch, compile time of the training function and peak RSS.
+Every point of the grid runs in a process of its own, so that peak RSS is its own.
+Results are written as CSV, against a baseline CSV every slowdown beyond the threshold is flagged.
+
+Run from the project root:
+    python -m benchmarks.throughput_benchmark --output before.csv
+    (change rbm.py)
+    python -m benchmarks.throughput_benchmark --output after.csv --baseline before.csv
+--quick runs a small grid, see --help for choosing the grid.
+"""
+
+import argparse
+import collections
+import csv
+import multiprocessing as mp
+import resource
+import sys
+import time
+
+import numpy as np
+import theano
+
+from models.rbm import RBM
+from models.rbm_config import *
+
+# SB: stochastic binary, G: gaussian (visible only), R: ReLU and NR: noisy ReLU (hidden only)
+UNITS = collections.OrderedDict([('SB', rbm_units.RBMUnit),
+                                 ('G', rbm_units.GaussianVisibleUnit),
+                                 ('R', rbm_units.ReLUnit),
+                                 ('NR', rbm_units.NReLUnit)])
+UNIT_PAIRS = [('SB', 'SB'), ('G', 'SB'), ('SB', 'R'), ('SB', 'NR')]
+CD = [(CLASSICAL, 1), (CLASSICAL, 5), (PERSISTENT, 1)]
+# RBM compares cd types by identity, names given on the command line are looked up here
+CD_TYPES = dict((cd_type, cd_type) for cd_type in [CLASSICAL, PERSISTENT, FAST_PERSISTENT, PARALLEL_TEMPERING])
+
+GRID = {'v_n': [625, 784, 1250, 2500, 5000],
+        'h_n': [100, 250, 500, 1000],
+        'batch_size': [10, 100],
+        'cd': CD,
+        'units': UNIT_PAIRS}
+QUICK_GRID = {'v_n': [625, 2500],
+              'h_n': [100, 500],
+              'batch_size': [10],
+              'cd': [(CLASSICAL, 1), (PERSISTENT, 1)],
+              'units': [('SB', 'SB'), ('G', 'NR')]}
+
+KEY = ['v_n', 'h_n', 'batch_size', 'cd_type', 'cd_steps', 'v_unit', 'h_unit']
+METRICS = ['compile_s', 'ms_per_batch', 'samples_per_sec', 'peak_rss_mb']
+FIELDS = KEY + METRICS + ['regression']
+# Metrics where smaller is better, samples_per_sec is the inverse of ms_per_batch
+COMPARED = ['ms_per_batch', 'compile_s', 'peak_rss_mb']
+
+
+def benchmark(v_n, h_n, batch_size, cd_type, cd_steps, v_unit, h_unit, n_batches=20, repeat=3):
+    tr = TrainParam(learning_rate=0.001,
+                    momentum_type=NESTEROV,
+                    momentum=0.5,
+                    weight_decay=0.0001,
+                    batch_size=batch_size,
+                    epochs=1)
+    config = RBMConfig(cd_type=cd_type, cd_steps=cd_steps, v_unit=UNITS[v_unit], h_unit=UNITS[h_unit],
+                       v_n=v_n, h_n=h_n, train_params=tr, progress_logger=None)
+    rbm = RBM(config)
+
+    np_rand = np.random.RandomState(123)
+    if v_unit == 'G':
+        data = np_rand.normal(0, 1, size=(batch_size * n_batches, v_n)).astype(t_float_x)
+    else:
+        data = np_rand.binomial(n=1, p=0.3, size=(batch_size * n_batches, v_n)).astype(t_float_x)
+
+    rbm.training = True
+    start_time = time.time()
+    train_fn = rbm.get_train_fn(theano.shared(data), None)
+    compile_time = time.time() - start_time
+    train_fn(0)  # warm up
+
+    best = float('inf')
+    for _ in xrange(repeat):
+        start_time = time.time()
+        for i in xrange(n_batches):
+            train_fn(i)
+        best = min(best, time.time() - start_time)
+
+    ms = best / n_batches * 1000.
+    return {'compile_s': compile_time,
+            'ms_per_batch': ms,
+            'samples_per_sec': batch_size * 1000. / ms,
+            # kilobytes on linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+
+
+def run_worker(setting, kwargs, queue):
+    try:
+        queue.put(benchmark(**dict(setting, **kwargs)))
+    except Exception as e:
+        queue.put(e)
+
+
+def run_isolated(setting, **kwargs):
+    queue = mp.Queue()
+    worker = mp.Process(target=run_worker, args=(setting, kwargs, queue))
+    worker.start()
+    result = queue.get()
+    worker.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def get_settings(grid):
+    for v_n in grid['v_n']:
+        for h_n in grid['h_n']:
+            for batch_size in grid['batch_size']:
+                for (cd_type, cd_steps) in grid['cd']:
+                    for (v_unit, h_unit) in grid['units']:
+                        yield collections.OrderedDict([('v_n', v_n), ('h_n', h_n), ('batch_size', batch_size),
+                                                       ('cd_type', cd_type), ('cd_steps', cd_steps),
+                                                       ('v_unit', v_unit), ('h_unit', h_unit)])
+
+
+def get_key(row):
+    return tuple(str(row[k]) for k in KEY)
+
+
+def compare(row, baseline, threshold, compile_threshold):
+    '''Metrics of row that are worse than in the baseline by more than their threshold (a fraction)'''
+    regressions = []
+    for metric in COMPARED:
+        before = float(baseline[metric])
+        change = (row[metric] - before) / before if before > 0 else 0.
+        # Compile times vary a lot from run to run
+        if change > (compile_threshold if metric == 'compile_s' else threshold):
+            regressions.append('{}+{:.0f}%'.format(metric, change * 100))
+    return ' '.join(regressions)
+
+
+def read_table(path):
+    with open(path) as f:
+        return dict((get_key(row), row) for row in csv.DictReader(f))
+
+
+def print_row(row):
+    print '{:>5} {:>5} {:>5} {:>11} {:>2} {:>3} {:>3} {:>8.2f}s {:>9.3f}ms {:>11.0f} {:>8.0f}MB  {}'.format(
+        *[row[f] for f in FIELDS])
+
+
+def run(grid=GRID, output=None, baseline=None, threshold=0.1, compile_threshold=0.5, isolate=True, **kwargs):
+    '''Returns the rows of the table and the number of regressions'''
+    baseline = read_table(baseline) if baseline else {}
+    writer = None
+    if output:
+        f = open(output, 'wb')
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+
+    print '{:>5} {:>5} {:>5} {:>11} {:>2} {:>3} {:>3} {:>9} {:>11} {:>11} {:>10}  {}'.format(
+        'v_n', 'h_n', 'batch', 'cd_type', 'k', 'v', 'h', 'compile', 'minibatch', 'samples/s', 'peak rss', 'regression')
+    rows = []
+    n_regressions = 0
+    for setting in get_settings(grid):
+        result = run_isolated(setting, **kwargs) if isolate else benchmark(**dict(setting, **kwargs))
+        row = dict(setting, **result)
+        row['regression'] = ''
+        if get_key(row) in baseline:
+            row['regression'] = compare(row, baseline[get_key(row)], threshold, compile_threshold)
+            n_regressions += bool(row['regression'])
+        print_row(row)
+        sys.stdout.flush()
+        rows.append(row)
+        if writer:
+            writer.writerow(row)
+            f.flush()
+
+    if output:
+        f.close()
+    if baseline:
+        print '{} of {} settings regressed by more than {:.0f}%'.format(n_regressions, len(rows), threshold * 100)
+    return rows, n_regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='RBM training throughput over a grid of settings')
+    parser.add_argument('--quick', action='store_true', help='small grid')
+    parser.add_argument('--v-n', type=int, nargs='+')
+    parser.add_argument('--h-n', type=int, nargs='+')
+    parser.add_argument('--batch-size', type=int, nargs='+')
+    parser.add_argument('--cd', nargs='+', help='cd_type:cd_steps, e.g. classical:1 persistent:1')
+    parser.add_argument('--units', nargs='+', help='visible:hidden unit, each of {}'.format(', '.join(UNITS)))
+    parser.add_argument('--n-batches', type=int, default=20, help='minibatches per timed run')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs, the best counts')
+    parser.add_argument('--output', help='CSV file for the results')
+    parser.add_argument('--baseline', help='CSV file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown flagged as a regression')
+    parser.add_argument('--compile-threshold', type=float, default=0.5, help='same for the compile time')
+    parser.add_argument('--in-process', action='store_true', help='no process per setting (peak RSS accumulates)')
+    args = parser.parse_args(argv)
+
+    grid = dict(QUICK_GRID if args.quick else GRID)
+    for name in ['v_n', 'h_n', 'batch_size']:
+        if getattr(args, name):
+            grid[name] = getattr(args, name)
+    if args.cd:
+        grid['cd'] = [(CD_TYPES[cd_type], int(k)) for (cd_type, k) in (cd.split(':') for cd in args.cd)]
+    if args.units:
+        grid['units'] = [tuple(units.split(':')) for units in args.units]
+
+    _, n_regressions = run(grid, args.output, args.baseline, args.threshold, args.compile_threshold,
+                           not args.in_process, n_batches=args.n_batches, repeat=args.repeat)
+    return 1 if n_regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
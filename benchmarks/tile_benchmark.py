@@ -0,0 +1,74 @@
+"""
+utils.tile_raster_images against the tile by tile loop it replaced, for 1000 tiles of 50x50 and a weight snapshot.
+Run from the project root: python -m benchmarks.tile_benchmark
+"""
+
+import time
+
+import numpy as np
+
+import utils
+
+
+def tile_raster_images_loop(X, img_shape, tile_shape, tile_spacing=(0, 0), scale_rows_to_unit_interval=True,
+                            output_pixel_vals=True):
+    """The previous single channel implementation, one scaled copy and one slice assignment per tile"""
+    out_shape = [(ishp + tsp) * tshp - tsp for ishp, tshp, tsp in zip(img_shape, tile_shape, tile_spacing)]
+    H, W = img_shape
+    Hs, Ws = tile_spacing
+
+    dt = 'uint8' if output_pixel_vals else X.dtype
+    out_array = np.zeros(out_shape, dtype=dt)
+
+    for tile_row in xrange(tile_shape[0]):
+        for tile_col in xrange(tile_shape[1]):
+            if tile_row * tile_shape[1] + tile_col < X.shape[0]:
+                this_x = X[tile_row * tile_shape[1] + tile_col]
+                if scale_rows_to_unit_interval:
+                    this_img = utils.scale_to_unit_interval(this_x.reshape(img_shape))
+                else:
+                    this_img = this_x.reshape(img_shape)
+                c = 255 if output_pixel_vals else 1
+                out_array[
+                    tile_row * (H + Hs): tile_row * (H + Hs) + H,
+                    tile_col * (W + Ws): tile_col * (W + Ws) + W
+                ] = this_img * c
+    return out_array
+
+
+def time_fn(fn, repeat=5):
+    best = float('inf')
+    for _ in xrange(repeat):
+        start_time = time.time()
+        result = fn()
+        best = min(best, time.time() - start_time)
+    return result, best
+
+
+def run(configs=((1000, (50, 50), (25, 40)), (500, (25, 25), (51, 10)))):
+    """configs: (number of tiles, image shape, tile shape), the second is a 625x500 weight snapshot"""
+    np_rand = np.random.RandomState(123)
+    print '{:>6} {:>8} {:>6} {:>10} {:>10} {:>8} {:>9}'.format('tiles', 'image', 'mode', 'loop', 'vectorized',
+                                                             'speedup', 'max diff')
+    for (n, img_shape, tile_shape) in configs:
+        x = np_rand.normal(size=(n, img_shape[0] * img_shape[1])).astype('float32')
+        for mode in ['grey', 'rgba']:
+            if mode == 'grey':
+                args = (x, img_shape, tile_shape, (1, 1))
+                loop = lambda: tile_raster_images_loop(*args)
+            else:
+                args = ((x, x[::-1], None, None), img_shape, tile_shape, (1, 1))
+                loop = lambda: np.dstack([tile_raster_images_loop(x, img_shape, tile_shape, (1, 1)),
+                                          tile_raster_images_loop(x[::-1], img_shape, tile_shape, (1, 1))])
+            expected, loop_time = time_fn(loop)
+            result, vectorized_time = time_fn(lambda: utils.tile_raster_images(*args))
+            if mode == 'rgba':
+                result = result[:, :, :2]
+            diff = np.max(np.abs(result.astype(int) - expected.astype(int)))
+            print '{:>6} {:>8} {:>6} {:>8.2f}ms {:>8.2f}ms {:>7.1f}x {:>9}'.format(
+                n, '{}x{}'.format(*img_shape), mode, loop_time * 1000, vectorized_time * 1000,
+                loop_time / vectorized_time, diff)
+
+
+if __name__ == '__main__':
+    run()
@@ -4,6 +4,8 @@ import datastorage as store
 import theano.tensor as T
 from theano.tensor.shared_randomstreams import RandomStreams
 from models.rbm import RBM
+from models.function_cache import FunctionCache
+from models.profiler import IO, INFERENCE, measure, measure_scope
 from rbm_config import *
 from models.rbm_logger import *
 
@@ -56,6 +58,9 @@ class DBN(object):
         self.topology = topology
         self.out_dir = out_dir
         self.data_manager = data_manager
+        # Compiled bottom up and top down passes, keyed on the layers they run through
+        self.pass_fn_cache = FunctionCache()
+        self.profiler = None
 
         assert self.n_layers > 0
 
@@ -81,6 +86,24 @@ class DBN(object):
             rbm_layer = RBM(rbm_config)
             self.rbm_layers.append(rbm_layer)
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('pass_fn_cache', None)
+        state['profiler'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pass_fn_cache = FunctionCache()
+        self.profiler = None
+
+    def set_profiler(self, profiler):
+        '''Profiles pretraining and the passes of every layer, None to stop'''
+        self.profiler = profiler
+        self.pass_fn_cache.profiler = profiler
+        for rbm in self.rbm_layers + self.inference_layers + self.generative_layers:
+            rbm.set_profiler(profiler)
+
     def __str__(self):
         return 'dbn_' + str(self.n_layers) + \
                'lys_' + '_'.join([str(i) for i in self.topology])
@@ -93,44 +116,50 @@ class DBN(object):
 
         layer_input = train_data
         for i in xrange(len(self.rbm_layers)):
-            rbm = self.rbm_layers[i]
-            print '... training layer {}, {}'.format(i, rbm)
-
-            self.data_manager.move_to('{}/layer/{}/{}'.format(self.out_dir, i, rbm))
-
-            # Check Cache
-            cost = 0
-            name=names[i] if names else str(rbm)
-            ret_name = cache[i] if isinstance(cache[i], str) else name
-            loaded = store.retrieve_object(ret_name)
-            if cache[i] and loaded:
-                # TODO override neural network's weights too
-                epochs = rbm.config.train_params.epochs
-                rbm = loaded
-                rbm.config.train_params.epochs = epochs
-                # Override the reference
-                self.rbm_layers[i] = rbm
-                print "... loaded trained layer {}".format(ret_name)
-
-                if train_further[i]:
+            with measure_scope(self.profiler, '{}/layer {}'.format(self.out_dir, i)):
+                rbm = self.rbm_layers[i]
+                print '... training layer {}, {}'.format(i, rbm)
+
+                self.data_manager.move_to('{}/layer/{}/{}'.format(self.out_dir, i, rbm))
+
+                # Check Cache
+                cost = 0
+                name=names[i] if names else str(rbm)
+                ret_name = cache[i] if isinstance(cache[i], str) else name
+                with measure(self.profiler, IO):
+                    loaded = store.retrieve_object(ret_name)
+                if cache[i] and loaded:
+                    # TODO override neural network's weights too
+                    epochs = rbm.config.train_params.epochs
+                    rbm = loaded
+                    rbm.config.train_params.epochs = epochs
+                    # Override the reference
+                    self.rbm_layers[i] = rbm
+                    rbm.set_profiler(self.profiler)
+                    print "... loaded trained layer {}".format(ret_name)
+
+                    if train_further[i]:
+                        cost += np.mean(rbm.train(layer_input))
+                        with measure(self.profiler, IO):
+                            self.data_manager.persist(rbm, name=name)
+                else:
+                    if rbm.train_parameters.sparsity_constraint:
+                        rbm.set_initial_hidden_bias()
+                        rbm.set_hidden_mean_activity(layer_input)
                     cost += np.mean(rbm.train(layer_input))
-                    self.data_manager.persist(rbm, name=name)
-            else:
-                if rbm.train_parameters.sparsity_constraint:
-                    rbm.set_initial_hidden_bias()
-                    rbm.set_hidden_mean_activity(layer_input)
-                cost += np.mean(rbm.train(layer_input))
-                self.data_manager.persist(rbm, name=name)
-
-            self.data_manager.move_to_project_root()
-            # os.chdir('../..')
-
-            # Pass the input through sampler method to get next layer input
-            sampled_layer = rbm.sample_h_given_v(layer_input)
-            transform_input = sampled_layer[2]
-            f = theano.function([], transform_input)
-            res = f()
-            layer_input = theano.shared(res)
+                    with measure(self.profiler, IO):
+                        self.data_manager.persist(rbm, name=name)
+
+                self.data_manager.move_to_project_root()
+                # os.chdir('../..')
+
+                # Pass the input through sampler method to get next layer input
+                with measure(self.profiler, INFERENCE):
+                    sampled_layer = rbm.sample_h_given_v(layer_input)
+                    transform_input = sampled_layer[2]
+                    f = theano.function([], transform_input)
+                    res = f()
+                    layer_input = theano.shared(res)
         return cost
 
     def bottom_up_pass(self, x, start=0, end=sys.maxint):
@@ -141,22 +170,44 @@ class DBN(object):
         :param end: end_layer (default = end)
         :return:
         '''
+        return self.pass_fn_cache.run(self.get_bottom_up_fn(start, end), x)
+
+    def bottom_up_stream(self, x, start=0, end=sys.maxint, chunk_size=1000, prefetch=False):
+        '''
+        bottom_up_pass over x in chunks of chunk_size rows
+        :param x: array, shared variable or iterator of rows / arrays
+        :param prefetch: load the next chunk in a background thread
+        :return: generator of top layer samples
+        '''
+        fn = self.get_bottom_up_fn(start, end)
+        return utils.stream(lambda chunk: self.pass_fn_cache.run(fn, chunk), x, chunk_size,
+                            dtype=theano.config.floatX, prefetch_next=prefetch)
+
+    def get_bottom_up_fn(self, start=0, end=sys.maxint):
         n_layer = len(self.rbm_layers)
         end = min(end, n_layer)
         assert (0 <= start < end <= n_layer)
 
+        layers = [self.rbm_layers[i] if not self.untied else self.inference_layers[i] for i in xrange(start, end)]
+        return self.pass_fn_cache.get(self.get_pass_key('bottom_up', layers),
+                                      lambda: self.compile_bottom_up_fn(layers))
+
+    @staticmethod
+    def get_pass_key(direction, layers):
+        # The compiled pass keeps the layers' shared parameters alive, not the RBMs, whose ids can be reused
+        # once a replaced layer is garbage collected
+        return direction, tuple(id(p) for rbm in layers for p in rbm.params)
+
+    def compile_bottom_up_fn(self, layers):
         layer_input = T.matrix('x')
         chain_next = layer_input
-        for i in xrange(start, end):
-            rbm = self.rbm_layers[i] if not self.untied else self.inference_layers[i]
+        for rbm in layers:
             h, hp, hs = rbm.sample_h_given_v(chain_next)
             chain_next = hs
             # layer_input = vp
 
-        gibbs_sampling = theano.function([layer_input], [h, hp, hs])
-        h, hp, hs = gibbs_sampling(x)
-        # For final layer, take the probability vp
-        return hs
+        # For final layer, take the sample hs
+        return theano.function([layer_input], hs, name='bottom_up_pass')
 
     def top_down_pass(self, x, start=sys.maxint, end=0):
         '''
@@ -164,22 +215,39 @@ class DBN(object):
         :param x:
         :return:
         '''
+        return self.pass_fn_cache.run(self.get_top_down_fn(start, end), x)
+
+    def top_down_stream(self, x, start=sys.maxint, end=0, chunk_size=1000, prefetch=False):
+        '''
+        top_down_pass over x in chunks of chunk_size rows
+        :param x: array, shared variable or iterator of rows / arrays
+        :param prefetch: load the next chunk in a background thread
+        :return: generator of visible layer probabilities
+        '''
+        fn = self.get_top_down_fn(start, end)
+        return utils.stream(lambda chunk: self.pass_fn_cache.run(fn, chunk), x, chunk_size,
+                            dtype=theano.config.floatX, prefetch_next=prefetch)
+
+    def get_top_down_fn(self, start=sys.maxint, end=0):
         n_layer = len(self.rbm_layers)
         start = min(start, n_layer)
         assert (0 <= end < start <= n_layer)
 
+        layers = [self.rbm_layers[i] if not self.untied else self.generative_layers[i]
+                  for i in reversed(xrange(end, start))]
+        return self.pass_fn_cache.get(self.get_pass_key('top_down', layers),
+                                      lambda: self.compile_top_down_fn(layers))
+
+    def compile_top_down_fn(self, layers):
         layer_input = T.matrix('x')
         chain_next = layer_input
-        for i in reversed(xrange(end, start)):
-            rbm = self.rbm_layers[i] if not self.untied else self.generative_layers[i]
+        for rbm in layers:
             v, vp, vs = rbm.sample_v_given_h(chain_next)
             chain_next = vs
             # layer_input = vp
 
-        gibbs_sampling = theano.function([layer_input], [v, vp, vs])
-        v, vp, vs = gibbs_sampling(x)
         # For final layer, take the probability vp
-        return vp
+        return theano.function([layer_input], vp, name='top_down_pass')
 
     def reconstruct(self, x, k=1, plot_n=None, plot_every=1, img_name='reconstruction.png'):
         '''
@@ -328,7 +396,8 @@ class DBN(object):
         # CONTRASTIVE DIVERGENCE AT TOP LAYER
         top_rbm = self.rbm_layers[-1]
         pen_state = wake_state
-        [updates, chain_end, _, _, _, _, _, _, _] = top_rbm.negative_statistics(pen_state)
+        res = top_rbm.negative_statistics(pen_state)
+        updates, chain_end = res[0], res[1]
         cost = T.mean(top_rbm.free_energy(pen_state)) - T.mean(top_rbm.free_energy(chain_end))
         grads = T.grad(cost, top_rbm.params, consider_constant=[chain_end])
         lr = top_rbm.train_parameters.learning_rate
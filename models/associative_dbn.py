@@ -8,6 +8,7 @@ except ImportError:
     import Image
 
 from utils import save_images
+from models.profiler import IO, INFERENCE, measure, profiled
 
 theano.config.optimizer = 'None'
 theano.config.exception_verbosity = 'high'
@@ -91,6 +92,13 @@ class AssociativeDBN(object):
         self.dbn_right = DBN(config.right_dbn) if not config.reuse_dbn else self.dbn_left
         print '... initialising association layer'
         self.association_layer = RBM(config=config.top_rbm)
+        self.profiler = None
+
+    def set_profiler(self, profiler):
+        '''Profiles training and recall of both DBNs and the association layer, None to stop'''
+        self.profiler = profiler
+        for model in [self.dbn_left, self.dbn_right, self.association_layer]:
+            model.set_profiler(profiler)
 
     def __str__(self):
         return 'l{}_r{}_t{}'.format(self.dbn_left, self.dbn_right, self.association_layer.h_n)
@@ -118,6 +126,10 @@ class AssociativeDBN(object):
             self.dbn_right.pretrain(x2, cache=cache_right,
                                     train_further=train_further_right)
 
+        self.train_association_layer(x1, x2, cache_top, train_further_top)
+
+    @profiled('association layer')
+    def train_association_layer(self, x1, x2, cache_top, train_further_top):
         # Pass the parameter to top layer
         x1_np = self.dbn_left.bottom_up_pass(x1.get_value(True))
         x2_np = self.dbn_right.bottom_up_pass(x2.get_value(True))
@@ -133,11 +145,13 @@ class AssociativeDBN(object):
         out_dir = 'association_layer/{}_{}/'.format(len(self.dbn_left.rbm_layers),
                                                     len(self.dbn_right.rbm_layers))
 
-        load = self.data_manager.retrieve('{}_{}'.format(self.opt_top, top),
-                                          out_dir=out_dir)
+        with measure(self.profiler, IO):
+            load = self.data_manager.retrieve('{}_{}'.format(self.opt_top, top),
+                                              out_dir=out_dir)
 
         if load and cache_top:
             self.association_layer = load
+            load.set_profiler(self.profiler)
             print '... top layer RBM loaded'
 
         if not load and tr.sparsity_constraint:
@@ -157,14 +171,18 @@ class AssociativeDBN(object):
             else:
                 top.train(x1_features, x2_features)
 
-            self.data_manager.persist(top,
-                                      '{}_{}'.format(self.opt_top, top),
-                                      out_dir=out_dir)
+            with measure(self.profiler, IO):
+                self.data_manager.persist(top,
+                                          '{}_{}'.format(self.opt_top, top),
+                                          out_dir=out_dir)
 
-    def recall(self, x, associate_steps=10, recall_steps=5, img_name='dbn', y=None, y_type='sample_active_h'):
+    @profiled('recall')
+    def recall(self, x, associate_steps=10, recall_steps=5, img_name='dbn', y=None, y_type='sample_active_h',
+               tolerance=0.01):
         ''' left dbn bottom-up -> associate -> right dbn top-down
         :param x: data
         :param associate_steps: top level gibbs sampling steps
+        :param tolerance: the association stops early once mean field has converged to this tolerance
         :param recall_steps: right dbn sampling
         :return:
         '''
@@ -226,9 +244,10 @@ class AssociativeDBN(object):
                                                         p=p).astype(t_float_x)
 
             y = theano.shared(y_base, name='assoc_y')
-            associate_x = top.mean_field_inference_opt(assoc_in, y=y, sample=True, k=associate_steps)
+            associate_x = top.mean_field_inference_opt(assoc_in, y=y, sample=True, k=associate_steps,
+                                                       tolerance=tolerance)
         else:
-            associate_x = top.mean_field_inference(assoc_in, sample=True, k=associate_steps)
+            associate_x = top.mean_field_inference(assoc_in, sample=True, k=associate_steps, tolerance=tolerance)
         # associate_x = top.reconstruct_association(assoc_in, k=associate_steps)
 
         if recall_steps > 0:
@@ -236,7 +255,8 @@ class AssociativeDBN(object):
             # Allow right dbn to day dream by extracting top layer rbm
             right_top_rbm = right.rbm_layers[-1]
             ass, ass_p, ass_s = right_top_rbm.sample_v_given_h(top_in)
-            associate_x_in = theano.function([], ass_s)()
+            with measure(self.profiler, INFERENCE):
+                associate_x_in = theano.function([], ass_s)()
             associate_x_reconstruct = right_top_rbm.reconstruct(associate_x_in,
                                                                 k=recall_steps,
                                                                 img_name='recall')
@@ -253,8 +273,9 @@ class AssociativeDBN(object):
         n = res.shape[0]
 
         img_shape = right.rbm_layers[0].track_progress.img_shape
-        save_images(x, img_name + '_orig.png', shape=(n / 10, 10), img_shape=img_shape)
-        save_images(res, img_name + '_recon.png', shape=(n / 10, 10), img_shape=img_shape)
+        with measure(self.profiler, IO):
+            save_images(x, img_name + '_orig.png', shape=(n / 10, 10), img_shape=img_shape)
+            save_images(res, img_name + '_recon.png', shape=(n / 10, 10), img_shape=img_shape)
 
         self.data_manager.move_to_project_root()
 
@@ -264,7 +285,8 @@ class AssociativeDBN(object):
         # CONTRASTIVE DIVERGENCE AT TOP LAYER
         rbm = self.association_layer
         pen_state = wake_state
-        [updates, chain_end, _, _, _, _, _, _, _] = rbm.negative_statistics(pen_state)
+        res = rbm.negative_statistics(pen_state)
+        updates, chain_end = res[0], res[1]
         cost = T.mean(rbm.free_energy(pen_state)) - T.mean(rbm.free_energy(chain_end))
         grads = T.grad(cost, rbm.params, consider_constant=[chain_end])
         lr = rbm.train_parameters.learning_rate
@@ -0,0 +1,60 @@
+import time
+
+from models.profiler import COMPILE, INFERENCE, measure
+
+
+class FunctionCache(object):
+    '''
+    Keeps compiled theano functions (and whatever shared variables they are bound to)
+    so that repeated calls with the same configuration skip graph construction and compilation.
+
+    Entries are built lazily by the callable passed to get, hits and misses are counted.
+    Compiled functions called through run are timed, so compile time can be told from execution time.
+    With a profiler, compilations and runs are also recorded as its compile and inference phases.
+    '''
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.compile_time = 0.
+        self.execute_time = 0.
+        self.profiler = None
+
+    def get(self, key, build_fn):
+        if key in self.entries:
+            self.hits += 1
+            return self.entries[key]
+
+        self.misses += 1
+        start_time = time.clock()
+        with measure(self.profiler, COMPILE):
+            entry = build_fn()
+        self.compile_time += time.clock() - start_time
+        self.entries[key] = entry
+        return entry
+
+    def run(self, fn, *args):
+        start_time = time.clock()
+        with measure(self.profiler, INFERENCE):
+            result = fn(*args)
+        self.execute_time += time.clock() - start_time
+        return result
+
+    def clear(self):
+        self.entries = {}
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+                'compile_time': self.compile_time,
+                'execute_time': self.execute_time}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return 'hits: {}, misses: {}, compile time: {:.2f}s, execute time: {:.2f}s'.format(self.hits, self.misses,
+                                                                                          self.compile_time,
+                                                                                          self.execute_time)
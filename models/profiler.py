@@ -0,0 +1,184 @@
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+import theano
+
+# Phases the time of training and inference is broken down into
+COMPILE = 'compile'
+POSITIVE = 'positive phase'
+NEGATIVE = 'negative phase'
+UPDATE = 'parameter update'
+# The update of the compiled training function, which runs fused with the phases, is what the phases timed on
+# their own leave of the call, an estimate
+UPDATE_RESIDUAL = 'parameter update (residual)'
+MONITOR = 'monitoring'
+IO = 'io'
+INFERENCE = 'inference'
+PROFILING = 'profiling'
+PHASES = [COMPILE, POSITIVE, NEGATIVE, UPDATE, UPDATE_RESIDUAL, MONITOR, IO, INFERENCE, PROFILING]
+
+
+class Profiler(object):
+    '''
+    Breaks wall time down into phases, under nested scopes (e.g. left/layer 0/train).
+
+    The positive phase, the negative phase and the parameter update run fused in one compiled training
+    function, so every sample_every-th call the first two are also timed on their own (without updates,
+    the time spent doing so is the profiling phase), less the overhead of calling a compiled function,
+    and each call is split by the latest measured fractions. Those events are marked estimated, the update
+    cannot be run on its own and is recorded as the rest of the call, UPDATE_RESIDUAL.
+    With theano_profile, the training functions are compiled with a theano ProfileStats of their own,
+    whose per op times are exported along with the phases.
+    Results export as JSON (save_json) and as a Chrome trace (save_chrome_trace, open in chrome://tracing).
+    '''
+
+    def __init__(self, theano_profile=False, sample_every=10):
+        self.theano_profile = theano_profile
+        self.sample_every = sample_every
+        self.events = []
+        self.scopes = []
+        self.theano_profiles = collections.OrderedDict()
+        self.origin = time.time()
+        self.lock = threading.Lock()
+
+    def get_scope(self):
+        return '/'.join(self.scopes)
+
+    def record(self, phase, start, duration, scope=None, **args):
+        event = {'scope': self.get_scope() if scope is None else scope,
+                 'phase': phase,
+                 'start': start - self.origin,
+                 'duration': duration,
+                 'thread': threading.current_thread().name,
+                 'args': args}
+        with self.lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def phase(self, phase, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(phase, start, time.time() - start, **args)
+
+    @contextlib.contextmanager
+    def scope(self, name):
+        '''Nested scope, its span is recorded as an event without a phase'''
+        self.scopes.append(str(name))
+        scope = self.get_scope()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(None, start, time.time() - start, scope=scope)
+            self.scopes.pop()
+
+    def get_theano_profile(self, name):
+        '''Value of theano.function's profile argument'''
+        if not self.theano_profile:
+            return False
+        name = '{}/{}'.format(self.get_scope(), name) if self.scopes else name
+        profile = theano.compile.profiling.ProfileStats(atexit_print=False, message=name)
+        self.theano_profiles[name] = profile
+        return profile
+
+    def summary(self):
+        '''Seconds spent in each phase of each scope'''
+        totals = collections.OrderedDict()
+        for event in self.events:
+            if event['phase'] is None:
+                continue
+            phases = totals.setdefault(event['scope'], collections.OrderedDict())
+            phases[event['phase']] = phases.get(event['phase'], 0.) + event['duration']
+        return totals
+
+    def get_theano_summary(self, top=10):
+        summary = collections.OrderedDict()
+        for (name, profile) in self.theano_profiles.items():
+            op_time = collections.defaultdict(float)
+            for (node, t) in profile.apply_time.items():
+                node = node[1] if isinstance(node, tuple) else node
+                op_time[str(node.op)] += t
+            ops = sorted(op_time.items(), key=lambda (op, t): -t)[:top]
+            summary[name] = {'calls': profile.fct_callcount,
+                             'call_time': profile.fct_call_time,
+                             'compile_time': profile.compile_time,
+                             'ops': [{'op': op, 'time': t} for (op, t) in ops]}
+        return summary
+
+    def to_dict(self):
+        return {'summary': self.summary(),
+                'events': self.events,
+                'theano': self.get_theano_summary()}
+
+    def save_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def get_chrome_trace(self):
+        '''Complete events of the trace event format, in microseconds'''
+        pid = os.getpid()
+        threads = {}
+        trace = []
+        for event in sorted(self.events, key=lambda e: (e['start'], -e['duration'])):
+            tid = threads.setdefault(event['thread'], len(threads))
+            scope = event['scope']
+            trace.append({'name': event['phase'] or scope.split('/')[-1] or 'profile',
+                          'cat': 'scope' if event['phase'] is None else scope,
+                          'ph': 'X',
+                          'ts': event['start'] * 1e6,
+                          'dur': event['duration'] * 1e6,
+                          'pid': pid,
+                          'tid': tid,
+                          'args': dict(event['args'], scope=scope)})
+        for (name, tid) in threads.items():
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def save_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.get_chrome_trace(), f)
+
+    def clear(self):
+        self.events = []
+        self.theano_profiles = collections.OrderedDict()
+
+    def __str__(self):
+        lines = []
+        for (scope, phases) in self.summary().items():
+            lines.append(scope or '-')
+            for (phase, t) in phases.items():
+                lines.append('    {:<18} {:>10.3f}s'.format(phase, t))
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def nothing():
+    yield
+
+
+def measure(profiler, phase, **args):
+    '''profiler.phase, or nothing without a profiler'''
+    return profiler.phase(phase, **args) if profiler else nothing()
+
+
+def measure_scope(profiler, name):
+    '''profiler.scope, or nothing without a profiler'''
+    return profiler.scope(name) if profiler else nothing()
+
+
+def profiled(name):
+    '''Decorator, runs a method under measure_scope(self.profiler, name)'''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with measure_scope(self.profiler, name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -4,7 +4,12 @@ import math
 from models.rbm_units import *
 from models.rbm_logger import *
 from models import rbm_config
+from models.function_cache import FunctionCache
+from models.profiler import COMPILE, POSITIVE, NEGATIVE, UPDATE_RESIDUAL, MONITOR, IO, PROFILING, measure, profiled
+from models.rbm_numpy import NumpyBackend
 from theano.tensor.shared_randomstreams import RandomStreams
+from theano.tensor.raw_random import RandomStateType
+from theano.ifelse import ifelse
 import utils
 import mnist_loader
 import datastorage as store
@@ -18,6 +23,17 @@ except ImportError:
 CLASSICAL = 'classical'
 NESTEROV = "nesterov"
 PERSISTENT = "persistent"
+PARALLEL_TEMPERING = "parallel_tempering"
+FAST_PERSISTENT = "fast_persistent"
+# Negative phases that keep chains from one update to the next
+PERSISTENT_TYPES = [PERSISTENT, FAST_PERSISTENT, PARALLEL_TEMPERING]
+
+THEANO = 'theano'
+NUMPY = 'numpy'
+
+FIXED_POINT = 'fixed_point'
+DAMPED = 'damped'
+ANDERSON = 'anderson'
 
 # Macro
 t_float_x = theano.config.floatX
@@ -53,13 +69,30 @@ class RBM(object):
         self.np_rand = np.random.RandomState(123)
         self.rand = RandomStreams(self.np_rand.randint(2 ** 30))
 
-        W = self.get_initial_weight(W, v_n, h_n, 'W')
+        # Low-rank W = W_a W_b: the factors are the parameters and W is their symbolic product (see dot_W)
+        # A W given for low-rank weights is the pair (W_a, W_b)
+        self.w_rank = getattr(config, 'w_rank', None)
+        if self.w_rank is not None and not 0 < self.w_rank < min(v_n, h_n):
+            raise Exception('w_rank has to be between 0 and min(v_n, h_n) = {}, '
+                            'got {}'.format(min(v_n, h_n), self.w_rank))
+        if self.w_rank:
+            W_a, W_b = W if W is not None else (None, None)
+            # Entries of the product start out with the standard deviation of a dense W
+            scale = np.sqrt(0.01 / np.sqrt(self.w_rank))
+            self.W_a = self.get_initial_weight(W_a, v_n, self.w_rank, 'W_a', scale)
+            self.W_b = self.get_initial_weight(W_b, self.w_rank, h_n, 'W_b', scale)
+            W = T.dot(self.W_a, self.W_b)
+            W.name = 'W'
+        else:
+            W = self.get_initial_weight(W, v_n, h_n, 'W')
         v_bias = self.get_initial_bias(v_bias, v_n, 'v_bias')
         h_bias = self.get_initial_bias(h_bias, h_n, 'h_bias')
 
         train_params = config.train_params
 
-        persistent = theano.shared(value=np.zeros((train_params.batch_size, h_n),
+        # Number of PCD fantasy particles, independent of the minibatch size
+        n_chains = config.n_chains or train_params.batch_size
+        persistent = theano.shared(value=np.zeros((n_chains, h_n),
                                                   dtype=t_float_x), name="persistent")
 
         # For sparsity cost
@@ -68,8 +101,8 @@ class RBM(object):
 
         self.dropout = train_params.dropout
         self.dropout_rate = train_params.dropout_rate
-        if self.dropout:
-            self.dropout_mask = self.rand.binomial(size=(h_n,), p=self.dropout_rate, n=1)
+        # Symbolic mask, drawn inside the compiled training graph (see get_dropout_mask)
+        self.dropout_mask = None
 
         self.train_parameters = train_params
 
@@ -88,7 +121,9 @@ class RBM(object):
         # Gibbs Sampling Method
         self.cd_type = cd_type
         self.cd_steps = cd_steps
+        self.n_chains = n_chains
         self.persistent = persistent
+        self.set_parallel_tempering(config.temperatures, v_n, v_n2, associative)
         self.params = [self.W, self.v_bias, self.h_bias]
 
         # For hyperparameters
@@ -102,14 +137,44 @@ class RBM(object):
             self.v_unit2 = config.v2_unit()
             self.params += [self.U, self.v_bias2]
 
+        if self.w_rank:
+            self.params[0] = self.W_a
+            self.params.append(self.W_b)
+
+        # FPCD: fast weights, added to the parameters when sampling the persistent chains
+        self.fast_params = None
+        if cd_type is FAST_PERSISTENT:
+            self.fast_params = [theano.shared(np.zeros_like(p.get_value()), name='fast_' + p.name)
+                                for p in self.params]
+
+        # Training state that carries over from one call to train to the next (see get_train_fn)
+        self.momentum = self.get_momentum_buffers()
+        # index of bit i in the pseudo-likelihood, cycles over the visible units from one minibatch to the next
+        self.bit_i_idx = theano.shared(value=0, name='bit_i_idx')
+        self.epoch = 0
+        self.train_rng = None
+        self.train_rng_state = None
+
         self.associative = associative
         self.track_progress = config.progress_logger
         self.config = config
         self.training = False
 
+        # Compiled training and inference functions, reused across calls
+        self.train_fn_cache = FunctionCache()
+        self.inference_fn_cache = FunctionCache()
+        self.profiler = None
+
+        # Backend used by train, reconstruct and mean_field_inference_opt, can be switched per instance
+        self.backend = config.backend
+        self.numpy_backend = NumpyBackend(self)
+
         # Check for legit configuration
-        if train_params.sparsity_constraint and type(self.h_unit) is not RBMUnit:
-            raise Exception('Sparsity Constraint can be used only for Stochastic Binary Hidden Unit')
+        if self.backend == NUMPY:
+            self.numpy_backend.check_supported()
+
+        if train_params.sparsity_constraint and type(self.h_unit) not in [RBMUnit, ReLUnit, NReLUnit]:
+            raise Exception('Sparsity Constraint can be used only for Sigmoid, ReLU and NReLU Hidden Units')
 
         if train_params.sparsity_constraint:
             self.set_initial_hidden_bias()
@@ -117,14 +182,144 @@ class RBM(object):
             self.active_probability_h = theano.shared(value=new_p_h,
                                                       name="active_probability_h")
 
+    def __getstate__(self):
+        # Compiled functions are not pickled, they are rebuilt on demand
+        state = self.__dict__.copy()
+        del state['train_fn_cache']
+        del state['inference_fn_cache']
+        # Their random streams are, so that training resumes where it stopped
+        state['train_rng'] = None
+        state['train_rng_state'] = self.get_train_rng_state()
+        state['profiler'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Unpickled strings are new objects, the types are compared by identity
+        self.cd_type = intern(self.cd_type)
+        self.train_parameters.momentum_type = intern(self.train_parameters.momentum_type)
+        self.train_fn_cache = FunctionCache()
+        self.inference_fn_cache = FunctionCache()
+        if 'numpy_backend' not in state:
+            self.backend = THEANO
+            self.numpy_backend = NumpyBackend(self)
+        if 'n_chains' not in state:
+            self.n_chains = self.persistent.get_value(borrow=True).shape[0]
+        if 'temperatures' not in state:
+            self.temperatures = None
+        if 'fast_params' not in state:
+            self.fast_params = None
+        if 'w_rank' not in state:
+            self.w_rank = None
+        if 'profiler' not in state:
+            self.profiler = None
+        if 'momentum' not in state:
+            self.momentum = self.get_momentum_buffers()
+            self.bit_i_idx = theano.shared(value=0, name='bit_i_idx')
+            self.epoch = 0
+            self.train_rng = None
+            self.train_rng_state = None
+
+    def set_profiler(self, profiler):
+        """Records where the time of training and inference goes (see models.profiler), None to stop"""
+        self.profiler = profiler
+        self.train_fn_cache.profiler = profiler
+        self.inference_fn_cache.profiler = profiler
+
+    def get_theano_profile(self, name):
+        return self.profiler.get_theano_profile(name) if self.profiler else False
+
+    def get_momentum_buffers(self):
+        """Last increment of each parameter (old_DW, old_Dvbias, old_Dhbias, old_DU, old_Dvbias2)"""
+        return [theano.shared(np.zeros_like(p.get_value(borrow=True)), name='old_D' + p.name.replace('_', ''),
+                              borrow=True)
+                for p in self.params]
+
+    def reset_momentum(self):
+        for old_dp in self.momentum:
+            old_dp.set_value(np.zeros_like(old_dp.get_value(borrow=True)), borrow=True)
+
+    def get_random_states(self, fn):
+        """
+        Random states a compiled function draws from, in the order they were created in.
+        Unlike the order of the function's inputs, this is the same every time the graph is built.
+        """
+        used = set(i.variable for i in fn.maker.inputs if isinstance(i.variable.type, RandomStateType))
+        units = [self.v_unit, self.h_unit] + ([self.v_unit2] if self.associative else [])
+        streams = [self.rand] + [u.rand for u in units]
+        return [r for stream in streams for (r, _) in stream.state_updates if r in used]
+
+    def get_train_rng_state(self):
+        """State of the random streams of the training function used last"""
+        if self.train_rng is None:
+            return self.train_rng_state
+        return [r.get_value() for r in self.train_rng]
+
+    def set_parallel_tempering(self, temperatures, v_n, v_n2, associative):
+        """
+        Replicas of the n_chains persistent chains at each inverse temperature of the ladder.
+        The states are visible samples, stacked by temperature (rows [:n_chains] are at temperature 1).
+        """
+        self.temperatures = None
+        if self.cd_type is not PARALLEL_TEMPERING:
+            return
+
+        if temperatures is None:
+            temperatures = np.linspace(1., 0.1, 10)
+        self.temperatures = np.asarray(temperatures, dtype=t_float_x)
+        if self.temperatures[0] != 1 or len(self.temperatures) < 2:
+            raise Exception('Temperature ladder needs to start at 1 and have at least two temperatures')
+
+        n_replicas = len(self.temperatures) * self.n_chains
+        self.pt_chains = theano.shared(np.zeros((n_replicas, v_n), dtype=t_float_x), name='pt_chains')
+        if associative:
+            self.pt_chains2 = theano.shared(np.zeros((n_replicas, v_n2), dtype=t_float_x), name='pt_chains2')
+
+        # Swap counts of each pair of neighbouring temperatures, see get_swap_rates
+        self.pt_step = theano.shared(np.int64(0), name='pt_step')
+        self.swap_accepted = theano.shared(np.zeros(len(self.temperatures) - 1, dtype=t_float_x),
+                                           name='swap_accepted')
+        self.swap_attempted = theano.shared(np.zeros(len(self.temperatures) - 1, dtype=t_float_x),
+                                            name='swap_attempted')
+
+    def get_swap_rates(self, reset=True):
+        """Fraction of accepted replica swaps for each pair of neighbouring temperatures since the last reset"""
+        accepted = self.swap_accepted.get_value()
+        attempted = self.swap_attempted.get_value()
+        rates = accepted / np.maximum(attempted, 1)
+        if reset:
+            self.swap_accepted.set_value(np.zeros_like(accepted))
+            self.swap_attempted.set_value(np.zeros_like(attempted))
+        return rates
+
     def __str__(self):
         name = 'ass_' if self.associative else ''
-        return name + "rbm_{}-{}_{}{}_{}".format(self.v_n, self.h_n, self.cd_type, self.cd_steps, self.train_parameters)
-
-    def get_initial_weight(self, w, nrow, ncol, name):
+        rank = '_r{}'.format(self.w_rank) if self.w_rank else ''
+        return name + "rbm_{}-{}{}_{}{}_{}".format(self.v_n, self.h_n, rank, self.cd_type, self.cd_steps,
+                                                   self.train_parameters)
+
+    def get_weights(self, borrow=False):
+        """Value of W, the product of its factors for low-rank weights"""
+        if self.w_rank:
+            return np.dot(self.W_a.get_value(borrow=True), self.W_b.get_value(borrow=True))
+        return self.W.get_value(borrow=borrow)
+
+    def dot_W(self, v):
+        """v W, a low-rank W is never formed: (v W_a) W_b takes (v_n + h_n) rank instead of v_n h_n per row"""
+        if self.w_rank:
+            return T.dot(T.dot(v, self.W_a), self.W_b)
+        return T.dot(v, self.W)
+
+    def dot_W_T(self, h):
+        """h W'"""
+        if self.w_rank:
+            return T.dot(T.dot(h, self.W_b.T), self.W_a.T)
+        return T.dot(h, self.W.T)
+
+    def get_initial_weight(self, w, nrow, ncol, name, scale=0.01):
         if w is None:
             w = np.asarray(
-                self.np_rand.normal(0, scale=0.01, size=(nrow, ncol)),
+                self.np_rand.normal(0, scale=scale, size=(nrow, ncol)),
                 # self.np_rand.uniform(low=-1./10, high=1./10, size=(nrow, ncol)),
                 # self.np_rand.uniform(
                 # low=-4 * np.sqrt(6. / (nrow + ncol)),
@@ -161,25 +356,29 @@ class RBM(object):
             self.v_bias.set_value(np.log2(p / (1 - p)))
 
     def set_initial_hidden_bias(self):
-        if self.train_parameters.sparsity_constraint:
+        # log [t / (1 - t)] puts sigmoid units at the target, it would only switch rectified units off
+        if self.train_parameters.sparsity_constraint and type(self.h_unit) is RBMUnit:
             print '... Sparsity: setting initial bias for Stochastic Binary Hidden Unit'
             t = self.train_parameters.sparsity_target
             bias = np.log(t / (1 - t))
             self.h_bias.set_value(np.tile(bias, self.h_n).astype(t_float_x))
 
-    def free_energy(self, v, v2=None):
+    def free_energy(self, v, v2=None, batch_scale=1):
         if self.associative:
-            return self.calc_free_energy(v, v2)
+            return self.calc_free_energy(v, v2, batch_scale)
         else:
-            return self.calc_free_energy(v)
+            return self.calc_free_energy(v, batch_scale=batch_scale)
 
-    def calc_free_energy(self, v, v2=None):
-        w = self.W
+    def calc_free_energy(self, v, v2=None, batch_scale=1):
+        """
+        :param batch_scale: factor for the terms that are summed over the batch (the ones averaged are left as is),
+                            used to put the free energy of n_chains persistent chains on the scale of a minibatch
+        """
         v_bias = self.v_bias
         h_bias = self.h_bias
 
         t0 = self.v_unit.energy(v, v_bias)
-        t1 = T.dot(v, w) + h_bias
+        t1 = self.dot_W(v) + h_bias
 
         if type(v2) is not type(None):
             u = self.U
@@ -190,13 +389,19 @@ class RBM(object):
 
         t2 = - T.sum(T.log(1 + T.exp(t1)))
 
+        if batch_scale != 1:
+            scale = T.cast(batch_scale, t_float_x)
+            t2 *= scale
+            if t0.ndim == 0:
+                t0 *= scale
+
         return t0 + t2
 
     def prop_up(self, v, v2=None):
         """Propagates v to the hidden layer. """
-        h_total_input = T.dot(v, self.W) + self.h_bias
+        h_total_input = self.dot_W(v) + self.h_bias
 
-        if np.any(v2):  # Associative
+        if v2 is not None:  # Associative
             h_total_input += T.dot(v2, self.U)
 
         h_p_activation = self.h_unit.scale(h_total_input)
@@ -205,33 +410,37 @@ class RBM(object):
 
         return [h_total_input, h_p_activation]
 
-    def __prop_down(self, h, connectivity, bias, v_unit):
-        """Propagates h to the visible layer. """
-        v_in = T.dot(h, connectivity.T) + bias
+    def get_dropout_mask(self, n):
+        """Mask for n rows of hidden units, sampled on the graph each time the compiled function is called"""
+        return self.rand.binomial(size=(n, self.h_n), n=1, p=self.dropout_rate, dtype=t_float_x)
+
+    def __prop_down(self, h_input, bias, v_unit):
+        """Propagates h to the visible layer, h_input is h times the transposed connectivity """
+        v_in = h_input + bias
         return [v_in, (v_unit.scale(v_in))]
 
     def prop_down(self, h):
-        return self.__prop_down(h, self.W, self.v_bias, self.v_unit)
+        return self.__prop_down(self.dot_W_T(h), self.v_bias, self.v_unit)
 
     def prop_down_assoc(self, h):
-        return self.__prop_down(h, self.U, self.v_bias2, self.v_unit2)
+        return self.__prop_down(T.dot(h, self.U.T), self.v_bias2, self.v_unit2)
 
     def sample_h_given_v(self, v, v2=None):
         h_total_input, h_p_activation = self.prop_up(v, v2)
         h_sample = self.h_unit.activate(h_p_activation)
         return [h_total_input, h_p_activation, h_sample]
 
-    def __sample_v_given_h(self, h_sample, prop_down_fn):
+    def __sample_v_given_h(self, h_sample, prop_down_fn, v_unit):
         v_total_input, v_p_activation = prop_down_fn(h_sample)
-        v_sample = self.v_unit.activate(v_p_activation)
+        v_sample = v_unit.activate(v_p_activation)
         return [v_total_input, v_p_activation, v_sample]
 
     def sample_v_given_h(self, h_sample):
-        return self.__sample_v_given_h(h_sample, self.prop_down)
+        return self.__sample_v_given_h(h_sample, self.prop_down, self.v_unit)
 
     def sample_v_given_h_assoc(self, h_sample):
-        return self.__sample_v_given_h(h_sample, self.prop_down) + self.__sample_v_given_h(h_sample,
-                                                                                           self.prop_down_assoc)
+        return self.__sample_v_given_h(h_sample, self.prop_down, self.v_unit) + \
+               self.__sample_v_given_h(h_sample, self.prop_down_assoc, self.v_unit2)
 
     def gibbs_hvh(self, h):
         v_total_input, v_p_activation, v_sample = self.sample_v_given_h(h)
@@ -277,8 +486,16 @@ class RBM(object):
         return [h_total_input, h_p_activation, h_sample,
                 v_total_input, v_p_activation, v_sample]
 
+    def get_chain_dropout_mask(self, n):
+        """The persistent chains have their own number of rows, so they get a mask of their own"""
+        if self.training and self.dropout and n != self.train_parameters.batch_size:
+            return self.get_dropout_mask(n)
+        return self.dropout_mask
+
     def pcd_assoc(self, k=1):
         chain_start = self.persistent
+        batch_mask = self.dropout_mask
+        self.dropout_mask = self.get_chain_dropout_mask(self.n_chains)
         (
             [
                 v_total_inputs,
@@ -298,27 +515,30 @@ class RBM(object):
                           None, None, None, chain_start],
             n_steps=k
         )
+        self.dropout_mask = batch_mask
         chain_end = v_samples[-1]
         chain_end2 = v2_samples[-1]
 
         updates[self.persistent] = h_samples[-1]
 
         # Return result of scan
-        return [updates,
-                chain_end,
-                v_total_inputs,
-                v_p_activations,
-                v_samples,
-                chain_end2,
-                v2_total_inputs,
-                v2_p_activations,
-                v2_samples,
-                h_total_inputs,
-                h_p_activations,
-                h_samples]
+        return self.add_fast_weights([updates,
+                                      chain_end,
+                                      v_total_inputs,
+                                      v_p_activations,
+                                      v_samples,
+                                      chain_end2,
+                                      v2_total_inputs,
+                                      v2_p_activations,
+                                      v2_samples,
+                                      h_total_inputs,
+                                      h_p_activations,
+                                      h_samples])
 
     def pcd(self, k=1):
         chain_start = self.persistent
+        batch_mask = self.dropout_mask
+        self.dropout_mask = self.get_chain_dropout_mask(self.n_chains)
         (
             [
                 v_total_inputs,
@@ -334,19 +554,145 @@ class RBM(object):
             outputs_info=[None, None, None, None, None, chain_start],
             n_steps=k
         )
+        self.dropout_mask = batch_mask
         chain_end = v_samples[-1]
 
         updates[self.persistent] = h_samples[-1]
 
         # Return result of scan
-        return [updates,
-                chain_end,
-                v_total_inputs,
-                v_p_activations,
-                v_samples,
-                h_total_inputs,
-                h_p_activations,
-                h_samples]
+        return self.add_fast_weights([updates,
+                                      chain_end,
+                                      v_total_inputs,
+                                      v_p_activations,
+                                      v_samples,
+                                      h_total_inputs,
+                                      h_p_activations,
+                                      h_samples])
+
+    def add_fast_weights(self, result):
+        """
+        FPCD (Tieleman, Hinton 2009): the persistent chains sample from the model with parameters + fast parameters.
+        The chain graph is cloned with the parameters replaced, so the gradient itself is still taken w.r.t. params.
+        """
+        if self.cd_type is not FAST_PERSISTENT:
+            return result
+        fast = dict((p, p + f) for (p, f) in zip(self.params, self.fast_params))
+        outputs, updates = self.clone_graph(result[1:], result[0], fast)
+        return [updates] + outputs
+
+    def tempered_free_energy(self, v_input, v_energy, betas):
+        """
+        Free energy of each replica at the inverse temperatures betas
+        :param v_input: total input to the hidden units, (temperatures, chains, h_n)
+        :param v_energy: energy of the visible units, (temperatures, chains)
+        :param betas: (temperatures,)
+        """
+        return betas.dimshuffle(0, 'x') * v_energy - \
+               T.sum(T.nnet.softplus(betas.dimshuffle(0, 'x', 'x') * v_input), axis=2)
+
+    def swap_replicas(self, parity, v, v2=None):
+        """
+        Metropolis swaps between neighbouring temperatures, all pairs (t, t + 1) with t % 2 == parity at once.
+        A swap of v_t and v_t+1 is accepted with probability
+        min(1, exp(F_t(v_t) + F_t+1(v_t+1) - F_t(v_t+1) - F_t+1(v_t)))
+        """
+        n_temps = len(self.temperatures)
+        n = self.n_chains
+        betas = T.constant(self.temperatures)
+
+        h_input = self.dot_W(v) + self.h_bias
+        v_energy = self.v_unit.sample_energy(v, self.v_bias)
+        if v2 is not None:
+            h_input += T.dot(v2, self.U)
+            v_energy += self.v_unit2.sample_energy(v2, self.v_bias2)
+        h_input = h_input.reshape((n_temps, n, self.h_n))
+        v_energy = v_energy.reshape((n_temps, n))
+
+        fe = self.tempered_free_energy(h_input, v_energy, betas)
+        fe_up = self.tempered_free_energy(h_input[:-1], v_energy[:-1], betas[1:])  # F_t+1(v_t)
+        fe_down = self.tempered_free_energy(h_input[1:], v_energy[1:], betas[:-1])  # F_t(v_t+1)
+        log_ratio = fe[:-1] + fe[1:] - fe_up - fe_down
+
+        attempt = T.eq(T.arange(n_temps - 1) % 2, parity).dimshuffle(0, 'x')
+        u = self.rand.uniform(size=(n_temps - 1, n), dtype=t_float_x)
+        accept = attempt * T.lt(T.log(u), log_ratio)
+
+        # Each replica is in at most one pair, so it takes the state of the one above or the one below
+        no_swap = T.zeros((1, n), dtype=accept.dtype)
+        from_above = T.concatenate([accept, no_swap]).dimshuffle(0, 1, 'x')
+        from_below = T.concatenate([no_swap, accept]).dimshuffle(0, 1, 'x')
+
+        def swap(x):
+            x = x.reshape((n_temps, n, x.shape[1]))
+            above = T.concatenate([x[1:], x[-1:]])
+            below = T.concatenate([x[:1], x[:-1]])
+            x = T.switch(from_above, above, T.switch(from_below, below, x))
+            return x.reshape((n_temps * n, x.shape[2]))
+
+        swapped = [swap(v)] + ([swap(v2)] if v2 is not None else [])
+        return swapped, T.cast(T.sum(accept, axis=1), t_float_x), T.cast(T.sum(attempt * T.ones_like(u), axis=1),
+                                                                          t_float_x)
+
+    def parallel_tempering(self, k=1, associative=False):
+        """
+        PT-k: each step runs one Gibbs step of every replica at its own temperature, then tries swaps
+        between neighbouring temperatures. The negative statistics are the replicas at temperature 1.
+        Returns the same values as pcd / pcd_assoc, for the temperature 1 replicas.
+        """
+        n = self.n_chains
+        n_replicas = len(self.temperatures) * n
+        betas = T.constant(np.repeat(self.temperatures, n).reshape(n_replicas, 1))
+        batch_mask = self.dropout_mask
+        mask = self.get_chain_dropout_mask(n_replicas)
+
+        def pt_step(parity, v, *v2):
+            v2 = v2[0] if associative else None
+            h_total_input = self.dot_W(v) + self.h_bias
+            if associative:
+                h_total_input += T.dot(v2, self.U)
+            h_p_activation = self.h_unit.tempered_scale(h_total_input, betas)
+            if self.training and self.dropout:
+                h_p_activation *= mask
+            h_sample = self.h_unit.tempered_activate(h_p_activation, betas)
+
+            v_total_input = self.dot_W_T(h_sample) + self.v_bias
+            v_p_activation = self.v_unit.tempered_scale(v_total_input, betas)
+            v_sample = self.v_unit.tempered_activate(v_p_activation, betas)
+            results = [v_total_input, v_p_activation]
+            if associative:
+                v2_total_input = T.dot(h_sample, self.U.T) + self.v_bias2
+                v2_p_activation = self.v_unit2.tempered_scale(v2_total_input, betas)
+                v2_sample = self.v_unit2.tempered_activate(v2_p_activation, betas)
+                results += [v2_total_input, v2_p_activation]
+                swapped, accepted, attempted = self.swap_replicas(parity, v_sample, v2_sample)
+            else:
+                swapped, accepted, attempted = self.swap_replicas(parity, v_sample)
+
+            return results + [h_total_input, h_p_activation, h_sample, accepted, attempted] + swapped
+
+        chains = [self.pt_chains] + ([self.pt_chains2] if associative else [])
+        n_outputs = 9 if associative else 7
+        outputs, updates = theano.scan(pt_step,
+                                       sequences=(self.pt_step + T.arange(k)) % 2,
+                                       outputs_info=[None] * n_outputs + chains,
+                                       n_steps=k)
+        self.dropout_mask = batch_mask
+
+        accepted, attempted = outputs[n_outputs - 2: n_outputs]
+        chain_ends = outputs[n_outputs:]
+        updates[self.pt_step] = self.pt_step + k
+        updates[self.swap_accepted] = self.swap_accepted + T.sum(accepted, axis=0)
+        updates[self.swap_attempted] = self.swap_attempted + T.sum(attempted, axis=0)
+        for chain, chain_end in zip(chains, chain_ends):
+            updates[chain] = chain_end[-1]
+
+        # Temperature 1 replicas, samples are taken after the swaps of each step
+        stats = [o[:, :n] for o in outputs[:n_outputs - 2]]
+        samples = [o[:, :n] for o in chain_ends]
+        result = [updates, samples[0][-1], stats[0], stats[1], samples[0]]
+        if associative:
+            result += [samples[1][-1], stats[2], stats[3], samples[1]]
+        return result + stats[-3:]
 
     def contrastive_divergence(self, x, k=1):
         '''
@@ -383,7 +729,8 @@ class RBM(object):
                 h_total_inputs,
                 h_p_activations,
                 h_samples,
-                h_sample]
+                h_sample,
+                h_total_input]
 
     def contrastive_divergence_assoc(self, x, y, k=1):
         h_total_input, h_p_activation, h_sample = self.sample_h_given_v(x, y)
@@ -422,10 +769,16 @@ class RBM(object):
                 v2_samples,
                 h_total_inputs,
                 h_p_activations,
-                h_samples]
+                h_samples,
+                h_total_input]
 
     def negative_statistics(self, x, y=None):
-        if self.cd_type is PERSISTENT:
+        if self.cd_type is PARALLEL_TEMPERING:
+            if y:
+                return self.parallel_tempering(self.cd_steps, associative=True)
+            else:
+                return self.parallel_tempering(self.cd_steps)
+        elif self.cd_type in [PERSISTENT, FAST_PERSISTENT]:
             if y:
                 return self.pcd_assoc(self.cd_steps)
             else:
@@ -449,7 +802,7 @@ class RBM(object):
         but not joint distribution P(X1, X2) for association """
 
         # index of bit i in expression p(x_i | x_{\i})
-        bit_i_idx = theano.shared(value=0, name='bit_i_idx')
+        bit_i_idx = self.bit_i_idx
 
         # binarize the input image by rounding to nearest integer
         xi = T.round(x)
@@ -473,8 +826,17 @@ class RBM(object):
 
         return cost
 
+    def get_chain_scale(self):
+        """Weight of the negative phase, so that n_chains persistent chains count as one minibatch"""
+        if self.cd_type in PERSISTENT_TYPES and self.n_chains != self.train_parameters.batch_size:
+            return float(self.train_parameters.batch_size) / self.n_chains
+        return 1
+
     def get_partial_derivatives(self, x, y):
         # Differentiate cost function w.r.t params to get gradients for param updates
+        chain_scale = self.get_chain_scale()
+        closed_form = self.train_parameters.closed_form_gradients
+        factor_scales = self.get_factor_scales() if self.w_rank else None
         if self.associative:
             # Perform Gibbs Sampling to generate negative statistics
             res = self.negative_statistics(x, y)
@@ -482,50 +844,154 @@ class RBM(object):
             v_input = res[2]
             v2_sample = res[5]
             v2_input = res[6]
-            cost = T.mean(self.free_energy(x, y)) - T.mean(self.free_energy(v_sample, v2_sample))
-            grads = T.grad(cost, self.params, consider_constant=[v_sample, v2_sample])
+            if closed_form:
+                grads = self.get_gradients(x, v_sample, y, v2_sample, *self.get_sampler_inputs(res, 9),
+                                           factor_scales=factor_scales)
+            else:
+                cost = T.mean(self.free_energy(x, y)) - T.mean(self.free_energy(v_sample, v2_sample, chain_scale))
+                grads = T.grad(cost, self.params, consider_constant=[v_sample, v2_sample])
             stats = [v_input, v2_input]
         else:
             res = self.negative_statistics(x)
             v_sample = res[1]
             v_input = res[2]
-            cost = T.mean(self.free_energy(x)) - T.mean(self.free_energy(v_sample))
-            grads = T.grad(cost, self.params, consider_constant=[v_sample])
-
-            # _, _, h = self.sample_h_given_v(x)
-            # _, _, vs = self.sample_v_given_h(h)
-            # _, _, hs = self.sample_h_given_v(vs)
-            # dw = (T.dot(x.T, h) - T.dot(vs.T, hs)) / -self.train_parameters.batch_size
-            # dv = T.mean(x - vs, axis=0)
-            # dh = T.mean(h - hs, axis=0)
-            # grads[1] = dv
-            # grads[2] = dh
-            # grads = [dw, dv, dh]
-            # Differentiate cost function w.r.t params to get gradients for param updates
-
+            if closed_form:
+                grads = self.get_gradients(x, v_sample, None, None, *self.get_sampler_inputs(res, 5),
+                                           factor_scales=factor_scales)
+            else:
+                cost = T.mean(self.free_energy(x)) - T.mean(self.free_energy(v_sample, batch_scale=chain_scale))
+                grads = T.grad(cost, self.params, consider_constant=[v_sample])
             stats = [v_input]
 
+        if self.w_rank and not closed_form:
+            grads = self.scale_factor_gradients(grads, factor_scales)
+
         updates = res[0]
 
         return {"gradients": grads,
                 "updates": updates,
                 "statistics": stats}
 
-    def get_cost_updates(self, x, param_increments, y=None):
+    def get_sampler_inputs(self, res, h_index):
+        """
+        Hidden total inputs the sampler has already computed, None where they have to be recomputed.
+        CD-k starts from the data (its initial total input comes last) and its chain ends with the hidden
+        total input of the final visible sample. PCD chains end the same way. FPCD chains run with fast weights
+        and parallel tempering swaps states after sampling, so their inputs are not the model's.
+        """
+        pos_input = res[-1] if self.cd_type not in PERSISTENT_TYPES else None
+        neg_input = res[h_index][-1] if self.cd_type not in [FAST_PERSISTENT, PARALLEL_TEMPERING] else None
+        return pos_input, neg_input
+
+    def get_gradients(self, x, v_sample, y=None, v2_sample=None, pos_input=None, neg_input=None, factor_scales=None):
+        """
+        Closed form of T.grad(mean(F(x, y)) - mean(F(v_sample, v2_sample)), params), with v_sample constant
+        and the negative phase weighted as in calc_free_energy. The hidden term of the free energy is a softplus
+        for every hidden unit type, so the statistics are sigmoid(total input):
+        dW = vs' sigmoid(vs W + h) - x' sigmoid(x W + h), dh = sum(sigmoid(vs W + h) - sigmoid(x W + h))
+        For low-rank weights dW is not formed, the factors get dW_a = dW W_b' and dW_b = W_a' dW.
+        :param pos_input: hidden total input of x (and y), computed here if None
+        :param neg_input: hidden total input of v_sample (and v2_sample), computed here if None
+        :param factor_scales: preconditioners of the factors of a low-rank W (see get_factor_scales), applied to
+                              the minibatch side of the products, so that they cost batch x rank^2
+        """
+        scale = self.get_chain_scale()
+        if pos_input is None:
+            pos_input = self.get_h_total_input(x, y)
+        if neg_input is None:
+            neg_input = self.get_h_total_input(v_sample, v2_sample)
+
+        h_pos = T.nnet.sigmoid(pos_input)
+        h_neg = T.nnet.sigmoid(neg_input)
+        if scale != 1:
+            h_neg *= T.cast(scale, t_float_x)
+
+        if self.w_rank:
+            # dW W_b' S_a = dW (S_a W_b)', S_a is symmetric
+            W_b = self.W_b if factor_scales is None else T.dot(factor_scales[0], self.W_b)
+            dW = T.dot(v_sample.T, T.dot(h_neg, W_b.T)) - T.dot(x.T, T.dot(h_pos, W_b.T))
+        else:
+            dW = T.dot(v_sample.T, h_neg) - T.dot(x.T, h_pos)
+        grads = [dW,
+                 self.get_visible_gradient(self.v_unit, x, v_sample, self.v_bias, scale),
+                 T.sum(h_neg, axis=0) - T.sum(h_pos, axis=0)]
+        if self.associative:
+            grads += [T.dot(v2_sample.T, h_neg) - T.dot(y.T, h_pos),
+                      self.get_visible_gradient(self.v_unit2, y, v2_sample, self.v_bias2, scale)]
+        if self.w_rank:
+            # S_b W_a' dW = (vs W_a S_b)' h_neg - (x W_a S_b)' h_pos
+            v_a, x_a = T.dot(v_sample, self.W_a), T.dot(x, self.W_a)
+            if factor_scales is not None:
+                v_a, x_a = T.dot(v_a, factor_scales[1]), T.dot(x_a, factor_scales[1])
+            grads.append(T.dot(v_a.T, h_neg) - T.dot(x_a.T, h_pos))
+        return grads
+
+    def get_factor_scales(self):
+        """
+        Preconditioners (W_b W_b')^-1 and (W_a' W_a)^-1 of the gradients of the factors of a low-rank W.
+        The plain gradients dW W_b' and W_a' dW grow with the other factor, so steps along them blow the factors up
+        at learning rates a dense W trains well with. Scaled gradient descent (Tong, Ma, Chi 2021) steps along
+        dW W_b' (W_b W_b')^-1 and (W_a' W_a)^-1 W_a' dW instead, which change W_a W_b about as much as lr dW
+        changes a dense W. Their cost is dominated by W_a' W_a, v_n x rank^2 per minibatch.
+        The Gram matrices are regularised by rbm_config.FACTOR_GRAM_EPS, a factor of lower rank than w_rank
+        makes them singular.
+        """
+        eps = T.cast(rbm_config.FACTOR_GRAM_EPS * T.eye(self.w_rank), t_float_x)
+        return (T.nlinalg.matrix_inverse(T.dot(self.W_b, self.W_b.T) + eps),
+                T.nlinalg.matrix_inverse(T.dot(self.W_a.T, self.W_a) + eps))
+
+    def scale_factor_gradients(self, grads, factor_scales):
+        """Preconditions the gradients of the factors (the first and the last parameter), see get_factor_scales"""
+        scale_a, scale_b = factor_scales
+        return [T.dot(grads[0], scale_a)] + grads[1:-1] + [T.dot(scale_b, grads[-1])]
+
+    def get_h_total_input(self, v, v2=None):
+        h_total_input = self.dot_W(v) + self.h_bias
+        if v2 is not None:
+            h_total_input += T.dot(v2, self.U)
+        return h_total_input
+
+    @staticmethod
+    def get_visible_gradient(v_unit, x, v_sample, v_bias, scale):
+        neg = v_unit.energy_gradient(v_sample, v_bias)
+        # Only energies summed over the batch are scaled, see calc_free_energy
+        if scale != 1 and v_unit.energy(v_sample, v_bias).ndim == 0:
+            neg *= T.cast(scale, t_float_x)
+        return v_unit.energy_gradient(x, v_bias) - neg
+
+    @staticmethod
+    def clone_graph(outputs, updates, replace):
+        """
+        Clones outputs and update expressions with the variables in replace substituted.
+        Random streams that are advanced implicitly (default_update) become explicit updates of the clone,
+        otherwise the original sampling graph would be compiled in as well just to advance them.
+        """
+        updates = theano.OrderedUpdates(updates)
+        for v in theano.gof.graph.inputs(outputs + updates.values()):
+            if getattr(v, 'default_update', None) is not None and v not in updates:
+                updates[v] = v.default_update
+
+        keys = updates.keys()
+        cloned = theano.clone(outputs + [updates[k] for k in keys], replace=replace)
+        return cloned[:len(outputs)], theano.OrderedUpdates(zip(keys, cloned[len(outputs):]))
+
+    def get_cost_updates(self, x, param_increments, y=None, monitor_index=None):
         """
         Get Cost function and a list of variables to update. To be called by get_train_fn function.
         Order of Parameters is fixed:
-        1. W
+        1. W (W_a for low-rank weights)
         2. v1
         3. h
         4. U
         5. v2
+        6. W_b for low-rank weights
 
         :param x: Theano symbolic variable for an input
         :param param_increments: Contains supplemental variables that will be used to update the variables.
                                  First 5 elements are for momentum, the last element is for sparsity constraint.
 
         :param y: Theano symbolic variable for an association input
+        :param monitor_index: minibatch index, every monitor_every-th minibatch the cost comes with weight statistics
         :return: cost, updates
         """
 
@@ -543,101 +1009,68 @@ class RBM(object):
         # else:
         # old_DW, old_Dvbias, old_Dhbias = old_ds
 
-        pre_updates = []
-        if param.momentum_type is NESTEROV:
-            for (p, old_dp) in zip(self.params, old_ds):
-                pre_updates.append((p, p + m * old_dp))
+        if self.dropout:
+            # One mask per minibatch, shared by every prop_up of the training step
+            self.dropout_mask = self.get_dropout_mask(param.batch_size)
 
         grad_meta = self.get_partial_derivatives(x, y)
         gradients = grad_meta["gradients"]
         updates = grad_meta["updates"]
 
-        # For each parameters, compute: new_dx = m * old_dx - lr * grad_x
-        new_ds = map(lambda (d, g): m * d - lr * g, zip(old_ds, gradients))
-
-        # TODO
-        # if not param.weight_decay_for_bias:
-        # only apply weight decay to W, U
-
-        if param.momentum_type is NESTEROV:
-
-            def nesterov_update(p, grad_p, old_dp):
-                # Nesterov update:
-                # v_new = m * v_old - lr * Df(x_old + m*v_old)
-                # x_new = x_old + v_new
-                # <=> x_new = [x_old + m * v_old] - lr * Df([x_old + m * v_old])
-                # NOTE: there is a hack here -- we compute the partial derivatives wrt. (x + m * v)
-                # It means grad_x = dFd(x+ m*v) and x = (x - m * dx)
-                new_p = p - lr * grad_p
-                new_p = new_p - lr * weight_decay * (p - m * old_dp)
-                return new_p
-
-            new_params = map(nesterov_update, self.params, gradients, old_ds)
-
-        else:
-
-            def classical_update(p, new_dp):
-                # Classical Momentum from Sutskever, Hinton.
-                # v_new = momentum * v_old + lr * grad_wrt_w
-                # w_new = w_old + v_new
-                new_p = p + new_dp
-                new_p -= lr * weight_decay * p
-                return new_p
-
-            new_params = map(classical_update, self.params, new_ds)
-
         # Sparsity
+        # (index of parameter, penalty subtracted from it)
+        sparsity_penalties = []
         if param.sparsity_constraint:
             active_probability_h = param_increments[-1]
-            sparsity_target = T.cast(param.sparsity_target, t_float_x)
-            sparsity_cost = T.cast(param.sparsity_cost, t_float_x)
-            sparsity_decay_rate = T.cast(param.sparsity_decay, t_float_x)
-            # 1. Compute actual probability of hidden unit being active, q
-            # 1.1 Get q_current (mean probability that a unit is active in each mini-batch
-            if self.associative:
-                _, h_p_activation = self.prop_up(x, y)
-            else:
-                _, h_p_activation = self.prop_up(x)
-            # q is the decaying average of mean active probability in each batch
-            q = sparsity_decay_rate * active_probability_h + (1 - sparsity_decay_rate) * T.mean(h_p_activation, axis=0)
+            sparsity_penalties, q = self.get_sparsity_penalties(x, y, active_probability_h, lr)
 
             # 1.2 Update q_current = q for next iteration
             updates[active_probability_h] = T.cast(q, t_float_x)
 
-            # 2. Define Sparsity Penalty Measure (dim = 1 x n_hidden)
-            sparsity_penalty = T.nnet.binary_crossentropy(sparsity_target, q)
+        # Cost function
+        stats = grad_meta["statistics"]
+        if self.cd_type in PERSISTENT_TYPES:
+            # cost = self.get_reconstruction_cost(x, v_total_inputs)
+            measure_cost = self.get_pseudo_likelihood(x, updates)
+        else:
+            v_total_inputs = stats[0]
+            measure_cost = self.get_reconstruction_cost(x, v_total_inputs)
+            if self.associative:
+                v2_total_inputs = stats[1]
+                measure_cost += self.get_reconstruction_cost(y, v2_total_inputs)
 
-            # 3. Get the derivative
-            if isinstance(self.h_unit, BinaryUnit):  # if sigmoid
-                d_sparsity = q - sparsity_target
-            else:
-                # Summation is a trick to differentiate element-wise
-                # (as non relevant terms in sum vanish because they are constant w.r.t the partial derivatives)
-                d_sparsity = T.grad(T.sum(sparsity_penalty), q)
+        if param.momentum_type is NESTEROV:
+            # Nesterov update:
+            # v_new = m * v_old - lr * Df(x_old + m*v_old)
+            # x_new = x_old + v_new
+            # The gradient is taken at the look-ahead point (x_old + m * v_old) by cloning the graph
+            # with the parameters replaced, so the look-ahead is never written to the parameters.
+            lookahead = dict((p, p + m * old_dp) for (p, old_dp) in zip(self.params, old_ds))
+            penalty_terms = [penalty for (_, penalty) in sparsity_penalties]
+            outputs, updates = self.clone_graph(gradients + penalty_terms + [measure_cost], updates, lookahead)
+            gradients = outputs[:len(gradients)]
+            sparsity_penalties = zip([i for (i, _) in sparsity_penalties], outputs[len(gradients):-1])
+            measure_cost = outputs[-1]
 
-            # Apply derivative scaled by sparsity_cost to the weights
-            # 1. use same quantity to adjust each weight
-            # new_hbias -= lr * sparsity_cost * d_sparsity
-            # new_W -= lr * sparsity_cost * d_sparsity
-            # 2. multiply quantity by dq/dw (chain rule)
+        # For each parameters, compute: new_dx = m * old_dx - lr * grad_x
+        new_ds = map(lambda (d, g): m * d - lr * g, zip(old_ds, gradients))
 
-            # chain_p = T.grad(T.sum(q), self.params, disconnected_inputs='ignore')
-            # for i in xrange(len(new_params)):
-            # new_params = [p - lr * sparsity_cost * d_sparsity * chain_p[i] for i, p in enumerate(new_params)]
+        # TODO
+        # if not param.weight_decay_for_bias:
+        # only apply weight decay to W, U
 
-            if self.associative:
-                chain_W, chain_h, chain_U = T.grad(T.sum(q), [self.W, self.h_bias, self.U])
-                new_params[0] -= T.cast(lr * sparsity_cost * d_sparsity * chain_W, t_float_x)
-                new_params[2] -= lr * sparsity_cost * d_sparsity * chain_h
-                new_params[3] -= lr * sparsity_cost * d_sparsity * chain_U
-            else:
-                chain_W, chain_h = T.grad(T.sum(q), [self.W, self.h_bias])
-                new_params[0] -= T.cast(lr * sparsity_cost * d_sparsity * chain_W, t_float_x)
-                new_params[2] -= T.cast(lr * sparsity_cost * d_sparsity * chain_h, t_float_x)
-                #
-                # chain_W, chain_h = T.grad(T.sum(q), [self.W, self.h_bias])
-                # new_hbias -= lr * sparsity_cost * d_sparsity * chain_h
-                # new_W -= lr * sparsity_cost * d_sparsity * chain_W
+        def momentum_update(p, new_dp):
+            # Classical Momentum from Sutskever, Hinton.
+            # v_new = momentum * v_old + lr * grad_wrt_w
+            # w_new = w_old + v_new
+            new_p = p + new_dp
+            new_p -= lr * weight_decay * p
+            return new_p
+
+        new_params = map(momentum_update, self.params, new_ds)
+
+        for (i, penalty) in sparsity_penalties:
+            new_params[i] -= penalty
 
         # update parameters
         for (p, new_p) in zip(self.params, new_params):
@@ -647,21 +1080,169 @@ class RBM(object):
         for (old_dp, new_dp) in zip(old_ds, new_ds):
             updates[old_dp] = new_dp
 
-        # Cost function
-        stats = grad_meta["statistics"]
-        if self.cd_type is PERSISTENT:
-            # cost = self.get_reconstruction_cost(x, v_total_inputs)
-            measure_cost = self.get_pseudo_likelihood(x, updates)
+        # FPCD: fast weights learn with the same gradient and decay quickly
+        if self.cd_type is FAST_PERSISTENT:
+            fast_lr = T.cast(param.fast_learning_rate, dtype=t_float_x)
+            fast_decay = T.cast(param.fast_decay, dtype=t_float_x)
+            for (f, g) in zip(self.fast_params, gradients):
+                updates[f] = fast_decay * f - fast_lr * g
+
+        if monitor_index is not None:
+            new_W = T.dot(updates[self.W_a], updates[self.W_b]) if self.w_rank else updates[self.W]
+            measure_cost = [measure_cost, self.get_weight_stats(monitor_index, gradients[0], new_W)]
+
+        return measure_cost, updates
+
+    def get_sparsity_penalties(self, x, y, active_probability_h, lr):
+        """
+        Penalties of the sparsity constraint as (index of parameter, penalty subtracted from it)
+        and the decaying average q of the mean hidden activation probabilities.
+
+        The activity is the probability that a hidden unit is active (h_unit.active_probability), the
+        sigmoid of the total input for ReLU and NReLU units as well, whose scaled output is not a probability.
+        With closed_form_gradients dq/dparams is taken from the hidden activations of the minibatch,
+        d mean(p(x W + h)) / dW = x' p'(x W + h) / n, instead of a backward pass through prop_up.
+        The penalties of the factors of a low-rank W are preconditioned like their gradients (see get_factor_scales).
+        """
+        param = self.train_parameters
+        sparsity_target = T.cast(param.sparsity_target, t_float_x)
+        sparsity_cost = T.cast(param.sparsity_cost, t_float_x)
+        sparsity_decay_rate = T.cast(param.sparsity_decay, t_float_x)
+        # 1. Compute actual probability of hidden unit being active, q
+        # 1.1 Get q_current (mean probability that a unit is active in each mini-batch
+        if self.associative:
+            h_total_input, _ = self.prop_up(x, y)
         else:
-            v_total_inputs = stats[0]
-            measure_cost = self.get_reconstruction_cost(x, v_total_inputs)
-            if self.associative:
-                v2_total_inputs = stats[1]
-                measure_cost += self.get_reconstruction_cost(y, v2_total_inputs)
+            h_total_input, _ = self.prop_up(x)
+        # q is the decaying average of mean active probability in each batch
+        q = sparsity_decay_rate * active_probability_h + \
+            (1 - sparsity_decay_rate) * T.mean(self.get_active_probability(h_total_input), axis=0)
+
+        # 2. Define Sparsity Penalty Measure (dim = 1 x n_hidden), the cross entropy of q against the target
+        sparsity_penalty = T.nnet.binary_crossentropy(q, sparsity_target)
+
+        # 3. Get the derivative
+        if isinstance(self.h_unit, BinaryUnit):  # if sigmoid
+            d_sparsity = q - sparsity_target
+        elif param.closed_form_gradients:
+            # d binary_crossentropy(target, q) / dq
+            d_sparsity = (q - sparsity_target) / (q * (1 - q))
+        else:
+            # Summation is a trick to differentiate element-wise
+            # (as non relevant terms in sum vanish because they are constant w.r.t the partial derivatives)
+            d_sparsity = T.grad(T.sum(sparsity_penalty), q)
+
+        # Apply derivative scaled by sparsity_cost to the weights
+        # 1. use same quantity to adjust each weight
+        # new_hbias -= lr * sparsity_cost * d_sparsity
+        # new_W -= lr * sparsity_cost * d_sparsity
+        # 2. multiply quantity by dq/dw (chain rule)
+        if param.closed_form_gradients:
+            # dq / d(total input) of each hidden unit in each row, masked like the activations
+            dq = (1 - sparsity_decay_rate) * self.h_unit.active_probability_gradient(h_total_input) / x.shape[0]
+            if self.training and self.dropout:
+                dq *= self.dropout_mask
+            dq = T.cast(dq, t_float_x)
+            if self.w_rank:
+                # d_sparsity is per hidden unit, it has to be applied before the chain rule reaches W_a.
+                # The factors are preconditioned like their gradients, see get_gradients
+                dq *= d_sparsity
+                d_sparsity = 1
+                scale_a, scale_b = self.get_factor_scales()
+                chains = [T.dot(x.T, T.dot(dq, T.dot(scale_a, self.W_b).T)), T.sum(dq, axis=0)] + \
+                         ([T.dot(y.T, dq)] if self.associative else []) + \
+                         [T.dot(T.dot(T.dot(x, self.W_a), scale_b).T, dq)]
+            else:
+                chains = [T.dot(x.T, dq), T.sum(dq, axis=0)] + ([T.dot(y.T, dq)] if self.associative else [])
+        elif self.w_rank:
+            chains = T.grad(T.sum(q * d_sparsity), [self.W_a, self.h_bias] + ([self.U] if self.associative else []) +
+                            [self.W_b], consider_constant=[d_sparsity])
+            chains = self.scale_factor_gradients(chains, self.get_factor_scales())
+            d_sparsity = 1
+        elif self.associative:
+            chains = T.grad(T.sum(q), [self.W, self.h_bias, self.U])
+        else:
+            chains = T.grad(T.sum(q), [self.W, self.h_bias])
 
-        return measure_cost, updates, pre_updates
+        # W (W_a), h_bias and U are the parameters 0, 2 and 3, W_b is the last one
+        indices = [0, 2] + ([3] if self.associative else []) + ([len(self.params) - 1] if self.w_rank else [])
+        penalties = [(i, T.cast(lr * sparsity_cost * d_sparsity * chain, t_float_x))
+                     for (i, chain) in zip(indices, chains)]
+        return penalties, q
+
+    def get_active_probability(self, h_total_input):
+        """Probability that each hidden unit is active, masked like the activations when training with dropout"""
+        p = self.h_unit.active_probability(h_total_input)
+        if self.training and self.dropout:
+            p *= self.dropout_mask
+        return p
+
+    def get_monitor_every(self):
+        """Minibatches between weight statistics returned by the compiled training function, 0 for none"""
+        if self.track_progress and self.track_progress.monitor_weights and self.backend != NUMPY:
+            return self.track_progress.monitor_every
+        return 0
+
+    def get_weight_stats(self, index, gradient, new_W):
+        """
+        Statistics of the updated weights, the gradient and the size of the update relative to the weights
+        in the order of rbm_logger.WEIGHT_STATS. Only evaluated for every monitor_every-th minibatch, zeros otherwise.
+        For low-rank weights the gradient is that of W_a.
+        """
+        update_ratio = T.sqrt(T.sum((new_W - self.W) ** 2) / T.maximum(T.sum(self.W ** 2), 1e-12))
+        stats = T.stack([T.mean(new_W), T.std(new_W), T.min(new_W), T.max(new_W),
+                         T.mean(gradient), T.std(gradient), T.min(gradient), T.max(gradient),
+                         update_ratio])
+        stats = T.cast(stats, t_float_x)
+        return ifelse(T.eq(index % self.get_monitor_every(), 0), stats, T.zeros_like(stats))
+
+    def get_train_fn_key(self, train_data, assoc_data):
+        """Everything that is baked into the compiled training function"""
+        data_shapes = tuple((d.get_value(borrow=True).shape, d.dtype)
+                            for d in [train_data, assoc_data] if d is not None)
+        units = [self.v_unit, self.h_unit] + ([self.v_unit2] if self.associative else [])
+        shared_vars = self.params + self.momentum + [self.active_probability_h, self.persistent] + \
+            (self.fast_params or [])
+        temperatures = tuple(self.temperatures) if self.temperatures is not None else None
+        # The number of epochs only matters to the python loop in train
+        train_params = [(k, v) for (k, v) in vars(self.train_parameters).items() if k != 'epochs']
+        return (data_shapes,
+                self.persistent.get_value(borrow=True).shape,
+                temperatures,
+                tuple(sorted(train_params)),
+                self.cd_type,
+                self.cd_steps,
+                tuple(type(u).__name__ for u in units),
+                tuple(id(v) for v in shared_vars),
+                self.training,
+                self.get_monitor_every())
 
     def get_train_fn(self, train_data, assoc_data):
+        if self.backend == NUMPY:
+            return self.numpy_backend.get_train_fn(train_data, assoc_data)
+
+        key = self.get_train_fn_key(train_data, assoc_data)
+        entry = self.train_fn_cache.get(key, lambda: self.compile_train_fn(train_data, assoc_data))
+
+        # Reuse the compiled function, only swap the data it is given
+        entry['train_data'].set_value(train_data.get_value(borrow=True), borrow=True)
+        if self.associative:
+            entry['assoc_data'].set_value(assoc_data.get_value(borrow=True), borrow=True)
+
+        # Momentum, sparsity averages and chains live on the RBM and carry over by themselves.
+        # Each compiled function has random states of its own, a function taking over from another one
+        # continues its random streams, so training is the same whether it is split into calls or not.
+        if entry['rng'] is not self.train_rng:
+            rng_state = self.get_train_rng_state()
+            if rng_state is not None and len(rng_state) == len(entry['rng']):
+                for (r, value) in zip(entry['rng'], rng_state):
+                    r.set_value(value)
+            self.train_rng = entry['rng']
+            self.train_rng_state = None
+
+        return entry['train_fn']
+
+    def compile_train_fn(self, train_data, assoc_data):
         param = self.train_parameters
         batch_size = param.batch_size
         index = T.lscalar()
@@ -669,22 +1250,12 @@ class RBM(object):
         y = T.matrix('y')
         param_increments = []
 
-        # Initialise Variables used for training
-        # For momentum
-        old_DW = theano.shared(value=np.zeros(self.W.get_value().shape, dtype=t_float_x),
-                               name='old_DW', borrow=True)
-        old_Dvbias = theano.shared(value=np.zeros(self.v_n, dtype=t_float_x),
-                                   name='old_Dvbias', borrow=True)
-        old_Dhbias = theano.shared(value=np.zeros(self.h_n, dtype=t_float_x),
-                                   name='old_Dhbias', borrow=True)
-        param_increments += [old_DW, old_Dvbias, old_Dhbias]
+        # Data is held by the compiled function so that later calls only need to swap it
+        train_data = theano.shared(train_data.get_value(borrow=True), name='train_data', borrow=True)
 
-        if self.associative:
-            old_DU = theano.shared(value=np.zeros(self.U.get_value().shape, dtype=t_float_x),
-                                   name='old_DU', borrow=True)
-            old_Dvbias2 = theano.shared(value=np.zeros(self.v_n2, dtype=t_float_x),
-                                        name='old_Dvbias2', borrow=True)
-            param_increments += [old_DU, old_Dvbias2]
+        # Initialise Variables used for training
+        # For momentum: old_DW, old_Dvbias, old_Dhbias (, old_DU, old_Dvbias2)
+        param_increments += self.momentum
 
         active_probability_h = self.active_probability_h
 
@@ -697,29 +1268,117 @@ class RBM(object):
         param_increments += [active_probability_h]
 
         if self.associative:
+            assoc_data = theano.shared(assoc_data.get_value(borrow=True), name='assoc_data', borrow=True)
             y_val = assoc_data[index * batch_size: (index + 1) * batch_size]
         else:
             y_val = 0
 
-        cross_entropy, updates, pre_updates = self.get_cost_updates(x, param_increments, y)
-        pre_train = theano.function([], updates=pre_updates)
-        train_rbm = theano.function(
-            [index],
-            cross_entropy,  # use cross entropy to keep track
-            updates=updates,
-            givens={
-                x: train_data[index * batch_size: (index + 1) * batch_size],
-                y: y_val
-            },
-            name='train_rbm',
-            on_unused_input='warn'
-        )
+        # With weight monitoring the training function returns [cost, weight statistics]
+        monitor_index = index if self.get_monitor_every() else None
+
+        if param.batches_per_call != 1:
+            train_rbm = self.compile_train_block_fn(train_data, assoc_data, param_increments)
+        else:
+            cross_entropy, updates = self.get_cost_updates(x, param_increments, y, monitor_index)
+            train_rbm = theano.function(
+                [index],
+                cross_entropy,  # use cross entropy to keep track
+                updates=updates,
+                givens={
+                    x: train_data[index * batch_size: (index + 1) * batch_size],
+                    y: y_val
+                },
+                name='train_rbm',
+                on_unused_input='warn',
+                profile=self.get_theano_profile('train_rbm')
+            )
+
+        return {'train_fn': train_rbm,
+                'train_data': train_data,
+                'assoc_data': assoc_data,
+                'rng': self.get_random_states(train_rbm)}
+
+    def compile_train_block_fn(self, train_data, assoc_data, param_increments):
+        """
+        Runs a block of minibatches inside one compiled scan over the batch indices.
+        Each step applies exactly the updates of a single train_rbm call, so momentum, sparsity and
+        persistent chains carry over from one minibatch to the next as in the python loop.
+        Returns f(start, n_batches) -> vector of the per-batch costs (and the matrix of per-batch weight statistics)
+        """
+        batch_size = self.train_parameters.batch_size
+        start = T.lscalar('start')
+        n_batches = T.lscalar('n_batches')
+        monitor = self.get_monitor_every()
+
+        def train_step(index):
+            x = train_data[index * batch_size: (index + 1) * batch_size]
+            y = assoc_data[index * batch_size: (index + 1) * batch_size] if self.associative else None
+            return self.get_cost_updates(x, param_increments, y, index if monitor else None)
+
+        costs, updates = theano.scan(train_step,
+                                     sequences=T.arange(start, start + n_batches),
+                                     name='train_rbm_block')
+
+        return theano.function([start, n_batches], costs, updates=updates, name='train_rbm_block',
+                               profile=self.get_theano_profile('train_rbm_block'))
+
+    def get_phase_fns(self, train_data, assoc_data):
+        key = self.get_train_fn_key(train_data, assoc_data)
+        entry = self.train_fn_cache.entries[key]
+        return self.train_fn_cache.get(('phases',) + key,
+                                       lambda: self.compile_phase_fns(entry['train_data'], entry['assoc_data']))
+
+    def compile_phase_fns(self, train_data, assoc_data):
+        """
+        The positive and the negative phase of the training function on their own, f(index) for the profiler,
+        and a function that does nothing, whose time is the overhead of a call.
+        None updates anything, random streams included, so profiling does not change training.
+        """
+        batch_size = self.train_parameters.batch_size
+        index = T.lscalar()
+        x = train_data[index * batch_size: (index + 1) * batch_size]
+        y = assoc_data[index * batch_size: (index + 1) * batch_size] if self.associative else None
+        if self.dropout:
+            self.dropout_mask = self.get_dropout_mask(batch_size)
+
+        if self.associative:
+            h_total_input, h_p_activation = self.prop_up(x, y)
+        else:
+            h_total_input, h_p_activation = self.prop_up(x)
+        positive = [T.dot(x.T, h_p_activation), T.sum(h_p_activation, axis=0)]
+        if self.associative:
+            positive.append(T.dot(y.T, h_p_activation))
+        negative = self.negative_statistics(x, y)[1]
 
-        def train_fn(i):
-            pre_train()
-            return train_rbm(i)
+        return [theano.function([index], outputs, no_default_updates=True, name=name, on_unused_input='ignore')
+                for (name, outputs) in [('positive_phase', positive), ('negative_phase', negative),
+                                        ('call_overhead', index)]]
 
-        return train_fn
+    def profile_call(self, phase_fns, batch_index, n_batches, start, duration, fractions=None):
+        """
+        Splits a call of the training function into the positive phase, negative phase and parameter update.
+        Without fractions, the phases are first timed on their own on the first minibatch of the call, less the
+        overhead of a call, which the fused training function pays once. The update is not timed, it is the
+        rest of the call (UPDATE_RESIDUAL). Every phase is an estimate and recorded as such.
+        Returns the fractions used.
+        """
+        if fractions is None:
+            times = []
+            with measure(self.profiler, PROFILING):
+                for fn in phase_fns:
+                    phase_start = time.time()
+                    fn(batch_index)
+                    times.append(time.time() - phase_start)
+            overhead = times[-1]
+            positive, negative = [max(t - overhead, 0.) * n_batches / duration for t in times[:2]]
+            positive = min(positive, 1.)
+            negative = min(negative, 1. - positive)
+            fractions = [positive, negative, 1. - positive - negative]
+
+        for (phase, fraction) in zip([POSITIVE, NEGATIVE, UPDATE_RESIDUAL], fractions):
+            self.profiler.record(phase, start, duration * fraction, batches=n_batches, estimated=True)
+            start += duration * fraction
+        return fractions
 
     @staticmethod
     def get_sub_data(train_data, train_label, factor=10):
@@ -739,10 +1398,11 @@ class RBM(object):
     def set_hidden_mean_activity(self, x, y=None):
         print '... Sparsity: setting initial mean activity for hidden units'
         sub_x, sub_y = self.get_sub_data(x, y)
-        _, ph = self.prop_up(sub_x, sub_y)
+        h_total_input, _ = self.prop_up(sub_x, sub_y)
+        ph = self.h_unit.active_probability(h_total_input)
         active_probability_h = theano.function([], T.mean(ph, axis=0))().astype(t_float_x)
         print active_probability_h.shape
-        self.active_probability_h = theano.shared(active_probability_h, 'active_probability_h')
+        self.active_probability_h.set_value(active_probability_h)
         # print active_probability_h
 
     def pretrain_mean_activity_h(self, x, y=None):
@@ -755,11 +1415,11 @@ class RBM(object):
             print 'attempt {}'.format(i)
             self.train(x, y)
 
-            _, ph = self.prop_up(sub_x, sub_y)
-            mean_ph = T.mean(ph, axis=0)
+            h_total_input, _ = self.prop_up(sub_x, sub_y)
+            mean_ph = T.mean(self.h_unit.active_probability(h_total_input), axis=0)
             f = theano.function([], mean_ph)
             active_probability_h = f()
-            self.active_probability_h = theano.shared(active_probability_h, 'active_probability_h')
+            self.active_probability_h.set_value(active_probability_h.astype(t_float_x))
 
             print 'mean, max, min', np.mean(active_probability_h), np.max(active_probability_h), np.min(
                 active_probability_h)
@@ -773,14 +1433,15 @@ class RBM(object):
             print 'sparsity cost updated to {}'.format(self.train_parameters.sparsity_cost)
 
     def set_default_weights(self):
-        self.W = self.get_initial_weight(None, self.v_n, self.h_n, 'W')
-        self.v_bias = self.get_initial_bias(None, self.v_n, 'v_bias')
-        self.h_bias = self.get_initial_bias(None, self.h_n, 'h_bias')
-        self.params = [self.W, self.v_bias, self.h_bias]
+        # Reset the values in place, so compiled functions bound to the parameters stay valid
+        defaults = [self.get_initial_weight(None, self.v_n, self.h_n, 'W'),
+                    self.get_initial_bias(None, self.v_n, 'v_bias'),
+                    self.get_initial_bias(None, self.h_n, 'h_bias')]
         if self.associative:
-            self.U = self.get_initial_weight(None, self.v_n, self.h_n, 'U')
-            self.v_bias2 = self.get_initial_bias(None, self.v_n2, 'v_bias2')
-            self.params = self.params + [self.U, self.v_bias2]
+            defaults += [self.get_initial_weight(None, self.v_n2, self.h_n, 'U'),
+                         self.get_initial_bias(None, self.v_n2, 'v_bias2')]
+        for (p, default) in zip(self.params, defaults):
+            p.set_value(default.get_value(borrow=True), borrow=True)
 
     def pretrain_lr(self, x, y=None):
         '''
@@ -810,38 +1471,84 @@ class RBM(object):
         self.train_parameters = tr
         self.set_default_weights()
 
-    def train(self, train_data, train_label=None, ctr=0):
-        """Trains RBM. For now, input needs to be Theano matrix"""
+    @profiled('train')
+    def train(self, train_data, train_label=None, ctr=None):
+        """
+        Trains RBM. For now, input needs to be Theano matrix
+        Continues from the state the last call left (momentum, sparsity averages, chains, random streams),
+        ctr numbers the epochs of the progress images and defaults to the epochs trained so far.
+        """
         self.training = True
         param = self.train_parameters
         batch_size = param.batch_size
         mini_batches = train_data.get_value(borrow=True).shape[0] / batch_size
         train_fn = self.get_train_fn(train_data, train_label)
+        block = max(1, param.batches_per_call or mini_batches) if self.backend != NUMPY else 1
+        # The numpy backend times its phases itself
+        phase_fns = self.get_phase_fns(train_data, train_label) if self.profiler and self.backend != NUMPY \
+            else None
+        fractions = None
+        n_calls = 0
+
+        # Weight statistics of every monitor_every-th minibatch
+        monitor_every = self.track_progress.monitor_every if self.track_progress and \
+            self.track_progress.monitor_weights else 0
+        if monitor_every:
+            n_monitored = int(math.ceil(mini_batches / float(monitor_every)))
+            self.track_progress.reserve_weight_stats(param.epochs * n_monitored)
+
+        if ctr is None:
+            ctr = self.epoch
 
         plotting_time = 0.
         start_time = time.clock()  # Measure training time
         for epoch in xrange(param.epochs):
             mean_cost = []
-            for batch_index in xrange(mini_batches):
-                if self.dropout:
-                    self.dropout_mask = self.np_rand.binomial(n=1, p=self.dropout_rate,
-                                                              size=(batch_size, self.h_n)).astype(t_float_x)
-
-                cost = train_fn(batch_index)
-                if not math.isnan(cost):
-                    mean_cost += [cost]
-                if self.track_progress and self.track_progress.monitor_weights:
-                    self.track_progress.monitor_wt(self)
+            for batch_index in xrange(0, mini_batches, block):
+                n_batches = min(block, mini_batches - batch_index)
+                call_start = time.time()
+                if block == 1:
+                    outputs = train_fn(batch_index)
+                else:
+                    outputs = train_fn(batch_index, n_batches)
+                if phase_fns:
+                    if n_calls % self.profiler.sample_every == 0:
+                        fractions = None
+                    fractions = self.profile_call(phase_fns, batch_index, n_batches, call_start,
+                                                  time.time() - call_start, fractions)
+                    n_calls += 1
+
+                with measure(self.profiler, MONITOR):
+                    if monitor_every and self.backend != NUMPY:
+                        costs, stats = outputs
+                        sampled = np.arange(batch_index, batch_index + n_batches) % monitor_every == 0
+                        self.track_progress.record_weight_stats(np.atleast_2d(stats)[sampled])
+                    else:
+                        costs = outputs
+                        if monitor_every and batch_index % monitor_every == 0:
+                            self.track_progress.monitor_wt(self)
+
+                costs = np.atleast_1d(costs)
+                mean_cost += [cost for cost in costs if not math.isnan(cost)]
 
             if self.track_progress:
-                print '... epoch %d, cost is ' % epoch, np.mean(mean_cost)
-                plotting_time += self.track_progress.visualise_weight(self, 'epoch_%05d.png' % (ctr + epoch))
+                with measure(self.profiler, MONITOR):
+                    print '... epoch %d, cost is ' % epoch, np.mean(mean_cost)
+                    if self.cd_type is PARALLEL_TEMPERING:
+                        self.track_progress.monitor_swap_rates(self)
+                    plotting_time += self.track_progress.visualise_weight(self, 'epoch_%05d.png' % (ctr + epoch))
+            self.epoch += 1
 
         end_time = time.clock()
         pre_training_time = (end_time - start_time) - plotting_time
 
         if self.track_progress:
             print ('... training took %f minutes' % (pre_training_time / 60.))
+            with measure(self.profiler, MONITOR):
+                visualiser = self.track_progress.flush()
+            if visualiser:
+                print ('... progress images: {}'.format(visualiser))
+            print ('... compiled training functions: {}'.format(self.train_fn_cache))
             print ('... training log saved to {}'.format(os.getcwd()))
             if self.track_progress.monitor_weights:
                 print 'Weight histogram'
@@ -856,7 +1563,8 @@ class RBM(object):
         return [mean_cost]
 
     def save(self):
-        store.store_object(self)
+        with measure(self.profiler, IO):
+            store.store_object(self)
         print "... saved RBM object to " + os.getcwd() + "/" + str(self)
 
     def sample(self, n=1, k=1, p=0.01, rand_type='uniform'):
@@ -879,48 +1587,117 @@ class RBM(object):
         Reconstruct image given cd-k
         - data: theano
         '''
-        if utils.isSharedType(data):
-            orig = data.get_value(borrow=True)
-        else:
-            orig = data
+        if self.backend == NUMPY:
+            return self.numpy_backend.reconstruct(data, k, plot_n, plot_every, img_name)
+
+        orig = np.asarray(self.get_array(data), dtype=t_float_x)
+
+        # Intermediate reconstructions are only kept when they are plotted
+        reconstructions = self.sample_reconstructions(orig, k, plot_every, keep_all=bool(self.track_progress))
+
+        if self.track_progress:
+            self.track_progress.visualise_reconstructions(orig, reconstructions, plot_n, img_name=img_name, multi=True)
+
+        return reconstructions[-1]
+
+    def sample_reconstructions(self, orig, k, plot_every=1, keep_all=False):
+        key = ('reconstruct', orig.shape, plot_every)
+        entry = self.inference_fn_cache.get(key, lambda: self.compile_reconstruct_fn(orig.shape, plot_every))
 
         # Set the initial chain
-        chain_state = theano.shared(np.asarray(orig, dtype=theano.config.floatX), name='reconstruct_root')
+        entry['chain_state'].set_value(orig)
 
         # Gibbs sampling
         k_batch = k / plot_every
+        reconstructions = []
+        for i in xrange(k_batch):
+            result = self.inference_fn_cache.run(entry['fn'])
+            [_, _, _, _, reconstruction_chain, _] = result
+            if keep_all or i == k_batch - 1:
+                reconstructions.append(reconstruction_chain[-1])
+
+        return reconstructions
+
+    def reconstruct_stream(self, data, k=1, plot_every=1, chunk_size=1000, prefetch=False):
+        """
+        Generator of cd-k reconstructions of data, chunk_size rows at a time.
+
+        data can be larger than memory (a memmap or an iterator of rows or arrays), only one chunk
+        and its reconstruction are held at a time, or two with prefetch which loads the next chunk
+        in a background thread. The last chunk is padded so every chunk runs through the same compiled sampler.
+        """
+        if self.backend == NUMPY:
+            def reconstruct_chunk(chunk):
+                return self.numpy_backend.sample_reconstruction(chunk, k, plot_every)
+        else:
+            def reconstruct_chunk(chunk):
+                return self.sample_reconstructions(chunk, k, plot_every)[-1]
+
+        return utils.stream(reconstruct_chunk, data, chunk_size, dtype=t_float_x, pad=True, prefetch_next=prefetch)
+
+    def compile_reconstruct_fn(self, shape, plot_every):
+        chain_state = theano.shared(np.zeros(shape, dtype=t_float_x), name='reconstruct_root')
         (res, updates) = theano.scan(self.gibbs_vhv,
                                      outputs_info=[None, None, None,
                                                    None, None, chain_state],
                                      n_steps=plot_every,
                                      name="Gibbs_sampling_reconstruction")
         updates.update({chain_state: res[-1][-1]})
-        gibbs_sampling = theano.function([], res, updates=updates)
+        return {'fn': theano.function([], res, updates=updates, name='reconstruct'),
+                'chain_state': chain_state}
+
+    @staticmethod
+    def get_array(data):
+        """Numpy value of shared variables and symbolic expressions, the compiled samplers take arrays"""
+        if isinstance(data, theano.compile.SharedVariable):
+            return data.get_value(borrow=True)
+        if isinstance(data, theano.gof.Variable):
+            return data.eval()
+        return data
+
+    def get_association_input(self, x, y, n, bit_p):
+        """Data of the fixed layer and the initial state of the layer to reconstruct as numpy arrays"""
+        x = self.get_array(x)
+        y = self.get_array(y)
+        if y is None:
+            y = self.np_rand.binomial(size=(x.shape[0], n), n=1, p=bit_p)
+        return np.asarray(x, dtype=t_float_x), np.asarray(y, dtype=t_float_x)
+
+    def reconstruct_association(self, x, y=None, k=1, bit_p=0, plot_n=None, plot_every=1,
+                                img_name='association_reconstruction.png', initial_input_multiplier=1):
+        # Initialise parameters
+        x, y = self.get_association_input(x, y, self.v_n2, bit_p)
 
+        key = ('reconstruct_association', x.shape, y.shape, plot_every)
+        entry = self.inference_fn_cache.get(key, lambda: self.compile_reconstruct_association_fn(x.shape, y.shape,
+                                                                                                  plot_every))
+        entry['x'].set_value(x)
+        self.inference_fn_cache.run(entry['init_fn'], y, initial_input_multiplier)
+
+        # Runner
+        k_batch = k / plot_every
         reconstructions = []
         for i in xrange(k_batch):
-            result = gibbs_sampling()
-            [_, _, _, _, reconstruction_chain, _] = result
+            result = self.inference_fn_cache.run(entry['fn'])
+            [_, _, _, _, reconstruction_chain, _, _, _, _] = result
             reconstructions.append(reconstruction_chain[-1])
 
         if self.track_progress:
-            self.track_progress.visualise_reconstructions(orig, reconstructions, plot_n, img_name=img_name, multi=True)
+            self.track_progress.visualise_reconstructions(x, reconstructions, plot_n, img_name=img_name)
 
-        return reconstructions[-1]
+        return reconstruction_chain[-1]
 
-    def reconstruct_association(self, x, y=None, k=1, bit_p=0, plot_n=None, plot_every=1,
-                                img_name='association_reconstruction.png', initial_input_multiplier=1):
-        # Initialise parameters
-        if not utils.isSharedType(x):
-            x = theano.shared(x, allow_downcast=True)
-        data_size = x.get_value().shape[0]
-        if not y:
-            y = self.rand.binomial(size=(data_size, self.v_n2), n=1, p=bit_p, dtype=t_float_x)
+    def compile_reconstruct_association_fn(self, x_shape, y_shape, plot_every):
+        x = theano.shared(np.zeros(x_shape, dtype=t_float_x), name='x')
+        y = T.matrix('y')
+        multiplier = T.scalar('initial_input_multiplier')
+        chain_start = theano.shared(np.zeros((x_shape[0], self.h_n), dtype=t_float_x), name='chain_start')
+
+        # Initial hidden state
+        _, _, h_sample = self.sample_h_given_v(x * multiplier, y)
+        init_fn = theano.function([y, multiplier], [], updates={chain_start: h_sample}, name='association_init')
 
         # Gibbs sampling
-        _, _, h_sample = self.sample_h_given_v(x * initial_input_multiplier, y)
-        chain_start = theano.shared(theano.function([], h_sample)())
-        k_batch = k / plot_every
         (res, updates) = theano.scan(
             self.gibbs_hvh_fixed,
             outputs_info=[None, None, None, None, None,
@@ -928,20 +1705,9 @@ class RBM(object):
             non_sequences=[x], n_steps=plot_every, name="Gibbs_sampling_association"
         )
         updates.update({chain_start: res[-1][-1]})
-        gibbs_sampling_assoc = theano.function([], res, updates=updates)
-
-        # Runner
-        reconstructions = []
-        for i in xrange(k_batch):
-            result = gibbs_sampling_assoc()
-            [_, _, _, _, reconstruction_chain, _, _, _, _] = result
-            reconstructions.append(reconstruction_chain[-1])
-
-        if self.track_progress:
-            self.track_progress.visualise_reconstructions(x.get_value(borrow=True), reconstructions, plot_n,
-                                                          img_name=img_name)
-
-        return reconstruction_chain[-1]
+        return {'fn': theano.function([], res, updates=updates, name='reconstruct_association'),
+                'init_fn': init_fn,
+                'x': x}
 
     def reconstruct_association_opt(self, x, y=None, k=1, bit_p=0, plot_n=None, plot_every=1,
                                     img_name='association_reconstruction.png', initial_input_multiplier=1):
@@ -953,171 +1719,314 @@ class RBM(object):
         '''
 
         # Initialise parameters
-        if not utils.isSharedType(x):
-            x = theano.shared(x, allow_downcast=True)
-        data_size = x.get_value().shape[0]
-        if not y:
-            y = self.rand.binomial(size=(data_size, self.v_n / 2), n=1, p=bit_p, dtype=t_float_x)
+        x, y = self.get_association_input(x, y, self.v_n / 2, bit_p)
 
-        # Concatenate x and y
-        z = T.concatenate([x, y], axis=1)
+        key = ('reconstruct_association_opt', x.shape, y.shape, plot_every)
+        entry = self.inference_fn_cache.get(key, lambda: self.compile_reconstruct_association_opt_fn(x.shape, y.shape,
+                                                                                                      plot_every))
+        entry['x'].set_value(x)
+        self.inference_fn_cache.run(entry['init_fn'], y, initial_input_multiplier)
 
-        # Gibbs sampling
-        _, _, h_sample = self.sample_h_given_v(z * initial_input_multiplier)
-        chain_start = theano.shared(theano.function([], h_sample)(), name='Z')
-
-        print chain_start.get_value().shape
+        print entry['chain_start'].get_value().shape
 
+        # Runner
         k_batch = k / plot_every
+        reconstructions = []
+        for i in xrange(k_batch):
+            result = self.inference_fn_cache.run(entry['fn'])
+            [_, reconstruction_chain, _, _, _, _] = result
+            reconstructions.append(reconstruction_chain[-1][:, (self.v_n / 2):])
+
+        if self.track_progress:
+            self.track_progress.visualise_reconstructions(x, reconstructions, plot_n,
+                                                          img_name=img_name, opt=True)
+
+        return reconstruction_chain[-1][:, (self.v_n / 2):]
 
+    def compile_reconstruct_association_opt_fn(self, x_shape, y_shape, plot_every):
+        x = theano.shared(np.zeros(x_shape, dtype=t_float_x), name='x')
+        y = T.matrix('y')
+        multiplier = T.scalar('initial_input_multiplier')
+        chain_start = theano.shared(np.zeros((x_shape[0], self.h_n), dtype=t_float_x), name='Z')
+
+        # Concatenate x and y
+        z = T.concatenate([x, y], axis=1)
+        _, _, h_sample = self.sample_h_given_v(z * multiplier)
+        init_fn = theano.function([y, multiplier], [], updates={chain_start: h_sample}, name='association_opt_init')
+
+        # Gibbs sampling
         (res, updates) = theano.scan(
             self.gibbs_hvh_fixed2,
             outputs_info=[None, None, None, None, None, chain_start],
             non_sequences=[x], n_steps=plot_every, name="Gibbs_sampling_association"
         )
         updates.update({chain_start: res[-1][-1]})
-        gibbs_sampling_assoc = theano.function([], res, updates=updates)
+        return {'fn': theano.function([], res, updates=updates, name='reconstruct_association_opt'),
+                'init_fn': init_fn,
+                'x': x,
+                'chain_start': chain_start}
 
-        # Runner
+    def mean_field_inference(self, x, tolerance=0.01, sample=False, k=100, bit_p=0, plot_n=None, plot_every=1,
+                             img_name='mean_field', return_iterations=False):
+        '''
+        Mean field inference of the associated layer given x, runs until the largest change of mu and tau
+        in a row is below tolerance (that row is then frozen) or for k iterations.
+        With return_iterations the number of iterations each row took is returned too.
+        '''
+        # Initialise parameters
+        x = np.asarray(self.get_array(x), dtype=t_float_x)
+        data_size = x.shape[0]
+
+        plot_every = min(k, 100)
+        key = ('mean_field_inference', x.shape, plot_every)
+        entry = self.inference_fn_cache.get(key, lambda: self.compile_mean_field_inference_fn(x.shape, plot_every))
+        entry['x'].set_value(x)
+        entry['mu'].set_value(np.zeros((data_size, self.v_n), dtype=t_float_x))
+        entry['tau'].set_value(np.zeros((data_size, self.h_n), dtype=t_float_x))
+        entry['converged'].set_value(np.zeros(data_size, dtype='int8'))
+        entry['iterations'].set_value(np.zeros(data_size, dtype='int32'))
+
+        # Runner, scan stops early once every row has converged
+        k_batch = k / plot_every
         reconstructions = []
         for i in xrange(k_batch):
-            result = gibbs_sampling_assoc()
-            [_, reconstruction_chain, _, _, _, _] = result
-            reconstructions.append(reconstruction_chain[-1][:, (self.v_n / 2):])
+            m, t, converged, iterations = self.inference_fn_cache.run(entry['fn'], tolerance)
+            reconstructions.append(m[-1])
+            if np.all(converged[-1]):
+                break
 
         if self.track_progress:
-            self.track_progress.visualise_reconstructions(x.get_value(borrow=True), reconstructions, plot_n,
-                                                          img_name=img_name, opt=True)
+            self.track_progress.visualise_reconstructions(x, reconstructions, plot_n,
+                                                          img_name=img_name)
 
-        return reconstruction_chain[-1][:, (self.v_n / 2):]
+        if sample:
+            result = self.np_rand.binomial(n=1, p=m[-1]).astype(t_float_x)
+        else:
+            result = m[-1]
 
-    def mean_field_inference(self, x, tolerance=0.01, sample=False, k=100, bit_p=0, plot_n=None, plot_every=1,
-                             img_name='mean_field'):
-        # Initialise parameters
-        if not utils.isSharedType(x):
-            x = theano.shared(x, allow_downcast=True)
-        data_size = x.get_value().shape[0]
+        return (result, iterations[-1]) if return_iterations else result
 
-        plot_every = 100
-        mu = theano.shared(np.zeros((data_size, self.v_n), dtype=t_float_x), name='mu')
-        tau = theano.shared(np.zeros((data_size, self.h_n), dtype=t_float_x), name='tau')
+    def compile_mean_field_inference_fn(self, shape, plot_every):
+        x = theano.shared(np.zeros(shape, dtype=t_float_x), name='x')
+        mu = theano.shared(np.zeros((shape[0], self.v_n), dtype=t_float_x), name='mu')
+        tau = theano.shared(np.zeros((shape[0], self.h_n), dtype=t_float_x), name='tau')
+        converged = theano.shared(np.zeros(shape[0], dtype='int8'), name='converged')
+        iterations = theano.shared(np.zeros(shape[0], dtype='int32'), name='iterations')
+        tolerance = T.scalar('tolerance')
 
         # Mean field inference -- basically gibbs sampling with no actual sampling
         def mean_field(m, t, x):
             _, mu2 = self.prop_down_assoc(t)
             _, tau2 = self.prop_up(x, mu2)
-            return mu2, tau2  # , {ctr: ctr+1}, theano.scan_module.until(ctr < 50)
+            return mu2, tau2
 
-        def mean_field_rev(m, t, x):
+        def mean_field_rev(m, t, done, n, x, tolerance):
             _, tau2 = self.prop_up(x, m)
             _, mu2 = self.prop_down(tau2)
             # _, mu2 = self.prop_down_assoc(tau2)
-            return mu2, tau2  # , {ctr: ctr+1}, theano.scan_module.until(ctr < 50)
 
-        k_batch = k / plot_every
+            # Converged rows keep their state
+            frozen = done.dimshuffle(0, 'x')
+            mu2 = T.switch(frozen, m, mu2)
+            tau2 = T.switch(frozen, t, tau2)
+            change = T.maximum(T.max(abs(mu2 - m), axis=1), T.max(abs(tau2 - t), axis=1))
+            done2 = done | T.cast(T.lt(change, tolerance), 'int8')
+            n2 = n + T.cast(1 - done, 'int32')
+            return [mu2, tau2, done2, n2], theano.scan_module.until(T.all(done2))
+
         (res, updates) = theano.scan(
             mean_field_rev,
-            outputs_info=[mu, tau],
-            non_sequences=[x], n_steps=plot_every, name="mean_field_inference"
+            outputs_info=[mu, tau, converged, iterations],
+            non_sequences=[x, tolerance], n_steps=plot_every, name="mean_field_inference"
         )
-        updates.update({tau: res[1][-1]})
-        updates.update({mu: res[0][-1]})
-        mfi = theano.function([], res, updates=updates)
-
-        # Runner
-        reconstructions = []
-        for i in xrange(k_batch):
-            m, t = mfi()
-            reconstructions.append(m[-1])
-
-        if self.track_progress:
-            self.track_progress.visualise_reconstructions(x.get_value(borrow=True), reconstructions, plot_n,
-                                                          img_name=img_name)
-
-        if sample:
-            return self.np_rand.binomial(n=1, p=m[-1]).astype(t_float_x)
-        else:
-            return m[-1]
+        updates.update({mu: res[0][-1], tau: res[1][-1], converged: res[2][-1], iterations: res[3][-1]})
+        return {'fn': theano.function([tolerance], res, updates=updates, name='mean_field_inference'),
+                'x': x,
+                'mu': mu,
+                'tau': tau,
+                'converged': converged,
+                'iterations': iterations}
 
     def mean_field_inference_opt(self, x, y=None, ylen=-1, sample=False, k=100, img_name='mean_field_inference',
-                                 initial_input_multiplier=1):
+                                 initial_input_multiplier=1, tolerance=0., return_iterations=False,
+                                 solver=FIXED_POINT):
         '''
         As an optimisation, we can concatenate two images and feed it as a single image to train the network.
         In this way theano performs matrix optimisation so its much faster.
 
         If such optimisation was done, this reconstruction method should be used.
+
+        A row stops being updated once the largest change of its tau is below tolerance,
+        inference ends when all rows have converged or after k iterations.
+        With return_iterations the number of iterations each row took is returned too.
+
+        solver picks how tau moves towards the fixed point tau = g(tau), each iteration costs one g:
+        - FIXED_POINT: tau = g(tau)
+        - DAMPED: tau += step * (g(tau) - tau), step grows while the residual shrinks and resets to 1 when it does not
+        - ANDERSON: Anderson acceleration with depth 1, extrapolates from the last two residuals
         '''
+        if self.backend == NUMPY:
+            return self.numpy_backend.mean_field_inference_opt(x, y, sample, k, img_name, initial_input_multiplier,
+                                                               tolerance, return_iterations, solver)
 
         plot_n = 100
         plot_every = k if k <= 10 else 10
-        ylen = self.v_n / 2 if type(y) is None and ylen == -1 else self.v_n - len(y.get_value()[0]) if type(
-            y) is not None else ylen
 
         # Initialise parameters
-        if not utils.isSharedType(x):
-            x = theano.shared(x, allow_downcast=True)
-        data_size = x.get_value().shape[0]
-        if type(y) is None:
-            y = self.rand.binomial(size=(data_size, ylen), n=1, p=0, dtype=t_float_x)
+        x = np.asarray(self.get_array(x), dtype=t_float_x)
+        y = self.get_array(y)
+        if y is None:
+            ylen = self.v_n / 2 if ylen == -1 else ylen
+            y = np.zeros((x.shape[0], self.v_n - ylen), dtype=t_float_x)
+        else:
+            ylen = self.v_n - len(y[0])
+        y = np.asarray(y, dtype=t_float_x)
+
+        key = ('mean_field_inference_opt', x.shape, y.shape, plot_every, solver)
+        entry = self.inference_fn_cache.get(key, lambda: self.compile_mean_field_inference_opt_fn(x.shape, y.shape,
+                                                                                                   plot_every, solver))
+        entry['x'].set_value(x)
+        self.inference_fn_cache.run(entry['init_fn'], y, initial_input_multiplier)
+
+        # Runner, scan stops early once every row has converged
+        k_batch = k / plot_every
+        reconstructions = []
+        for i in xrange(k_batch):
+            result = self.inference_fn_cache.run(entry['fn'], tolerance)
+            [reconstruction_chain, converged, iterations] = result[:3]
+            reconstructions.append(reconstruction_chain[-1][:, (ylen):])
+            if np.all(converged[-1]):
+                break
+
+        if self.track_progress:
+            self.track_progress.visualise_reconstructions(x, reconstructions, plot_n,
+                                                          img_name=img_name, opt=True)
+
+        if sample and type(self.v_unit) is RBMUnit:
+            result = self.np_rand.binomial(n=1, p=reconstruction_chain[-1][:, (ylen):])
+        else:
+            result = reconstruction_chain[-1][:, (ylen):]
+
+        return (result, iterations[-1]) if return_iterations else result
+
+    def compile_mean_field_inference_opt_fn(self, x_shape, y_shape, plot_every, solver=FIXED_POINT):
+        ylen = self.v_n - y_shape[1]
+        n = x_shape[0]
+        x = theano.shared(np.zeros(x_shape, dtype=t_float_x), name='x')
+        y = T.matrix('y')
+        multiplier = T.scalar('initial_input_multiplier')
+        tolerance = T.scalar('tolerance')
+        chain_start = theano.shared(np.zeros((n, self.h_n), dtype=t_float_x), name='tau')
+        converged = theano.shared(np.zeros(n, dtype='int8'), name='converged')
+        iterations = theano.shared(np.zeros(n, dtype='int32'), name='iterations')
+
+        # Solver state carried between iterations besides tau, with its initial value
+        if solver == DAMPED:
+            solver_state = [(theano.shared(np.ones(n, dtype=t_float_x), name='step_size'), 1.),
+                            (theano.shared(np.zeros(n, dtype=t_float_x), name='residual'), np.inf)]
+        elif solver == ANDERSON:
+            solver_state = [(theano.shared(np.zeros((n, self.h_n), dtype=t_float_x), name='g_prev'), 0.),
+                            (theano.shared(np.zeros((n, self.h_n), dtype=t_float_x), name='f_prev'), 0.),
+                            # No residual is below 0, which makes the first step a plain one
+                            (theano.shared(np.zeros(n, dtype=t_float_x), name='residual'), 0.)]
+        elif solver == FIXED_POINT:
+            solver_state = []
+        else:
+            raise Exception('Unknown mean field solver {}'.format(solver))
 
         # get initial values of tau (Concatenate x and y)
-        z = T.concatenate([x * initial_input_multiplier, y], axis=1)
+        z = T.concatenate([x * multiplier, y], axis=1)
         total_input, tau = self.prop_up(z)
         tau = self.h_unit.scale(total_input)
-
-        chain_start = theano.shared(theano.function([], tau)(), name='tau')
+        init_updates = [(chain_start, tau),
+                        (converged, T.zeros_like(converged)),
+                        (iterations, T.zeros_like(iterations))]
+        init_updates += [(s, T.cast(T.ones_like(s) * value, t_float_x)) for (s, value) in solver_state]
+        init_fn = theano.function([y, multiplier], [], updates=init_updates, name='mean_field_opt_init')
 
         # mean field func
-        def mean_field(tau1, fixed):
+        def mean_field(done, n, tau1, *args):
+            state = args[:len(solver_state)]
+            fixed, tolerance = args[len(solver_state):]
+
             _, mu2 = self.prop_down(tau1)
             mu2 = T.concatenate([fixed, mu2[:, (ylen):]], axis=1)
-            total_input, tau2 = self.prop_up(mu2)
-            tau2 = self.h_unit.scale(total_input)
-            return mu2, tau2  # , {ctr: ctr+1}, theano.scan_module.until(ctr < 50)
+            total_input, g = self.prop_up(mu2)
+            g = self.h_unit.scale(total_input)
+            f = g - tau1
+            residual = T.max(abs(f), axis=1)
+
+            if solver == DAMPED:
+                # The residual shrank by 1 - step * (1 - rate) for the slowest mode contracting at rate,
+                # 2 / (2 - rate) balances it against the modes that contract at once
+                [step_size, residual_prev] = state
+                rate = T.minimum(1 - (1 - residual / residual_prev) / step_size, 1.)
+                step_size2 = T.clip(2 / (2 - rate), 1., rbm_config.DAMPED_MAX_STEP)
+                step_size2 = T.switch(T.lt(residual, residual_prev), step_size2, 1.)
+                tau2 = tau1 + step_size2.dimshuffle(0, 'x') * f
+                state2 = [step_size2, residual]
+            elif solver == ANDERSON:
+                # Mix g with the previous g to cancel the residual along its last change,
+                # plain step on the first iteration and whenever the last extrapolation made the residual worse
+                [g_prev, f_prev, residual_prev] = state
+                df = f - f_prev
+                gamma = T.sum(f * df, axis=1) / T.maximum(T.sum(df ** 2, axis=1), 1e-12)
+                gamma = T.switch(T.lt(residual, residual_prev), gamma, 0.)
+                tau2 = g - gamma.dimshuffle(0, 'x') * (g - g_prev)
+                state2 = [g, f, residual]
+            else:
+                tau2 = g
+                state2 = []
+
+            # Converged rows keep their state
+            frozen = done.dimshuffle(0, 'x')
+            tau2 = T.switch(frozen, tau1, tau2)
+            state2 = [T.cast(T.switch(done if s.ndim == 1 else frozen, s, s2), t_float_x)
+                      for (s, s2) in zip(state, state2)]
+            done2 = done | T.cast(T.lt(residual, tolerance), 'int8')
+            n2 = n + T.cast(1 - done, 'int32')
+            return [mu2, done2, n2, tau2] + state2, theano.scan_module.until(T.all(done2))
 
         # loop
-        k_batch = k / plot_every
+        shared_state = [converged, iterations, chain_start] + [s for (s, _) in solver_state]
         (res, updates) = theano.scan(
             mean_field,
-            outputs_info=[None, chain_start],
-            non_sequences=[x], n_steps=plot_every, name="mean_field_opt"
+            outputs_info=[None] + shared_state,
+            non_sequences=[x, tolerance], n_steps=plot_every, name="mean_field_opt"
         )
-        updates.update({chain_start: res[-1][-1]})
-        mean_field_opt = theano.function([], res, updates=updates)
-
-        # Runner
-        reconstructions = []
-        for i in xrange(k_batch):
-            result = mean_field_opt()
-            [reconstruction_chain, _] = result
-            reconstructions.append(reconstruction_chain[-1][:, (ylen):])
-
-        if self.track_progress:
-            self.track_progress.visualise_reconstructions(x.get_value(borrow=True), reconstructions, plot_n,
-                                                          img_name=img_name, opt=True)
+        for (s, r) in zip(shared_state, res[1:]):
+            updates[s] = r[-1]
+        return {'fn': theano.function([tolerance], res, updates=updates, name='mean_field_inference_opt'),
+                'init_fn': init_fn,
+                'x': x}
 
-        if sample and type(self.v_unit) is RBMUnit:
-            return self.np_rand.binomial(n=1, p=reconstruction_chain[-1][:, (ylen):])
-        else:
-            return reconstruction_chain[-1][:, (ylen):]
-
-    def classify(self, xs):
+    def get_class_log_posteriors_fn(self):
+        """
+        log p(c | x) for every class c of the associated layer (one-hot v2), all classes in one pass:
+        -F(x, e_c) = -energy2(e_c) + sum_j softplus(x W + h + U[c]) up to the terms of x alone, which cancel
+        """
+        x = T.matrix('x')
+        x_input = self.dot_W(x) + self.h_bias
+        classes = T.eye(self.v_n2, dtype=t_float_x)
+        class_energy = self.v_unit2.sample_energy(classes, self.v_bias2)
+        h_input = x_input.dimshuffle(0, 'x', 1) + self.U.dimshuffle('x', 0, 1)
+        neg_free_energy = T.sum(T.nnet.softplus(h_input), axis=2) - class_energy.dimshuffle('x', 0)
+        return theano.function([x], T.nnet.logsoftmax(neg_free_energy), name='class_log_posteriors')
+
+    def get_class_log_posteriors(self, xs):
         assert self.associative
+        if utils.isSharedType(xs):
+            xs = xs.get_value(borrow=True)
+        fn = self.inference_fn_cache.get(('classify', self.v_n2), self.get_class_log_posteriors_fn)
+        return self.inference_fn_cache.run(fn, np.asarray(xs, dtype=t_float_x))
 
-        n_case = xs.get_value().shape[0]
-        n_classes = self.v_n2
-        pred_mat = np.zeros((n_case, n_classes))
-        for c in xrange(n_classes):
-            v_c = utils.get_class_vector(c, n_classes)
-            vs = np.tile(v_c, (n_case, 1))
-            energy = theano.function([], self.free_energy(xs, vs))()
-            # print energy
-            pred_mat[:, c] = energy
-
-        normalised = np.transpose(pred_mat.T / np.sum(pred_mat, axis=1))
-        print normalised
+    def classify(self, xs):
+        return self.get_class_log_posteriors(xs).argmax(axis=1)
 
-        return normalised.argmax(axis=1)
+    def sample_class(self, xs):
+        """One-hot samples of the label, drawn from the exact p(y | x) of a softmax label layer"""
+        assert isinstance(self.v_unit2, SoftmaxUnit)
+        return self.v_unit2.np_activate(np.exp(self.get_class_log_posteriors(xs)))
 
 
 def test_rbm():
@@ -9,6 +9,22 @@ t_float_x = theano.config.floatX
 CLASSICAL = 'classical'
 NESTEROV = "nesterov"
 PERSISTENT = "persistent"
+PARALLEL_TEMPERING = "parallel_tempering"
+FAST_PERSISTENT = "fast_persistent"
+
+# Backends
+THEANO = 'theano'
+NUMPY = 'numpy'
+
+# Mean field solvers
+FIXED_POINT = 'fixed_point'
+DAMPED = 'damped'
+ANDERSON = 'anderson'
+# Largest over-relaxation of the damped mean field solver
+DAMPED_MAX_STEP = 1.8
+
+# Added to the rank x rank Gram matrices that precondition the factors of a low-rank W
+FACTOR_GRAM_EPS = 1e-5
 
 
 class TrainParam(object):
@@ -24,7 +40,11 @@ class TrainParam(object):
                  sparsity_cost=0.01,            # use histogram
                  sparsity_decay=0.9,            # in range [0.9, 0.99]
                  dropout=False,
-                 dropout_rate=0.8               # in range [0.5 0.9]
+                 dropout_rate=0.8,              # in range [0.5 0.9]
+                 fast_learning_rate=0.001,      # FPCD only
+                 fast_decay=0.95,               # FPCD only, fast weights shrink by this factor every update
+                 closed_form_gradients=True,    # CD and sparsity gradients in closed form instead of by T.grad
+                 batches_per_call=1             # minibatches per compiled call, 0 for the whole epoch
                  ):
         self.epochs = epochs
         self.batch_size = batch_size
@@ -46,6 +66,15 @@ class TrainParam(object):
         self.dropout = dropout
         self.dropout_rate = dropout_rate
 
+        # Fast weights (FPCD)
+        self.fast_learning_rate = fast_learning_rate
+        self.fast_decay = fast_decay
+
+        self.closed_form_gradients = closed_form_gradients
+
+        # Execution: with more than one minibatch per call, training runs inside a compiled scan
+        self.batches_per_call = batches_per_call
+
 
     def __str__(self):
         return "batch{}_lr{}_{}{}_wd{}".format(self.batch_size, self.learning_rate, self.momentum_type, self.momentum,
@@ -61,6 +90,8 @@ class RBMConfig(object):
     def __init__(self,
                  cd_type=CLASSICAL,
                  cd_steps=1,
+                 n_chains=None,                 # persistent chains, batch_size if None
+                 temperatures=None,             # inverse temperatures for parallel tempering, starting at 1
                  associative=False,
                  v_n=10,
                  v_unit=rbm_units.RBMUnit,
@@ -68,10 +99,15 @@ class RBMConfig(object):
                  v2_unit=rbm_units.RBMUnit,
                  h_n=10,
                  h_unit=rbm_units.RBMUnit,
+                 w_rank=None,                   # W as a product of v_n x w_rank and w_rank x h_n factors, dense if None,
+                                                # in range (0, min(v_n, h_n))
                  train_params=TrainParam(),
-                 progress_logger=None):
+                 progress_logger=None,
+                 backend=THEANO):
         self.cd_type = cd_type
         self.cd_steps = cd_steps
+        self.n_chains = n_chains
+        self.temperatures = temperatures
         self.associative = associative
 
         self.v_n = v_n
@@ -82,9 +118,13 @@ class RBMConfig(object):
 
         self.h_n = h_n
         self.h_unit = h_unit
+        self.w_rank = w_rank
 
         self.train_params = train_params
         self.progress_logger = progress_logger
+        self.backend = backend  # {THEANO, NUMPY}
 
     def __str__(self):
-        return '{}{}_{}{}_{}{}'.format(self.cd_type, self.cd_steps, self.v_unit, self.v_n, self.h_unit, self.h_n)
+        rank = '_r{}'.format(self.w_rank) if getattr(self, 'w_rank', None) else ''
+        return '{}{}_{}{}_{}{}{}'.format(self.cd_type, self.cd_steps, self.v_unit, self.v_n, self.h_unit, self.h_n,
+                                         rank)
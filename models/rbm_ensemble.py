@@ -0,0 +1,245 @@
+import collections
+import time
+
+import numpy as np
+import theano
+import theano.tensor as T
+
+from models.rbm import RBM, CLASSICAL, PERSISTENT, NESTEROV, t_float_x
+from models.rbm_units import SoftmaxUnit
+
+
+class RBMEnsemble(object):
+    '''
+    Trains K RBMs of the same architecture at once, e.g. repeated attempts or a learning rate sweep.
+
+    The parameters of the members are stacked (W is K x v_n x h_n, the biases K x n) and every minibatch
+    of all members is one call of one compiled function, made of batched matrix products.
+    Each member keeps its own learning rate, momentum and weight decay (from its train_parameters),
+    samples from the random streams of its own units and visits the minibatches in an order of its own,
+    drawn every epoch from its np_rand (in order without shuffle).
+
+    The members are the RBM objects the ensemble was made of, get_member writes the trained parameters,
+    momentum and persistent chains back to them, after which they train and infer like any other RBM.
+
+    Members have to agree on everything the compiled graph depends on: layer sizes, unit types, cd_type
+    (CD-k or PCD-k), cd_steps, batch_size, n_chains and momentum_type. Sparsity, dropout, low-rank weights
+    and associative RBMs are not supported. Gradients are those of RBM.get_gradients (closed form),
+    the cost is the reconstruction cross entropy for PCD as well.
+    '''
+
+    def __init__(self, rbms, seeds=None, shuffle=True):
+        self.rbms = list(rbms)
+        self.k = len(self.rbms)
+        self.shuffle = shuffle
+        self.check_members()
+        if seeds is not None:
+            assert len(seeds) == self.k
+            for (rbm, seed) in zip(self.rbms, seeds):
+                self.seed_member(rbm, seed)
+
+        rbm = self.rbms[0]
+        self.v_n = rbm.v_n
+        self.h_n = rbm.h_n
+        self.cd_type = rbm.cd_type
+        self.cd_steps = rbm.cd_steps
+        self.batch_size = rbm.train_parameters.batch_size
+        # Epochs trained in the ensemble, on top of those each member had trained before
+        self.epoch = 0
+        self.member_epochs = [r.epoch for r in self.rbms]
+
+        self.params = [self.stack([r.params[i] for r in self.rbms], p.name) for (i, p) in enumerate(rbm.params)]
+        self.W, self.v_bias, self.h_bias = self.params
+        self.momentum = [self.stack([r.momentum[i] for r in self.rbms], d.name) for (i, d) in enumerate(rbm.momentum)]
+        self.persistent = self.stack([r.persistent for r in self.rbms], 'persistent')
+
+        # Per member hyperparameters, read from the members' train_parameters at every call to train
+        self.learning_rate = theano.shared(np.zeros(self.k, dtype=t_float_x), name='learning_rate')
+        self.momentum_rate = theano.shared(np.zeros(self.k, dtype=t_float_x), name='momentum')
+        self.weight_decay = theano.shared(np.zeros(self.k, dtype=t_float_x), name='weight_decay')
+
+        # Minibatch order of every member, K x mini_batches
+        self.batch_order = theano.shared(np.zeros((self.k, 1), dtype='int64'), name='batch_order')
+        self.train_data = None
+        self.train_fn = None
+        self.stats = []
+
+    @classmethod
+    def from_configs(cls, configs, seeds=None, shuffle=True):
+        '''Members made from configs, with initial weights (and random streams) drawn from their seeds'''
+        seeds = range(len(configs)) if seeds is None else seeds
+        rbms = []
+        for (config, seed) in zip(configs, seeds):
+            w = np.random.RandomState(seed).normal(0, scale=0.01, size=(config.v_n, config.h_n)).astype(t_float_x)
+            rbms.append(RBM(config, W=w))
+        return cls(rbms, seeds, shuffle)
+
+    def __str__(self):
+        return 'ensemble{}_{}'.format(self.k, self.rbms[0])
+
+    def check_members(self):
+        if self.k == 0:
+            raise Exception('RBMEnsemble needs at least one RBM')
+        first = self.rbms[0]
+        for rbm in self.rbms:
+            param = rbm.train_parameters
+            if rbm.associative or param.sparsity_constraint or param.dropout:
+                raise Exception('RBMEnsemble does not support associative RBMs, sparsity or dropout')
+            if rbm.w_rank:
+                raise Exception('RBMEnsemble does not support low-rank weights')
+            if rbm.cd_type not in [CLASSICAL, PERSISTENT]:
+                raise Exception('RBMEnsemble supports only CD-k and PCD-k')
+            if isinstance(rbm.v_unit, SoftmaxUnit) or isinstance(rbm.h_unit, SoftmaxUnit):
+                raise Exception('RBMEnsemble needs element-wise units, Softmax units are not supported')
+            if (rbm.v_n, rbm.h_n, type(rbm.v_unit), type(rbm.h_unit), rbm.cd_type, rbm.cd_steps, rbm.n_chains,
+                    param.batch_size, param.momentum_type) != \
+                    (first.v_n, first.h_n, type(first.v_unit), type(first.h_unit), first.cd_type, first.cd_steps,
+                     first.n_chains, first.train_parameters.batch_size, first.train_parameters.momentum_type):
+                raise Exception('Members of an RBMEnsemble need the same architecture and training method')
+
+    @staticmethod
+    def seed_member(rbm, seed):
+        '''Separate random streams (and minibatch order) for every member'''
+        rbm.np_rand = np.random.RandomState(seed)
+        for (i, unit) in enumerate([rbm.v_unit, rbm.h_unit]):
+            unit.np_rand = np.random.RandomState(seed + 100 * (i + 1))
+            unit.rand.seed(unit.np_rand.randint(2 ** 30))
+
+    @staticmethod
+    def stack(variables, name):
+        value = np.asarray([v.get_value(borrow=True) for v in variables], dtype=t_float_x)
+        return theano.shared(value, name=name, borrow=True)
+
+    def per_member(self, v, ndim):
+        '''Vector of per member values, broadcastable against K x ... tensors of ndim dimensions'''
+        return v.dimshuffle(*([0] + ['x'] * (ndim - 1)))
+
+    def activate(self, unit, p):
+        # Each member samples from the random streams of its own unit
+        return T.stack([getattr(rbm, unit).activate(p[i]) for (i, rbm) in enumerate(self.rbms)])
+
+    def prop_up(self, v, W, h_bias):
+        total_input = T.batched_dot(v, W) + h_bias.dimshuffle(0, 'x', 1)
+        return total_input, self.rbms[0].h_unit.scale(total_input)
+
+    def prop_down(self, h, W, v_bias):
+        total_input = T.batched_dot(h, W.dimshuffle(0, 2, 1)) + v_bias.dimshuffle(0, 'x', 1)
+        return total_input, self.rbms[0].v_unit.scale(total_input)
+
+    def get_cost_updates(self, x):
+        '''
+        x is K x batch_size x v_n. Same update as RBM.get_cost_updates, for every member at once.
+        Returns the reconstruction cost of every member and the updates.
+        '''
+        rbm = self.rbms[0]
+        lr = self.learning_rate
+        m = self.momentum_rate
+        weight_decay = self.weight_decay
+        scale = rbm.get_chain_scale()
+
+        if rbm.train_parameters.momentum_type is NESTEROV:
+            # Gradients at the look-ahead point, see RBM.get_cost_updates
+            W, v_bias, h_bias = [p + self.per_member(m, p.ndim) * old_dp for (p, old_dp) in zip(self.params,
+                                                                                                  self.momentum)]
+        else:
+            W, v_bias, h_bias = self.params
+
+        pos_input, h_p = self.prop_up(x, W, h_bias)
+        h = self.persistent if self.cd_type is PERSISTENT else self.activate('h_unit', h_p)
+        # cd_steps is small, so the chain is unrolled rather than scanned
+        for _ in xrange(self.cd_steps):
+            v_input, v_p = self.prop_down(h, W, v_bias)
+            v_sample = self.activate('v_unit', v_p)
+            neg_input, h_p = self.prop_up(v_sample, W, h_bias)
+            h = self.activate('h_unit', h_p)
+
+        updates = collections.OrderedDict()
+        if self.cd_type is PERSISTENT:
+            updates[self.persistent] = h
+            v_input, _ = self.prop_down(T.nnet.sigmoid(pos_input), W, v_bias)
+
+        # Closed form gradients, see RBM.get_gradients
+        h_pos = T.nnet.sigmoid(pos_input)
+        h_neg = T.nnet.sigmoid(neg_input)
+        if scale != 1:
+            h_neg *= T.cast(scale, t_float_x)
+        gradients = [T.batched_dot(v_sample.dimshuffle(0, 2, 1), h_neg) - T.batched_dot(x.dimshuffle(0, 2, 1), h_pos),
+                     T.stack([RBM.get_visible_gradient(rbm.v_unit, x[i], v_sample[i], v_bias[i], scale)
+                              for i in xrange(self.k)]),
+                     T.sum(h_neg, axis=1) - T.sum(h_pos, axis=1)]
+
+        for (p, old_dp, g) in zip(self.params, self.momentum, gradients):
+            new_dp = self.per_member(m, p.ndim) * old_dp - self.per_member(lr, p.ndim) * g
+            updates[p] = p + new_dp - self.per_member(lr * weight_decay, p.ndim) * p
+            updates[old_dp] = new_dp
+
+        p = rbm.v_unit.scale(v_input)
+        cost = T.mean(- T.sum(x * T.log(p) + (1 - x) * T.log(1 - p), axis=2), axis=1)
+        return cost, updates
+
+    def compile_train_fn(self, train_data):
+        index = T.lscalar()
+        # Minibatch index of every member
+        rows = (self.batch_order[:, index] * self.batch_size).dimshuffle(0, 'x') + T.arange(self.batch_size)
+        x = train_data[rows.flatten()].reshape((self.k, self.batch_size, self.v_n))
+        cost, updates = self.get_cost_updates(x)
+        return theano.function([index], cost, updates=updates, name='train_ensemble')
+
+    def get_train_fn(self, train_data):
+        # Like RBM.get_train_fn, the compiled function is kept and only given new data
+        if self.train_fn is None:
+            self.train_data = theano.shared(train_data.get_value(borrow=True), name='train_data', borrow=True)
+            self.train_fn = self.compile_train_fn(self.train_data)
+        else:
+            self.train_data.set_value(train_data.get_value(borrow=True), borrow=True)
+        return self.train_fn
+
+    def set_hyperparameters(self):
+        params = [rbm.train_parameters for rbm in self.rbms]
+        self.learning_rate.set_value(np.asarray([p.learning_rate for p in params], dtype=t_float_x))
+        self.momentum_rate.set_value(np.asarray([p.momentum for p in params], dtype=t_float_x))
+        self.weight_decay.set_value(np.asarray([p.weight_decay for p in params], dtype=t_float_x))
+
+    def get_batch_order(self, mini_batches):
+        if not self.shuffle:
+            return np.tile(np.arange(mini_batches), (self.k, 1))
+        return np.asarray([rbm.np_rand.permutation(mini_batches) for rbm in self.rbms])
+
+    def train(self, train_data, epochs=None):
+        '''Trains every member, returns the mean cost of every epoch (epochs x K)'''
+        epochs = self.rbms[0].train_parameters.epochs if epochs is None else epochs
+        mini_batches = train_data.get_value(borrow=True).shape[0] / self.batch_size
+        train_fn = self.get_train_fn(train_data)
+        self.set_hyperparameters()
+
+        epoch_costs = []
+        for _ in xrange(epochs):
+            start_time = time.time()
+            self.batch_order.set_value(self.get_batch_order(mini_batches))
+            costs = np.asarray([train_fn(i) for i in xrange(mini_batches)])
+            elapsed = time.time() - start_time
+
+            mean_cost = np.nanmean(costs, axis=0)
+            epoch_costs.append(mean_cost)
+            self.stats.append({'epoch': self.epoch,
+                               'members': self.k,
+                               'time': elapsed,
+                               'samples_per_sec': self.k * mini_batches * self.batch_size / elapsed,
+                               'cost': mean_cost})
+            if self.rbms[0].track_progress:
+                print '... epoch %d, costs are ' % self.epoch, mean_cost
+            self.epoch += 1
+
+        return np.asarray(epoch_costs)
+
+    def get_member(self, i):
+        '''Member i as a normal RBM, with the state the ensemble trained it to'''
+        rbm = self.rbms[i]
+        for (p, stacked) in zip(rbm.params + rbm.momentum + [rbm.persistent],
+                                self.params + self.momentum + [self.persistent]):
+            p.set_value(stacked.get_value()[i].copy(), borrow=True)
+        rbm.epoch = self.member_epochs[i] + self.epoch
+        return rbm
+
+    def members(self):
+        return [self.get_member(i) for i in xrange(self.k)]
@@ -1,22 +1,38 @@
 __author__ = 'joschlemper'
 
+import os
 import numpy as np
 import utils
 import PIL.Image as Image
 import sys
 import time
+from models.visualiser import AsyncVisualiser
+
+
+# Columns of the weight statistics, taken inside the compiled training function
+WEIGHT_STATS = ['avg', 'std', 'min', 'max', 'grad_avg', 'grad_std', 'grad_min', 'grad_max', 'update_ratio']
 
 
 class ProgressLogger(object):
+        # Defaults for loggers pickled before weight statistics were sampled and images rendered asynchronously
+        monitor_every = 1
+        weight_stats = np.zeros((0, len(WEIGHT_STATS)))
+        n_weight_stats = 0
+        async_plot = False
+        max_pending_frames = 4
+        visualiser = None
 
         def __init__(self,
                      likelihood=True,
                      monitor_weights=False,
+                     monitor_every=10,          # minibatches between weight statistics
                      time_training=True,
                      plot=True,
                      plot_info=None,
                      img_shape=(28, 28),
-                     out_dir=None
+                     out_dir=None,
+                     async_plot=False,          # render images in a background thread, written after train returns
+                     max_pending_frames=4       # images waiting to be rendered before the oldest is dropped
                      ):
 
             self.likelihood = likelihood
@@ -25,8 +41,62 @@ class ProgressLogger(object):
             self.plot_info = plot_info
             self.out_dir = out_dir
             self.monitor_weights = monitor_weights
-            self.weight_hist = {'avg': [], 'std': [], 'min': sys.maxint, 'max': -sys.maxint - 1}
+            self.monitor_every = monitor_every
+            self.weight_stats = np.zeros((0, len(WEIGHT_STATS)))
+            self.n_weight_stats = 0
+            self.swap_rates = []
             self.img_shape = img_shape
+            self.async_plot = async_plot
+            self.max_pending_frames = max_pending_frames
+            self.visualiser = None
+
+        def __getstate__(self):
+            # The rendering thread is not pickled, it is restarted on demand
+            state = self.__dict__.copy()
+            state['visualiser'] = None
+            return state
+
+        def render(self, key, render_fn, *args):
+            '''Runs render_fn(*args) in the background when plotting asynchronously, newer frames of key replace it'''
+            if not self.async_plot:
+                render_fn(*args)
+                return
+            if self.visualiser is None:
+                self.visualiser = AsyncVisualiser(self.max_pending_frames)
+            self.visualiser.submit(key, render_fn, *args)
+
+        def flush(self):
+            '''Waits for the pending images, returns the visualiser to report on or None'''
+            if self.visualiser:
+                self.visualiser.flush()
+            return self.visualiser
+
+        @property
+        def weight_hist(self):
+            stats = self.get_weight_stats()
+            return {'avg': stats[:, 0],
+                    'std': stats[:, 1],
+                    'min': np.min(stats[:, 2]) if len(stats) else sys.maxint,
+                    'max': np.max(stats[:, 3]) if len(stats) else -sys.maxint - 1}
+
+        def get_weight_stats(self, name=None):
+            """Recorded rows of weight statistics, or the column of one of WEIGHT_STATS"""
+            stats = self.weight_stats[:self.n_weight_stats]
+            return stats if name is None else stats[:, WEIGHT_STATS.index(name)]
+
+        def reserve_weight_stats(self, n):
+            """Preallocates room for n more rows so that recording does not allocate during training"""
+            if self.n_weight_stats + n > len(self.weight_stats):
+                stats = np.zeros((self.n_weight_stats + n, len(WEIGHT_STATS)))
+                stats[:self.n_weight_stats] = self.get_weight_stats()
+                self.weight_stats = stats
+
+        def record_weight_stats(self, stats):
+            stats = np.atleast_2d(stats)
+            if self.n_weight_stats + len(stats) > len(self.weight_stats):
+                self.reserve_weight_stats(max(len(stats), self.n_weight_stats))
+            self.weight_stats[self.n_weight_stats:self.n_weight_stats + len(stats)] = stats
+            self.n_weight_stats += len(stats)
 
         def visualise_weight(self, rbm, image_name):
             plotting_start = time.clock()  # Measure plotting time
@@ -34,15 +104,9 @@ class ProgressLogger(object):
             if rbm.v_n in [784, 625, 1250, 784*2, 2500, 5000] and (self.img_shape[0] * self.img_shape[1] == rbm.v_n):
                 tile_shape = (rbm.h_n / 10 + 1, 10)
 
-                image = Image.fromarray(
-                    utils.tile_raster_images(
-                        X=rbm.W.get_value(borrow=True).T,
-                        img_shape=self.img_shape,
-                        tile_shape=tile_shape,
-                        tile_spacing=(1, 1)
-                    )
-                )
-                image.save(image_name)
+                # Snapshot of the weights, training carries on updating them in place
+                self.render('weight', save_tiles, rbm.get_weights().T, self.img_shape, tile_shape,
+                            os.path.abspath(image_name))
 
             plotting_end = time.clock()
             return plotting_end - plotting_start
@@ -53,17 +117,25 @@ class ProgressLogger(object):
             else:
                 img_shape = self.img_shape
 
-            if multi:
-                visualise_reconstructions_animate(orig, reconstructions, img_shape, plot_n, img_name)
-            else:
-                visualise_reconstructions(orig, reconstructions, img_shape, plot_n, img_name)
+            render_fn = visualise_reconstructions_animate if multi else visualise_reconstructions
+            self.render(img_name, render_fn, orig, reconstructions, img_shape, plot_n, os.path.abspath(img_name))
 
         def monitor_wt(self, rbm):
-            # print rbm.W.get_value(borrow=True)[0][0:5]
-            self.weight_hist['avg'].append(np.mean(rbm.W.get_value(borrow=True)))
-            self.weight_hist['std'].append(np.std(rbm.W.get_value(borrow=True)))
-            self.weight_hist['min'] = min(np.min(rbm.W.get_value(borrow=True)), self.weight_hist['min'])
-            self.weight_hist['max'] = max(np.max(rbm.W.get_value(borrow=True)), self.weight_hist['max'])
+            # Host side statistics for backends whose training function does not return them,
+            # the gradient is not available here
+            w = rbm.get_weights(borrow=True)
+            stats = np.empty(len(WEIGHT_STATS))
+            stats.fill(np.nan)
+            stats[:4] = [np.mean(w), np.std(w), np.min(w), np.max(w)]
+            self.record_weight_stats(stats)
+
+        def monitor_swap_rates(self, rbm):
+            # Parallel tempering: acceptance rate of the swaps between neighbouring temperatures
+            rates = rbm.get_swap_rates()
+            if not hasattr(self, 'swap_rates'):
+                self.swap_rates = []
+            self.swap_rates.append(rates)
+            print '... swap acceptance rates', np.round(rates, 3)
 
 
 class AssociationProgressLogger(ProgressLogger):
@@ -72,29 +144,35 @@ class AssociationProgressLogger(ProgressLogger):
             if rbm.v_n in [784, 625, 2500, 5000]:
                 plotting_start = time.clock()  # Measure plotting time
 
-                w = rbm.W.get_value(borrow=True).T
+                w = rbm.get_weights(borrow=True).T
                 u = rbm.U.get_value(borrow=True).T
 
                 weight = np.hstack((w, u))
 
                 tile_shape = (rbm.h_n / 10 + 1, 10)
 
-                image = Image.fromarray(
-                    utils.tile_raster_images(
-                        X=weight,
-                        img_shape=(self.img_shape[0] *2, self.img_shape[1]),
-                        tile_shape=tile_shape,
-                        tile_spacing=(1, 1)
-                    )
-                )
-                image.save(image_name)
+                self.render('weight', save_tiles, weight, (self.img_shape[0] * 2, self.img_shape[1]), tile_shape,
+                            os.path.abspath(image_name))
 
                 plotting_end = time.clock()
                 return plotting_end - plotting_start
             return 0
 
     def visualise_reconstructions(self, orig, reconstructions, plot_n=None, img_name='association'):
-        visualise_reconstructions(orig, reconstructions, self.img_shape, plot_n, img_name)
+        self.render(img_name, visualise_reconstructions, orig, reconstructions, self.img_shape, plot_n,
+                    os.path.abspath(img_name))
+
+
+def save_tiles(x, img_shape, tile_shape, image_name):
+    image = Image.fromarray(
+        utils.tile_raster_images(
+            X=x,
+            img_shape=img_shape,
+            tile_shape=tile_shape,
+            tile_spacing=(1, 1)
+        )
+    )
+    image.save(image_name)
 
 
 def visualise_reconstructions(orig, reconstructions, img_shape, plot_n=None, img_name='reconstruction'):
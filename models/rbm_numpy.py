@@ -0,0 +1,429 @@
+import numpy as np
+
+import utils
+from models.rbm_units import *
+from models.rbm_config import NESTEROV, PERSISTENT, PARALLEL_TEMPERING, FAST_PERSISTENT, FIXED_POINT, DAMPED, ANDERSON, \
+    DAMPED_MAX_STEP
+from models.profiler import POSITIVE, NEGATIVE, UPDATE, MONITOR, measure
+
+t_float_x = theano.config.floatX
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def softplus(x):
+    return np.logaddexp(0, x)
+
+
+class NumpyBackend(object):
+    '''
+    Runs an RBM directly on numpy arrays, without building or compiling theano graphs.
+    The parameters are the values of the RBM's shared variables, so both backends
+    train, save and load the same model.
+
+    Updates follow RBM.get_cost_updates: the gradients are those of
+    mean(F(x)) - mean(F(chain_end)) written in closed form.
+    '''
+
+    def __init__(self, rbm):
+        self.rbm = rbm
+        self.lookahead = None  # parameters at the Nesterov look-ahead point, during an update
+        self.dropout_mask = None  # set during an update only
+
+    def check_supported(self):
+        # The backend takes the first parameter for the dense W
+        if self.rbm.w_rank:
+            raise Exception('Low-rank weights are not supported by the numpy backend')
+
+    @property
+    def params(self):
+        if self.lookahead is not None:
+            return self.lookahead
+        self.check_supported()
+        return [p.get_value(borrow=True) for p in self.rbm.params]
+
+    def free_energy(self, v, v2=None):
+        rbm = self.rbm
+        params = self.params
+        w, v_bias, h_bias = params[:3]
+        t0 = rbm.v_unit.np_energy(v, v_bias)
+        t1 = np.dot(v, w) + h_bias
+        if v2 is not None:
+            t0 += rbm.v_unit2.np_energy(v2, params[4])
+            t1 += np.dot(v2, params[3])
+        t2 = - np.sum(softplus(t1))
+        return t0 + t2
+
+    def prop_up(self, v, v2=None):
+        """Propagates v to the hidden layer. """
+        params = self.params
+        h_total_input = np.dot(v, params[0]) + params[2]
+        if v2 is not None:  # Associative
+            h_total_input += np.dot(v2, params[3])
+
+        h_p_activation = self.rbm.h_unit.np_scale(h_total_input)
+        if self.dropout_mask is not None:
+            h_p_activation *= self.dropout_mask
+
+        return [h_total_input, h_p_activation]
+
+    def prop_down(self, h):
+        params = self.params
+        v_total_input = np.dot(h, params[0].T) + params[1]
+        return [v_total_input, self.rbm.v_unit.np_scale(v_total_input)]
+
+    def prop_down_assoc(self, h):
+        params = self.params
+        v_total_input = np.dot(h, params[3].T) + params[4]
+        return [v_total_input, self.rbm.v_unit2.np_scale(v_total_input)]
+
+    def sample_h_given_v(self, v, v2=None):
+        h_total_input, h_p_activation = self.prop_up(v, v2)
+        h_sample = self.rbm.h_unit.np_activate(h_p_activation)
+        return [h_total_input, h_p_activation, h_sample]
+
+    def sample_v_given_h(self, h_sample):
+        v_total_input, v_p_activation = self.prop_down(h_sample)
+        v_sample = self.rbm.v_unit.np_activate(v_p_activation)
+        return [v_total_input, v_p_activation, v_sample]
+
+    def sample_v_given_h_assoc(self, h_sample):
+        v2_total_input, v2_p_activation = self.prop_down_assoc(h_sample)
+        v2_sample = self.rbm.v_unit2.np_activate(v2_p_activation)
+        return self.sample_v_given_h(h_sample) + [v2_total_input, v2_p_activation, v2_sample]
+
+    def gibbs_vhv(self, v):
+        h_total_input, h_p_activation, h_sample = self.sample_h_given_v(v)
+        v_total_input, v_p_activation, v_sample = self.sample_v_given_h(h_sample)
+        return [h_total_input, h_p_activation, h_sample,
+                v_total_input, v_p_activation, v_sample]
+
+    def gibbs_hvh(self, h):
+        v_total_input, v_p_activation, v_sample = self.sample_v_given_h(h)
+        h_total_input, h_p_activation, h_sample = self.sample_h_given_v(v_sample)
+        return [v_total_input, v_p_activation, v_sample,
+                h_total_input, h_p_activation, h_sample]
+
+    def gibbs_hvh_assoc(self, h):
+        v_res = self.sample_v_given_h_assoc(h)
+        h_res = self.sample_h_given_v(v_res[2], v_res[5])
+        return v_res + h_res
+
+    def negative_statistics(self, x, y=None):
+        """
+        CD-k, PCD-k or FPCD-k chain.
+        :return: chain end (v, v2) and visible total inputs (v, v2) of every step
+        """
+        rbm = self.rbm
+        if rbm.cd_type == PARALLEL_TEMPERING:
+            raise Exception('Parallel tempering is only implemented for the theano backend')
+
+        batch_mask = self.dropout_mask
+        lookahead = self.lookahead
+        if rbm.cd_type == FAST_PERSISTENT:
+            # The chains sample with parameters + fast parameters
+            self.lookahead = [p + f.get_value(borrow=True) for (p, f) in zip(self.params, rbm.fast_params)]
+        if rbm.cd_type in [PERSISTENT, FAST_PERSISTENT]:
+            h_sample = rbm.persistent.get_value(borrow=True)
+            if batch_mask is not None and rbm.n_chains != batch_mask.shape[0]:
+                # The chains have their own number of rows
+                self.dropout_mask = rbm.np_rand.binomial(n=1, p=rbm.dropout_rate,
+                                                         size=(rbm.n_chains, rbm.h_n)).astype(t_float_x)
+        else:
+            h_sample = self.sample_h_given_v(x, y)[2]
+
+        v_inputs, v2_inputs = [], []
+        v2_sample = None
+        for i in xrange(rbm.cd_steps):
+            if y is None:
+                v_input, _, v_sample, _, _, h_sample = self.gibbs_hvh(h_sample)
+            else:
+                v_input, _, v_sample, v2_input, _, v2_sample, _, _, h_sample = self.gibbs_hvh_assoc(h_sample)
+                v2_inputs.append(v2_input)
+            v_inputs.append(v_input)
+
+        self.dropout_mask = batch_mask
+        self.lookahead = lookahead
+        if rbm.cd_type in [PERSISTENT, FAST_PERSISTENT]:
+            rbm.persistent.set_value(h_sample.astype(t_float_x), borrow=True)
+
+        return v_sample, v2_sample, v_inputs, v2_inputs
+
+    def get_gradients(self, x, v_sample, y=None, v2_sample=None):
+        """
+        Gradients of mean(F(x, y)) - mean(F(v_sample, v2_sample)) w.r.t. RBM.params,
+        the negative phase weighted as in RBM.get_partial_derivatives
+        """
+        positive = self.get_statistics(x, y)
+        negative = self.get_statistics(v_sample, v2_sample, self.rbm.get_chain_scale())
+        return [pos - neg for (pos, neg) in zip(positive, negative)]
+
+    def get_statistics(self, v, v2=None, scale=1):
+        """
+        Derivatives of mean(F(v, v2)) w.r.t. RBM.params, the statistics of one phase,
+        with the energies summed over the batch scaled by scale (see RBM.calc_free_energy)
+        """
+        rbm = self.rbm
+        params = self.params
+        h = sigmoid(self.prop_up_input(v, v2)) * scale
+
+        stats = [- np.dot(v.T, h),
+                 self.visible_scale(rbm.v_unit, v, params[1], scale) * rbm.v_unit.np_energy_gradient(v, params[1]),
+                 - np.sum(h, axis=0)]
+
+        if v2 is not None:
+            stats += [- np.dot(v2.T, h),
+                      self.visible_scale(rbm.v_unit2, v2, params[4], scale) *
+                      rbm.v_unit2.np_energy_gradient(v2, params[4])]
+        return stats
+
+    @staticmethod
+    def visible_scale(v_unit, v, v_bias, scale):
+        """Only energies summed over the batch are scaled, see RBM.calc_free_energy"""
+        if scale != 1 and np.ndim(v_unit.np_energy(v[:1], v_bias)) == 0:
+            return scale
+        return 1
+
+    def prop_up_input(self, v, v2=None):
+        params = self.params
+        h_total_input = np.dot(v, params[0]) + params[2]
+        if v2 is not None:
+            h_total_input += np.dot(v2, params[3])
+        return h_total_input
+
+    def get_sparsity_penalties(self, x, y, lr):
+        """Mirrors the sparsity constraint of RBM.get_sparsity_penalties"""
+        rbm = self.rbm
+        param = rbm.train_parameters
+        decay = param.sparsity_decay
+        target = param.sparsity_target
+
+        h_total_input = self.prop_up_input(x, y)
+        p = rbm.h_unit.np_active_probability(h_total_input)
+        if self.dropout_mask is not None:
+            p *= self.dropout_mask
+        q = decay * rbm.active_probability_h.get_value(borrow=True) + (1 - decay) * np.mean(p, axis=0)
+        rbm.active_probability_h.set_value(q.astype(t_float_x))
+
+        if isinstance(rbm.h_unit, BinaryUnit):
+            d_sparsity = q - target
+        else:
+            d_sparsity = (q - target) / (q * (1 - q))
+
+        # dq / d(total input), the active probability is a sigmoid
+        p = rbm.h_unit.np_active_probability(h_total_input)
+        dq = (1 - decay) * p * (1 - p) / x.shape[0]
+        if self.dropout_mask is not None:
+            dq *= self.dropout_mask
+
+        scale = lr * param.sparsity_cost * d_sparsity
+        penalties = [(0, scale * np.dot(x.T, dq)),
+                     (2, scale * np.sum(dq, axis=0))]
+        if y is not None:
+            penalties.append((3, scale * np.dot(y.T, dq)))
+        return penalties
+
+    def get_reconstruction_cost(self, x, v_total_inputs):
+        """Same reduction as RBM.get_reconstruction_cost on the stacked chain inputs"""
+        p = self.rbm.v_unit.np_scale(np.array(v_total_inputs))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cross_entropy = - np.sum(x * np.log(p) + (1 - x) * np.log(1 - p), axis=1)
+        return np.mean(cross_entropy)
+
+    def get_pseudo_likelihood(self, x):
+        # The bit flipped is the RBM's, so both backends checkpoint and resume the same index
+        bit_i_idx = self.rbm.bit_i_idx.get_value()
+        xi = np.round(x)
+        fe_xi = self.free_energy(xi)
+        xi_flip = xi.copy()
+        xi_flip[:, bit_i_idx] = 1 - xi_flip[:, bit_i_idx]
+        fe_xi_flip = self.free_energy(xi_flip)
+        cost = np.mean(self.rbm.v_n * np.log(sigmoid(fe_xi_flip - fe_xi)))
+        self.rbm.bit_i_idx.set_value((bit_i_idx + 1) % self.rbm.v_n)
+        return cost
+
+    def train_step(self, x, y, velocities):
+        """One minibatch update, returns the monitoring cost"""
+        rbm = self.rbm
+        param = rbm.train_parameters
+        lr = param.learning_rate
+        m = param.momentum
+        weight_decay = param.weight_decay
+
+        params = self.params
+        if param.momentum_type == NESTEROV:
+            # Gradient at the look-ahead point, parameters are only written once
+            self.lookahead = [p + m * d for (p, d) in zip(params, velocities)]
+        if rbm.dropout:
+            self.dropout_mask = rbm.np_rand.binomial(n=1, p=rbm.dropout_rate,
+                                                     size=(x.shape[0], rbm.h_n)).astype(t_float_x)
+
+        try:
+            with measure(rbm.profiler, NEGATIVE):
+                v_sample, v2_sample, v_inputs, v2_inputs = self.negative_statistics(x, y)
+                negative = self.get_statistics(v_sample, v2_sample, rbm.get_chain_scale())
+            with measure(rbm.profiler, POSITIVE):
+                positive = self.get_statistics(x, y)
+                penalties = self.get_sparsity_penalties(x, y, lr) if param.sparsity_constraint else []
+
+            with measure(rbm.profiler, MONITOR):
+                if rbm.cd_type in [PERSISTENT, FAST_PERSISTENT]:
+                    cost = self.get_pseudo_likelihood(x)
+                else:
+                    cost = self.get_reconstruction_cost(x, v_inputs)
+                    if y is not None:
+                        cost += self.get_reconstruction_cost(y, v2_inputs)
+        finally:
+            self.lookahead = None
+            self.dropout_mask = None
+
+        with measure(rbm.profiler, UPDATE):
+            gradients = [pos - neg for (pos, neg) in zip(positive, negative)]
+            # new_dx = m * old_dx - lr * grad_x, x = x + new_dx - lr * weight_decay * x
+            for (p, d, g) in zip(params, velocities, gradients):
+                d *= m
+                d -= lr * g
+                p *= (1 - lr * weight_decay)
+                p += d
+
+            for (i, penalty) in penalties:
+                params[i] -= penalty
+
+            if rbm.cd_type == FAST_PERSISTENT:
+                for (f, g) in zip(rbm.fast_params, gradients):
+                    f.set_value(param.fast_decay * f.get_value(borrow=True) - param.fast_learning_rate * g,
+                                borrow=True)
+
+            for (p, value) in zip(rbm.params, params):
+                p.set_value(value, borrow=True)
+
+        return cost
+
+    def get_train_fn(self, train_data, assoc_data=None):
+        self.check_supported()
+        rbm = self.rbm
+        batch_size = rbm.train_parameters.batch_size
+        data = train_data.get_value(borrow=True)
+        assoc = assoc_data.get_value(borrow=True) if rbm.associative else None
+
+        # Momentum carries over from the last call to train, like the compiled function's
+        velocities = [np.array(d.get_value(borrow=True)) for d in rbm.momentum]
+
+        def train_fn(index):
+            x = data[index * batch_size: (index + 1) * batch_size]
+            y = assoc[index * batch_size: (index + 1) * batch_size] if assoc is not None else None
+            cost = self.train_step(x, y, velocities)
+            for (d, value) in zip(rbm.momentum, velocities):
+                d.set_value(value, borrow=True)
+            return cost
+
+        return train_fn
+
+    def reconstruct(self, data, k=1, plot_n=None, plot_every=1, img_name='reconstruction'):
+        if utils.isSharedType(data):
+            orig = data.get_value(borrow=True)
+        else:
+            orig = data
+
+        if not self.rbm.track_progress:
+            return self.sample_reconstruction(orig, k, plot_every)
+
+        chain_state = np.asarray(orig, dtype=t_float_x)
+        reconstructions = []
+        for i in xrange(k / plot_every):
+            for j in xrange(plot_every):
+                _, _, _, _, v_p_activation, chain_state = self.gibbs_vhv(chain_state)
+            reconstructions.append(v_p_activation)
+
+        self.rbm.track_progress.visualise_reconstructions(orig, reconstructions, plot_n, img_name=img_name,
+                                                          multi=True)
+
+        return reconstructions[-1]
+
+    def sample_reconstruction(self, orig, k, plot_every=1):
+        """Last reconstruction of cd-k without keeping the intermediate ones"""
+        chain_state = np.asarray(orig, dtype=t_float_x)
+        v_p_activation = None
+        for i in xrange(k / plot_every * plot_every):
+            _, _, _, _, v_p_activation, chain_state = self.gibbs_vhv(chain_state)
+        return v_p_activation
+
+    def mean_field_inference_opt(self, x, y=None, sample=False, k=100, img_name='mean_field_inference',
+                                 initial_input_multiplier=1, tolerance=0., return_iterations=False,
+                                 solver=FIXED_POINT):
+        """Mean field inference of the second half of the visible units with x clamped to the first half"""
+        rbm = self.rbm
+        if utils.isSharedType(x):
+            x = x.get_value(borrow=True)
+        if utils.isSharedType(y):
+            y = y.get_value(borrow=True)
+        if y is None:
+            y = np.zeros((x.shape[0], rbm.v_n - x.shape[1]), dtype=t_float_x)
+
+        plot_n = 100
+        plot_every = k if k <= 10 else 10
+        xlen = x.shape[1]
+
+        tau = rbm.h_unit.np_scale(self.prop_up_input(np.concatenate([x * initial_input_multiplier, y], axis=1)))
+
+        converged = np.zeros(x.shape[0], dtype=bool)
+        iterations = np.zeros(x.shape[0], dtype='int32')
+        if solver not in [FIXED_POINT, DAMPED, ANDERSON]:
+            raise Exception('Unknown mean field solver {}'.format(solver))
+
+        # Solver state, see RBM.mean_field_inference_opt
+        step_size = np.ones(x.shape[0], dtype=t_float_x)
+        # Anderson starts from 0 so that its first step is a plain one
+        residual_prev = np.full(x.shape[0], 0. if solver == ANDERSON else np.inf, dtype=t_float_x)
+        g_prev = np.zeros_like(tau)
+        f_prev = np.zeros_like(tau)
+
+        reconstructions = []
+        for i in xrange(k / plot_every):
+            for j in xrange(plot_every):
+                _, mu = self.prop_down(tau)
+                mu = np.concatenate([x, mu[:, xlen:]], axis=1)
+                g = rbm.h_unit.np_scale(self.prop_up_input(mu))
+                f = g - tau
+                residual = np.max(np.abs(f), axis=1)
+
+                active = ~converged
+                if solver == DAMPED:
+                    rate = np.minimum(1 - (1 - residual / residual_prev) / step_size, 1.)
+                    step = np.clip(2 / (2 - rate), 1., DAMPED_MAX_STEP)
+                    step_size[active] = np.where(residual < residual_prev, step, 1.)[active]
+                    residual_prev[active] = residual[active]
+                    tau2 = tau + step_size[:, np.newaxis] * f
+                elif solver == ANDERSON:
+                    df = f - f_prev
+                    gamma = np.sum(f * df, axis=1) / np.maximum(np.sum(df ** 2, axis=1), 1e-12)
+                    gamma[~(residual < residual_prev)] = 0
+                    tau2 = g - gamma[:, np.newaxis] * (g - g_prev)
+                    g_prev[active] = g[active]
+                    f_prev[active] = f[active]
+                    residual_prev[active] = residual[active]
+                else:
+                    tau2 = g
+
+                # Converged rows keep their state
+                tau2[converged] = tau[converged]
+                iterations += active
+                converged |= residual < tolerance
+                tau = tau2
+                if np.all(converged):
+                    break
+            reconstructions.append(mu[:, xlen:])
+            if np.all(converged):
+                break
+
+        if rbm.track_progress:
+            rbm.track_progress.visualise_reconstructions(x, reconstructions, plot_n, img_name=img_name, opt=True)
+
+        if sample and type(rbm.v_unit) is RBMUnit:
+            result = rbm.np_rand.binomial(n=1, p=reconstructions[-1])
+        else:
+            result = reconstructions[-1]
+
+        return (result, iterations) if return_iterations else result
@@ -0,0 +1,136 @@
+import ctypes
+import multiprocessing as mp
+import time
+
+import numpy as np
+import theano
+
+HOGWILD = 'hogwild'
+AVERAGE = 'average'
+
+t_float_x = theano.config.floatX
+
+
+class ParallelTrainer(object):
+    '''
+    Data parallel training of an RBM on several processes.
+
+    The minibatches of each epoch are split across worker processes, which run the numpy backend
+    (theano functions are not shared across forked processes). The parameters of the RBM
+    (W, v_bias, h_bias, U, v_bias2) are moved to shared memory, and the RBM's shared variables keep
+    pointing at it, so the trained model is the original RBM object.
+
+    mode:
+        HOGWILD - every worker updates the shared parameters in place, without locking
+        AVERAGE - workers train private copies and add their average change to the shared parameters
+                  every sync_every minibatches
+
+    Persistent chains and sparsity estimates are kept per worker.
+    '''
+
+    def __init__(self, rbm, n_workers=mp.cpu_count(), mode=HOGWILD, sync_every=10):
+        assert mode in [HOGWILD, AVERAGE]
+        # Raised here, a worker that fails leaves train waiting for its costs
+        rbm.numpy_backend.check_supported()
+        self.rbm = rbm
+        self.n_workers = n_workers
+        self.mode = mode
+        self.sync_every = sync_every
+        self.lock = mp.Lock()
+        self.stats = []
+        self.shared_params = self.move_to_shared_memory()
+
+    def __str__(self):
+        return 'parallel_{}{}_{}'.format(self.mode, self.n_workers, self.rbm)
+
+    def move_to_shared_memory(self):
+        c_type = ctypes.c_float if t_float_x == 'float32' else ctypes.c_double
+        shared_params = []
+        for p in self.rbm.params:
+            value = p.get_value(borrow=True)
+            raw = mp.RawArray(c_type, value.size)
+            array = np.frombuffer(raw, dtype=t_float_x).reshape(value.shape)
+            array[:] = value
+            p.set_value(array, borrow=True)
+            shared_params.append(array)
+        return shared_params
+
+    def split_batches(self, mini_batches, epoch):
+        order = np.random.RandomState(epoch).permutation(mini_batches)
+        return np.array_split(order, self.n_workers)
+
+    def train(self, train_data, train_label=None):
+        """Trains the RBM, returns the mean cost of every epoch"""
+        rbm = self.rbm
+        param = rbm.train_parameters
+        mini_batches = train_data.get_value(borrow=True).shape[0] / param.batch_size
+
+        epoch_costs = []
+        for epoch in xrange(param.epochs):
+            start_time = time.time()
+            queue = mp.Queue()
+            workers = [mp.Process(target=self.run_worker,
+                                  args=(worker_id, batches, epoch, train_data, train_label, queue))
+                       for (worker_id, batches) in enumerate(self.split_batches(mini_batches, epoch))]
+            for w in workers:
+                w.start()
+            costs = []
+            for _ in workers:
+                costs += queue.get()
+            for w in workers:
+                w.join()
+            elapsed = time.time() - start_time
+
+            mean_cost = np.mean(costs)
+            epoch_costs.append(mean_cost)
+            self.stats.append({'epoch': epoch,
+                               'workers': self.n_workers,
+                               'time': elapsed,
+                               'samples_per_sec': mini_batches * param.batch_size / elapsed,
+                               'cost': mean_cost})
+
+            if rbm.track_progress:
+                print '... epoch %d, cost is ' % epoch, mean_cost
+                print '... %d workers, %.1f samples/sec' % (self.n_workers, self.stats[-1]['samples_per_sec'])
+
+        return epoch_costs
+
+    def run_worker(self, worker_id, batches, epoch, train_data, train_label, queue):
+        rbm = self.rbm
+        backend = rbm.numpy_backend
+
+        # Separate random streams for every worker
+        seed = 123 + 1000 * epoch + worker_id
+        rbm.np_rand = np.random.RandomState(seed)
+        units = [rbm.v_unit, rbm.h_unit] + ([rbm.v_unit2] if rbm.associative else [])
+        for i, unit in enumerate(units):
+            unit.np_rand = np.random.RandomState(seed + 100 * (i + 1))
+
+        if self.mode == AVERAGE:
+            synced = [np.array(p) for p in self.shared_params]
+            for (p, value) in zip(rbm.params, synced):
+                p.set_value(value.copy(), borrow=True)
+
+        train_fn = backend.get_train_fn(train_data, train_label)
+        costs = []
+        for n, batch_index in enumerate(batches):
+            cost = train_fn(batch_index)
+            if not np.isnan(cost):
+                costs.append(cost)
+
+            if self.mode == AVERAGE and ((n + 1) % self.sync_every == 0 or n == len(batches) - 1):
+                synced = self.sync(synced)
+
+        queue.put(costs)
+
+    def sync(self, synced):
+        """Adds the averaged change of the private parameters to the shared ones, returns the new shared values"""
+        rbm = self.rbm
+        with self.lock:
+            for (shared, p, start) in zip(self.shared_params, rbm.params, synced):
+                shared += (p.get_value(borrow=True) - start) / self.n_workers
+            synced = [np.array(shared) for shared in self.shared_params]
+
+        for (p, value) in zip(rbm.params, synced):
+            p.set_value(value.copy(), borrow=True)
+        return synced
@@ -25,6 +25,50 @@ class RBMUnit(object):
     def energy(self, v, v_bias):
         return - T.dot(v, v_bias)
 
+    # Sampling at inverse temperature beta (parallel tempering), i.e. from exp(-beta * energy)
+    def tempered_scale(self, x, beta):
+        return self.scale(beta * x)
+
+    def tempered_activate(self, p_activate, beta):
+        return self.activate(p_activate)
+
+    def sample_energy(self, v, v_bias):
+        # energy of each row of v
+        return - T.dot(v, v_bias)
+
+    def energy_gradient(self, v, v_bias):
+        # d/dv_bias of mean(energy) over the rows of v
+        return - T.mean(v, axis=0)
+
+    def scale_gradient(self, x):
+        # d sum(scale(x)) / dx, the sigmoid's derivative
+        p = self.scale(x)
+        return p * (1 - p)
+
+    # Probability that the unit is active, the activity the sparsity constraint drives to its target
+    def active_probability(self, x):
+        return self.scale(x)
+
+    def active_probability_gradient(self, x):
+        return self.scale_gradient(x)
+
+    # NumPy counterparts of scale and activate, used by the numpy backend
+    def np_scale(self, x):
+        return 1. / (1. + np.exp(-x))
+
+    def np_activate(self, p_activate):
+        return self.np_rand.binomial(n=1, p=p_activate).astype(theano.config.floatX)
+
+    def np_energy(self, v, v_bias):
+        return - np.dot(v, v_bias)
+
+    def np_energy_gradient(self, v, v_bias):
+        # d/dv_bias of mean(energy) over the rows of v
+        return - np.mean(v, axis=0)
+
+    def np_active_probability(self, x):
+        return self.np_scale(x)
+
     def __str__(self):
         return 'SB'
 
@@ -37,6 +81,9 @@ class BinaryUnit(RBMUnit):
         p_activate = log_sig(x)
         return p_activate
 
+    def np_activate(self, x):
+        return self.np_scale(x)
+
     def __str__(self):
         return 'B'
 
@@ -58,10 +105,69 @@ class GaussianVisibleUnit(RBMUnit):
         # return (x - T.mean(x, axis=0)) / T.std(x, axis=0)  # normalise
         return x
 
+    def tempered_scale(self, x, beta):
+        # the mean does not depend on the temperature, the variance is 1 / beta
+        return x
+
+    def tempered_activate(self, x, beta):
+        return x + self.rand.normal(size=x.shape, avg=0., std=1., dtype=theano.config.floatX) / T.sqrt(beta)
+
+    def sample_energy(self, v, v_bias):
+        return 0.5 * T.sum((v - v_bias) ** 2, axis=1)
+
+    def energy_gradient(self, v, v_bias):
+        return - T.sum(v - v_bias, axis=0)
+
+    def scale_gradient(self, x):
+        return T.ones_like(x)
+
+    def np_scale(self, x):
+        return x
+
+    def np_activate(self, x):
+        return (x + self.np_rand.normal(0., 1., size=x.shape)).astype(theano.config.floatX)
+
+    def np_energy(self, v, v_bias):
+        return 0.5 * np.sum((v - v_bias) ** 2)
+
+    def np_energy_gradient(self, v, v_bias):
+        return - np.sum(v - v_bias, axis=0)
+
     def __str__(self):
         return 'G'
 
 
+class SoftmaxUnit(RBMUnit):
+    '''
+    Softmax (one-of-K) unit, a whole layer is one K-way variable, e.g. a class label
+    - energy is that of binary units restricted to one-hot states
+    - p(v | h) is the softmax of the total input, sampling draws exactly one active unit per row
+    '''
+
+    def scale(self, x):
+        return T.nnet.softmax(x)
+
+    def scale_gradient(self, x):
+        # the probabilities of a row always sum to 1
+        return T.zeros_like(x)
+
+    def activate(self, p_activate):
+        return self.rand.multinomial(pvals=p_activate, dtype=theano.config.floatX)
+
+    def np_scale(self, x):
+        e_x = np.exp(x - np.max(x, axis=1, keepdims=True))
+        return e_x / np.sum(e_x, axis=1, keepdims=True)
+
+    def np_activate(self, p_activate):
+        # one uniform draw per row against the cumulative probabilities
+        u = self.np_rand.uniform(size=(p_activate.shape[0], 1))
+        c = np.minimum(np.sum(np.cumsum(p_activate, axis=1) < u, axis=1), p_activate.shape[1] - 1)
+        return np.eye(p_activate.shape[1], dtype=theano.config.floatX)[c]
+
+    def __str__(self):
+        return 'SM'
+
+
 class ReLUnit(RBMUnit):
     '''
     Rectifier Linear Unit
@@ -75,9 +181,30 @@ class ReLUnit(RBMUnit):
     def scale(self, x):
         return x
 
+    def scale_gradient(self, x):
+        return T.ones_like(x)
+
+    # The scaled output is the total input, not a probability. P(h > 0) is approximated by the sigmoid of the
+    # total input, as for the binary units the rectifier stands for
+    def active_probability(self, x):
+        return log_sig(x)
+
+    def active_probability_gradient(self, x):
+        p = log_sig(x)
+        return p * (1 - p)
+
     def activate(self, x):
         return T.maximum(0, x)
 
+    def np_scale(self, x):
+        return x
+
+    def np_active_probability(self, x):
+        return 1. / (1. + np.exp(-x))
+
+    def np_activate(self, x):
+        return np.maximum(0, x)
+
     def __str__(self):
         return 'R'
 
@@ -92,5 +219,8 @@ class NReLUnit(ReLUnit):
         return T.maximum(0, x + self.rand.normal(size=x.shape, avg=0., std=1., dtype=theano.config.floatX))
         # T.std(x, axis=0)
 
+    def np_activate(self, x):
+        return np.maximum(0, x + self.np_rand.normal(0., 1., size=x.shape)).astype(theano.config.floatX)
+
     def __str__(self):
         return 'NR'
\ No newline at end of file
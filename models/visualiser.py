@@ -0,0 +1,114 @@
+import atexit
+import collections
+import threading
+import time
+
+
+# Visualisers not closed yet, their pending images are still written when the interpreter exits
+_open = set()
+
+
+@atexit.register
+def _close_open():
+    for visualiser in list(_open):
+        visualiser.close()
+
+
+class AsyncVisualiser(object):
+    '''
+    Renders progress images (tiling and PNG encoding) in a background thread, off the training thread.
+
+    Frames are submitted as a render function with its arguments, under a key naming what they show.
+    At most max_pending frames wait to be rendered: a new frame replaces a pending one with the same key
+    (coalesced), and when the queue is full the oldest pending frame is dropped.
+    The time spent rendering in the background is the time saved on the training thread, less the time
+    submit took there.
+    '''
+
+    def __init__(self, max_pending=4):
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.busy = False
+        self.closed = False
+
+        self.submitted = 0
+        self.rendered = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self.render_time = 0.
+        self.submit_time = 0.
+
+        self.thread = threading.Thread(target=self.run, name='visualiser')
+        self.thread.daemon = True
+        self.thread.start()
+        _open.add(self)
+
+    def submit(self, key, render_fn, *args):
+        start_time = time.time()
+        with self.condition:
+            self.submitted += 1
+            if key in self.pending:
+                del self.pending[key]
+                self.coalesced += 1
+            elif len(self.pending) >= self.max_pending:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            self.pending[key] = (render_fn, args)
+            self.condition.notify_all()
+        self.submit_time += time.time() - start_time
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                _, (render_fn, args) = self.pending.popitem(last=False)
+                self.busy = True
+
+            start_time = time.time()
+            try:
+                render_fn(*args)
+                self.rendered += 1
+            except Exception as e:
+                self.failed += 1
+                print '... failed to render a progress image: {}'.format(e)
+            self.render_time += time.time() - start_time
+
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def flush(self):
+        '''Waits until every pending frame has been rendered'''
+        with self.condition:
+            while self.pending or self.busy:
+                self.condition.wait()
+
+    def close(self):
+        '''Renders what is pending and stops the thread'''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.thread.is_alive():
+            self.thread.join()
+        _open.discard(self)
+
+    def saved_time(self):
+        return self.render_time - self.submit_time
+
+    def stats(self):
+        return {'submitted': self.submitted,
+                'rendered': self.rendered,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'render_time': self.render_time,
+                'saved_time': self.saved_time()}
+
+    def __str__(self):
+        return 'rendered: {}, coalesced: {}, dropped: {}, saved {:.2f}s of training time'.format(
+            self.rendered, self.coalesced, self.dropped, self.saved_time())
@@ -3,6 +3,12 @@ __author__ = 'joschlemper'
 import unittest
 
 import numpy as np
+import theano
+
+from models.DBN import DBN, DBNConfig
+from models.rbm import RBM
+from models.rbm_config import RBMConfig
+from models import profiler
 
 
 class MyTestCase(unittest.TestCase):
@@ -33,6 +39,41 @@ class MyTestCase(unittest.TestCase):
         self.assertTrue(r1.shape[1] == 5)
         self.assertTrue(r2.shape[1] == 4)
         self.assertTrue(r3.shape[1] == 5)
+    def test_fine_tune(self):
+        # Fine tuning unpacks the negative statistics of the top layer
+        data = theano.shared(np.random.RandomState(1).binomial(n=1, p=0.5, size=(20, 6)).astype(theano.config.floatX))
+        dbn = DBN(DBNConfig(topology=[6, 4, 3]))
+        w = dbn.rbm_layers[-1].W.get_value().copy()
+        dbn.fine_tune(data, epochs=1)
+        self.assertTrue(dbn.untied)
+        self.assertFalse(np.allclose(w, dbn.rbm_layers[-1].W.get_value()))
+
+    def test_pass_cache(self):
+        x = np.random.RandomState(2).binomial(n=1, p=0.5, size=(5, 6)).astype(theano.config.floatX)
+        dbn = DBN(DBNConfig(topology=[6, 4, 3]))
+        dbn.bottom_up_pass(x)
+        dbn.bottom_up_pass(x)
+        self.assertEqual((dbn.pass_fn_cache.hits, dbn.pass_fn_cache.misses), (1, 1))
+
+        # A replaced layer gets a pass of its own, bound to its parameters
+        layer = dbn.rbm_layers[0]
+        dbn.rbm_layers[0] = RBM(RBMConfig(v_n=6, h_n=4))
+        del layer
+        dbn.bottom_up_pass(x)
+        self.assertEqual(dbn.pass_fn_cache.misses, 2)
+        self.assertEqual(dbn.get_pass_key('bottom_up', dbn.rbm_layers)[1][:3],
+                         tuple(id(p) for p in dbn.rbm_layers[0].params))
+
+    def test_profiler_scopes(self):
+        # A layer that fails to pretrain leaves no profiling scope open
+        p = profiler.Profiler()
+        dbn = DBN(DBNConfig(topology=[6, 4, 3]))
+        dbn.set_profiler(p)
+        dbn.data_manager = None
+        self.assertRaises(AttributeError, dbn.pretrain, theano.shared(np.zeros((4, 6), dtype=theano.config.floatX)))
+        self.assertEqual(p.scopes, [])
+        self.assertEqual([e['scope'] for e in p.events], ['{}/layer 0'.format(dbn.out_dir)])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,142 @@
+import unittest
+import cPickle
+
+from models.rbm import RBM
+from rbm_config import *
+from models.rbm_logger import *
+import theano
+import theano.tensor as T
+import numpy as np
+
+
+class NumpyBackendTest(unittest.TestCase):
+    def setUpRBM(self, associative=False, v_unit=rbm_units.RBMUnit, cd_type=CLASSICAL, n_chains=None):
+        tr = TrainParam(learning_rate=0.01,
+                        momentum_type=NESTEROV,
+                        momentum=0.5,
+                        weight_decay=0.01,
+                        sparsity_constraint=False,
+                        batch_size=2,
+                        epochs=5)
+
+        config = RBMConfig(v_n=5, v2_n=3, h_n=10, associative=associative, v_unit=v_unit, cd_type=cd_type,
+                           n_chains=n_chains, train_params=tr, backend=NUMPY)
+        self.rbm = RBM(config)
+        np_rand = np.random.RandomState(1)
+        self.rbm.h_bias.set_value(np_rand.normal(0, 0.1, 10))
+        self.x = np_rand.binomial(n=1, p=0.5, size=(4, 5)).astype(t_float_x)
+        self.vs = np_rand.binomial(n=1, p=0.5, size=(4, 5)).astype(t_float_x)
+        self.y = np_rand.binomial(n=1, p=0.5, size=(4, 3)).astype(t_float_x)
+        self.v2s = np_rand.binomial(n=1, p=0.5, size=(4, 3)).astype(t_float_x)
+
+    def test_prop(self):
+        self.setUpRBM()
+        rbm = self.rbm
+        v = T.matrix('v')
+        h_input, h_p = theano.function([v], rbm.prop_up(v))(self.x)
+        np_h_input, np_h_p = rbm.numpy_backend.prop_up(self.x)
+        self.assertTrue(np.allclose(h_input, np_h_input))
+        self.assertTrue(np.allclose(h_p, np_h_p))
+
+        v_input, v_p = theano.function([v], rbm.prop_down(v))(h_p)
+        np_v_input, np_v_p = rbm.numpy_backend.prop_down(h_p)
+        self.assertTrue(np.allclose(v_input, np_v_input))
+        self.assertTrue(np.allclose(v_p, np_v_p))
+
+    def assertGradientsEqual(self, rbm, x, vs, y=None, v2s=None):
+        inputs = [T.matrix('x'), T.matrix('vs')]
+        scale = rbm.get_chain_scale()
+        if y is None:
+            cost = T.mean(rbm.free_energy(inputs[0])) - T.mean(rbm.free_energy(inputs[1], batch_scale=scale))
+            values = [x, vs]
+        else:
+            inputs += [T.matrix('y'), T.matrix('v2s')]
+            cost = T.mean(rbm.free_energy(inputs[0], inputs[2])) - T.mean(rbm.free_energy(inputs[1], inputs[3],
+                                                                                          scale))
+            values = [x, vs, y, v2s]
+        grads = theano.function(inputs, T.grad(cost, rbm.params))(*values)
+        np_grads = rbm.numpy_backend.get_gradients(x, vs, y, v2s)
+        for g, np_g in zip(grads, np_grads):
+            self.assertTrue(np.allclose(g, np_g))
+        return np_grads
+
+    def test_gradients(self):
+        self.setUpRBM()
+        self.assertGradientsEqual(self.rbm, self.x, self.vs)
+
+    def test_gradients_gaussian(self):
+        self.setUpRBM(v_unit=rbm_units.GaussianVisibleUnit)
+        self.assertGradientsEqual(self.rbm, self.x, self.vs)
+
+    def test_gradients_associative(self):
+        self.setUpRBM(associative=True)
+        self.assertGradientsEqual(self.rbm, self.x, self.vs, self.y, self.v2s)
+
+    def test_gradients_chains(self):
+        for v_unit in [rbm_units.RBMUnit, rbm_units.GaussianVisibleUnit]:
+            self.setUpRBM(v_unit=v_unit, cd_type=PERSISTENT)
+            x = self.x[:2]
+            grads = self.assertGradientsEqual(self.rbm, x, self.vs[:2])
+
+            # Twice the chains in the same states give the same negative statistics
+            self.setUpRBM(v_unit=v_unit, cd_type=PERSISTENT, n_chains=4)
+            self.assertEqual(self.rbm.persistent.get_value().shape, (4, 10))
+            chain_grads = self.assertGradientsEqual(self.rbm, x, np.tile(self.vs[:2], (2, 1)))
+            for g, chain_g in zip(grads, chain_grads):
+                self.assertTrue(np.allclose(g, chain_g))
+
+    def test_train(self):
+        for cd_type in [CLASSICAL, PERSISTENT]:
+            self.setUpRBM(cd_type=cd_type)
+            rbm = self.rbm
+            rbm.train_parameters.sparsity_constraint = True
+            rbm.dropout = True
+            w = rbm.W.get_value().copy()
+            cost = rbm.train(theano.shared(self.x))
+            self.assertTrue(np.all(np.isfinite(cost)))
+            self.assertFalse(np.allclose(w, rbm.W.get_value()))
+            self.assertEqual(rbm.train_fn_cache.misses, 0)
+
+    def test_pseudo_likelihood_index(self):
+        # The flipped bit is the RBM's, checkpointed with it and advanced as by the theano backend
+        indices = []
+        for backend in [NUMPY, THEANO]:
+            self.setUpRBM(cd_type=PERSISTENT)
+            rbm = self.rbm
+            rbm.backend = backend
+            rbm.track_progress = None
+            rbm.train_parameters.epochs = 2
+            rbm.train(theano.shared(self.x))
+            loaded = cPickle.loads(cPickle.dumps(rbm, protocol=cPickle.HIGHEST_PROTOCOL))
+            self.assertEqual(loaded.bit_i_idx.get_value(), 4)
+            loaded.train_parameters.epochs = 1
+            loaded.train(theano.shared(self.x))
+            indices.append(loaded.bit_i_idx.get_value())
+        self.assertEqual(indices, [1, 1])
+
+    def test_reconstruct(self):
+        self.setUpRBM()
+        rbm = self.rbm
+        res = rbm.reconstruct(self.x, k=2)
+        self.assertEqual(res.shape, self.x.shape)
+        res = rbm.mean_field_inference_opt(self.x[:, :3], y=theano.shared(self.vs[:, 3:]), k=4)
+        self.assertEqual(res.shape, (4, 2))
+
+    def test_save_load(self):
+        self.setUpRBM()
+        rbm = self.rbm
+        rbm.train(theano.shared(self.x))
+        loaded = cPickle.loads(cPickle.dumps(rbm, protocol=cPickle.HIGHEST_PROTOCOL))
+        self.assertTrue(np.all(loaded.W.get_value() == rbm.W.get_value()))
+        self.assertEqual(loaded.backend, NUMPY)
+
+        # Parameters trained with numpy are used by the theano graphs
+        loaded.backend = THEANO
+        v = T.matrix('v')
+        _, h_p = theano.function([v], loaded.prop_up(v))(self.x)
+        self.assertTrue(np.allclose(h_p, rbm.numpy_backend.prop_up(self.x)[1]))
+
+
+if __name__ == '__main__':
+    print "Test NumPy backend"
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+from models.rbm import RBM
+from models.rbm_parallel import *
+from rbm_config import *
+import theano
+import numpy as np
+
+
+class ParallelTrainerTest(unittest.TestCase):
+    def setUpRBM(self):
+        tr = TrainParam(learning_rate=0.1,
+                        momentum_type=NESTEROV,
+                        momentum=0.5,
+                        weight_decay=0.001,
+                        batch_size=5,
+                        epochs=2)
+        config = RBMConfig(v_n=20, h_n=8, train_params=tr, backend=NUMPY)
+        self.rbm = RBM(config)
+        np_rand = np.random.RandomState(1)
+        self.data = theano.shared(np_rand.binomial(n=1, p=0.5, size=(100, 20)).astype(t_float_x))
+
+    def test_train(self):
+        for mode in [HOGWILD, AVERAGE]:
+            self.setUpRBM()
+            rbm = self.rbm
+            w = rbm.W.get_value().copy()
+            trainer = ParallelTrainer(rbm, n_workers=2, mode=mode, sync_every=3)
+            costs = trainer.train(self.data)
+
+            # Workers' updates end up in the original RBM
+            self.assertEqual(len(costs), 2)
+            self.assertTrue(np.all(np.isfinite(costs)))
+            self.assertFalse(np.allclose(w, rbm.W.get_value()))
+            self.assertEqual(len(trainer.stats), 2)
+            self.assertTrue(trainer.stats[0]['samples_per_sec'] > 0)
+
+    def test_low_rank_unsupported(self):
+        # The workers run the numpy backend, which has no low-rank weights
+        self.setUpRBM()
+        config = self.rbm.config
+        config.backend = THEANO
+        config.w_rank = 3
+        self.assertRaises(Exception, ParallelTrainer, RBM(config), n_workers=2)
+
+
+if __name__ == '__main__':
+    print "Test Parallel RBM Trainer"
+    unittest.main()
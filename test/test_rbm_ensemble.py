@@ -0,0 +1,83 @@
+import unittest
+
+from models.rbm import RBM
+from models.rbm_ensemble import *
+from rbm_config import *
+import theano
+import numpy as np
+
+
+class RBMEnsembleTest(unittest.TestCase):
+    def setUp(self):
+        np_rand = np.random.RandomState(1)
+        self.data = theano.shared(np_rand.binomial(n=1, p=0.5, size=(100, 20)).astype(t_float_x))
+
+    def get_config(self, learning_rate=0.1, momentum=0.5, cd_type=CLASSICAL, unit=rbm_units.RBMUnit):
+        tr = TrainParam(learning_rate=learning_rate,
+                        momentum_type=NESTEROV,
+                        momentum=momentum,
+                        weight_decay=0.001,
+                        batch_size=10,
+                        epochs=2)
+        return RBMConfig(cd_type=cd_type, cd_steps=2, v_unit=unit, h_unit=unit, v_n=20, h_n=8, train_params=tr)
+
+    def test_same_as_rbm(self):
+        # Mean field units sample deterministically, so every member trains exactly as the RBM on its own
+        for cd_type in [CLASSICAL, PERSISTENT]:
+            configs = [self.get_config(lr, m, cd_type, rbm_units.BinaryUnit) for (lr, m) in [(0.1, 0.5), (0.01, 0.9)]]
+            ensemble = RBMEnsemble.from_configs(configs, seeds=[1, 2], shuffle=False)
+            ensemble.train(self.data)
+
+            for (i, config) in enumerate(configs):
+                w = np.random.RandomState(i + 1).normal(0, scale=0.01, size=(20, 8)).astype(t_float_x)
+                rbm = RBM(config, W=w)
+                rbm.train(self.data)
+                member = ensemble.get_member(i)
+                for (p, expected) in zip(member.params + member.momentum, rbm.params + rbm.momentum):
+                    self.assertTrue(np.allclose(p.get_value(), expected.get_value(), atol=1e-5))
+
+    def test_independent_members(self):
+        # A member trains the same whatever the other members are
+        configs = [self.get_config(lr) for lr in [0.1, 0.05, 0.01]]
+        ensemble = RBMEnsemble.from_configs(configs, seeds=[4, 5, 6])
+        costs = ensemble.train(self.data)
+        self.assertEqual(costs.shape, (2, 3))
+        self.assertTrue(np.all(np.isfinite(costs)))
+
+        single = RBMEnsemble.from_configs(configs[1:2], seeds=[5])
+        single.train(self.data)
+        self.assertTrue(np.allclose(ensemble.get_member(1).W.get_value(), single.get_member(0).W.get_value(),
+                                    atol=1e-5))
+        self.assertFalse(np.allclose(ensemble.get_member(0).W.get_value(), ensemble.get_member(1).W.get_value()))
+
+    def test_members(self):
+        configs = [self.get_config(lr) for lr in [0.1, 0.]]
+        ensemble = RBMEnsemble.from_configs(configs)
+        w = [rbm.W.get_value().copy() for rbm in ensemble.rbms]
+        ensemble.train(self.data)
+        members = ensemble.members()
+
+        # A learning rate of 0 leaves the member as it was
+        self.assertTrue(np.array_equal(members[1].W.get_value(), w[1]))
+        self.assertFalse(np.allclose(members[0].W.get_value(), w[0]))
+
+        # Members are RBMs that carry on training on their own
+        rbm = members[0]
+        self.assertTrue(isinstance(rbm, RBM))
+        self.assertEqual(rbm.epoch, 2)
+        rbm.train(self.data)
+        self.assertEqual(rbm.epoch, 4)
+        self.assertEqual(rbm.reconstruct(self.data.get_value()[:5]).shape, (5, 20))
+
+    def test_unsupported(self):
+        config = self.get_config()
+        config.train_params = TrainParam(sparsity_constraint=True, batch_size=10)
+        self.assertRaises(Exception, RBMEnsemble.from_configs, [self.get_config(), config])
+        other = self.get_config()
+        other.h_n = 9
+        self.assertRaises(Exception, RBMEnsemble.from_configs, [self.get_config(), other])
+
+
+if __name__ == '__main__':
+    print "Test RBM Ensemble"
+    unittest.main()
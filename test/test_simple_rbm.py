@@ -7,6 +7,13 @@ import theano
 import theano.tensor as T
 from theano.tensor.shared_randomstreams import RandomStreams
 import numpy as np
+import threading
+import time
+import cPickle
+from models.visualiser import AsyncVisualiser
+from models import visualiser as visualiser_module
+from models import profiler
+import json
 
 
 class SingleRBMTest(unittest.TestCase):
@@ -115,6 +122,259 @@ class SingleRBMTest(unittest.TestCase):
         # print g_h
         pass
 
+    def test_closed_form_gradients(self):
+        np_rand = np.random.RandomState(1)
+        x, vs = np_rand.binomial(n=1, p=0.5, size=(2, 4, 5)).astype(t_float_x)
+        y, v2s = np_rand.binomial(n=1, p=0.5, size=(2, 4, 5)).astype(t_float_x)
+        for associative in [False, True]:
+            for v_unit, h_unit in [(rbm_units.RBMUnit, rbm_units.RBMUnit),
+                                   (rbm_units.GaussianVisibleUnit, rbm_units.ReLUnit),
+                                   (rbm_units.RBMUnit, rbm_units.NReLUnit)]:
+                for cd_type, n_chains, w_rank in [(CLASSICAL, None, None), (PERSISTENT, 6, None), (CLASSICAL, None, 3)]:
+                    self.setUpRBM()
+                    config = self.rbm.config
+                    config.associative = associative
+                    config.v_unit = v_unit
+                    config.v2_unit = v_unit
+                    config.h_unit = h_unit
+                    config.cd_type = cd_type
+                    config.n_chains = n_chains
+                    config.w_rank = w_rank
+                    config.train_params.batch_size = 4
+                    rbm = RBM(config)
+                    rbm.h_bias.set_value(np_rand.normal(0, 1, rbm.h_n))
+
+                    tx, tvs, ty, tv2s = [T.matrix() for i in xrange(4)]
+                    scale = rbm.get_chain_scale()
+                    if associative:
+                        cost = T.mean(rbm.free_energy(tx, ty)) - T.mean(rbm.free_energy(tvs, tv2s, scale))
+                        closed_form = rbm.get_gradients(tx, tvs, ty, tv2s)
+                    else:
+                        cost = T.mean(rbm.free_energy(tx)) - T.mean(rbm.free_energy(tvs, batch_scale=scale))
+                        closed_form = rbm.get_gradients(tx, tvs)
+                    grads = T.grad(cost, rbm.params, consider_constant=[tvs, tv2s])
+                    f = theano.function([tx, tvs, ty, tv2s], grads + closed_form, on_unused_input='ignore')
+                    # 6 persistent chains for a batch of 4
+                    chains = [np.tile(v, (2, 1))[:6] if n_chains else v for v in [vs, v2s]]
+                    res = f(x, chains[0], y, chains[1])
+                    n = len(rbm.params)
+                    for g, cf in zip(res[:n], res[n:]):
+                        self.assertTrue(np.allclose(g, cf))
+
+    def test_closed_form_sparsity(self):
+        np_rand = np.random.RandomState(2)
+        x = np_rand.binomial(n=1, p=0.5, size=(4, 5)).astype(t_float_x)
+        y = np_rand.binomial(n=1, p=0.5, size=(4, 5)).astype(t_float_x)
+        mask = np_rand.binomial(n=1, p=0.8, size=(4, 10)).astype(t_float_x)
+        for associative in [False, True]:
+            for h_unit in [rbm_units.RBMUnit, rbm_units.ReLUnit, rbm_units.NReLUnit]:
+                for dropout, w_rank in [(False, None), (True, None), (True, 3)]:
+                    self.setUpRBM()
+                    config = self.rbm.config
+                    config.associative = associative
+                    config.h_unit = h_unit
+                    config.w_rank = w_rank
+                    rbm = RBM(config)
+                    rbm.active_probability_h.set_value(np_rand.uniform(0.1, 0.9, rbm.h_n).astype(t_float_x))
+                    rbm.training = dropout
+                    rbm.dropout = dropout
+                    rbm.dropout_mask = T.constant(mask)
+
+                    tx, ty = T.matrix(), T.matrix()
+                    penalties = []
+                    for closed_form in [False, True]:
+                        rbm.train_parameters.closed_form_gradients = closed_form
+                        terms, q = rbm.get_sparsity_penalties(tx, ty if associative else None,
+                                                              rbm.active_probability_h, 0.1)
+                        penalties.append([term for (_, term) in terms] + [q])
+                    f = theano.function([tx, ty], penalties[0] + penalties[1], on_unused_input='ignore')
+                    res = f(x, y)
+                    n = len(penalties[0])
+                    self.assertEqual(n, (4 if associative else 3) + bool(w_rank))
+                    for grad, closed_form in zip(res[:n], res[n:]):
+                        self.assertTrue(np.allclose(grad, closed_form))
+
+    def test_sparsity_rectified_units(self):
+        # The activity of rectified units is a probability, so q stays in (0, 1) and moves to the target
+        np_rand = np.random.RandomState(3)
+        x = theano.shared(np_rand.binomial(n=1, p=0.5, size=(20, 5)).astype(t_float_x))
+        for h_unit in [rbm_units.ReLUnit, rbm_units.NReLUnit]:
+            for backend in [THEANO, NUMPY]:
+                self.setUpRBM()
+                config = self.rbm.config
+                config.h_unit = h_unit
+                config.backend = backend
+                config.progress_logger = None
+                config.train_params.sparsity_constraint = True
+                config.train_params.sparsity_target = 0.1
+                config.train_params.sparsity_cost = 1.
+                config.train_params.epochs = 2
+                rbm = RBM(config)
+                # The bias is left at 0, log [t / (1 - t)] is for sigmoid units
+                self.assertTrue(np.all(rbm.h_bias.get_value() == 0))
+                h_total_input, _ = rbm.prop_up(x)
+                initial = theano.function([], T.mean(rbm.h_unit.active_probability(h_total_input)))()
+
+                rbm.train(x)
+                q = rbm.active_probability_h.get_value()
+                self.assertTrue(np.all((q > 0) & (q < 1)))
+                self.assertTrue(np.mean(q) < initial)
+                self.assertTrue(np.all(rbm.h_bias.get_value() < 0))
+
+    def test_classify(self):
+        self.setUpRBM()
+        config = self.rbm.config
+        config.associative = True
+        config.v2_n = 3
+        rbm = RBM(config)
+        np_rand = np.random.RandomState(2)
+        for p in rbm.params:
+            p.set_value(np_rand.normal(0, 1, p.get_value().shape))
+        x = np_rand.binomial(n=1, p=0.5, size=(6, 5)).astype(t_float_x)
+
+        log_posteriors = rbm.get_class_log_posteriors(theano.shared(x))
+
+        # p(c | x) from the free energy of each (x, c) pair
+        w, v_bias, h_bias, u, v_bias2 = [p.get_value() for p in rbm.params]
+        neg_fe = np.array([[np.dot(xi, v_bias) + v_bias2[c] + np.sum(np.log(1 + np.exp(np.dot(xi, w) + h_bias + u[c])))
+                            for c in xrange(3)] for xi in x])
+        posteriors = np.exp(neg_fe) / np.sum(np.exp(neg_fe), axis=1, keepdims=True)
+        self.assertEqual(log_posteriors.shape, (6, 3))
+        self.assertTrue(np.allclose(np.exp(log_posteriors), posteriors))
+        self.assertTrue(np.all(rbm.classify(x) == posteriors.argmax(axis=1)))
+        self.assertEqual(rbm.inference_fn_cache.misses, 1)
+        self.assertEqual(rbm.inference_fn_cache.hits, 1)
+
+    def test_softmax_unit(self):
+        unit = rbm_units.SoftmaxUnit()
+        x = T.matrix('x')
+        total_input = np.array([[0., 1., 2.], [3., 0., -1.]], dtype=t_float_x)
+        p = theano.function([x], unit.scale(x))(total_input)
+        self.assertTrue(np.allclose(p, unit.np_scale(total_input)))
+        self.assertTrue(np.allclose(p.sum(axis=1), 1))
+
+        # Exactly one active unit per row, drawn with probability p
+        sample = theano.function([x], unit.activate(x))
+        samples = np.array([sample(p) for i in xrange(2000)])
+        np_samples = np.array([unit.np_activate(p) for i in xrange(2000)])
+        for s in [samples, np_samples]:
+            self.assertTrue(np.all(s.sum(axis=2) == 1))
+            self.assertTrue(np.all(np.abs(s.mean(axis=0) - p) < 0.05))
+
+    def test_train_softmax_label(self):
+        self.setUpRBM()
+        config = self.rbm.config
+        config.associative = True
+        config.v2_n = 3
+        config.v2_unit = rbm_units.SoftmaxUnit
+        rbm = RBM(config)
+        rbm.train_parameters.epochs = 2
+        y = theano.shared(np.eye(3, dtype=t_float_x)[np.arange(10) % 3])
+        cost = rbm.train(self.tx2, y)
+        self.assertTrue(np.all(np.isfinite(cost)))
+
+        labels = rbm.sample_class(self.tx2)
+        self.assertEqual(labels.shape, (10, 3))
+        self.assertTrue(np.all(labels.sum(axis=1) == 1))
+
+    def test_inference_fn_cache(self):
+        self.setUpRBM()
+        rbm = self.rbm
+        rbm.track_progress = None
+        np_rand = np.random.RandomState(3)
+        x = np_rand.binomial(n=1, p=0.5, size=(4, 5)).astype(t_float_x)
+        x2 = np_rand.binomial(n=1, p=0.5, size=(4, 5)).astype(t_float_x)
+
+        for i in xrange(3):
+            self.assertEqual(rbm.reconstruct(theano.shared(x), k=2).shape, (4, 5))
+        self.assertEqual(rbm.inference_fn_cache.misses, 1)
+        self.assertEqual(rbm.inference_fn_cache.hits, 2)
+
+        # Compiled once, later calls only swap the data, same result as the numpy implementation
+        y = theano.shared(np.zeros((4, 2), dtype=t_float_x))
+        for data in [x, x2, x]:
+            res = rbm.mean_field_inference_opt(theano.shared(data[:, :3]), y=y, k=4)
+            expected = rbm.numpy_backend.mean_field_inference_opt(data[:, :3], y, k=4)
+            self.assertTrue(np.allclose(res, expected))
+        self.assertEqual(rbm.inference_fn_cache.misses, 2)
+
+        rbm.reconstruct_association_opt(x[:, :2], np.zeros((4, 3), dtype=t_float_x), k=2)
+        rbm.reconstruct_association_opt(x2[:, :2], np.zeros((4, 3), dtype=t_float_x), k=2)
+        self.assertEqual(rbm.inference_fn_cache.misses, 3)
+        self.assertTrue(rbm.inference_fn_cache.execute_time > 0)
+
+    def test_mean_field_early_stopping(self):
+        self.setUpRBM()
+        rbm = self.rbm
+        rbm.track_progress = None
+        np_rand = np.random.RandomState(5)
+        x = np_rand.binomial(n=1, p=0.5, size=(6, 3)).astype(t_float_x)
+        y = np.zeros((6, 2), dtype=t_float_x)
+
+        full, full_iterations = rbm.mean_field_inference_opt(x, y=y, k=50, return_iterations=True)
+        self.assertTrue(np.all(full_iterations == 50))
+
+        # Rows stop once converged, the result and counts match the numpy implementation
+        res, iterations = rbm.mean_field_inference_opt(x, y=y, k=50, tolerance=1e-4, return_iterations=True)
+        expected, expected_iterations = rbm.numpy_backend.mean_field_inference_opt(x, y, k=50, tolerance=1e-4,
+                                                                                   return_iterations=True)
+        self.assertTrue(np.all(iterations < 50))
+        self.assertTrue(np.all(iterations == expected_iterations))
+        self.assertTrue(np.allclose(res, expected, atol=1e-5))
+        self.assertTrue(np.allclose(res, full, atol=1e-3))
+
+    def test_mean_field_solvers(self):
+        np_rand = np.random.RandomState(6)
+        config = RBMConfig(v_n=20, h_n=15)
+        rbm = RBM(config)
+        rbm.W.set_value(np_rand.normal(0, 0.5, (20, 15)).astype(t_float_x))
+        x = np_rand.binomial(n=1, p=0.5, size=(8, 10)).astype(t_float_x)
+        y = np.zeros((8, 10), dtype=t_float_x)
+
+        fixed_point, fixed_point_iterations = rbm.mean_field_inference_opt(x, y=y, k=200, tolerance=1e-6,
+                                                                           return_iterations=True)
+        for solver in [DAMPED, ANDERSON]:
+            res, iterations = rbm.mean_field_inference_opt(x, y=y, k=200, tolerance=1e-6, solver=solver,
+                                                           return_iterations=True)
+            expected, expected_iterations = rbm.numpy_backend.mean_field_inference_opt(x, y, k=200, tolerance=1e-6,
+                                                                                       solver=solver,
+                                                                                       return_iterations=True)
+            # Same fixed point in fewer iterations, the numpy implementation takes the same steps
+            self.assertTrue(np.allclose(res, fixed_point, atol=1e-5))
+            self.assertTrue(np.sum(iterations) < np.sum(fixed_point_iterations))
+            self.assertTrue(np.all(iterations == expected_iterations))
+            self.assertTrue(np.allclose(res, expected))
+
+        # The first step starts from the initial tau, the same step as the fixed point iteration
+        for k in [1, 2]:
+            fixed_point = rbm.mean_field_inference_opt(x, y=y, k=k)
+            for solver in [DAMPED, ANDERSON]:
+                self.assertTrue(np.allclose(rbm.mean_field_inference_opt(x, y=y, k=k, solver=solver), fixed_point))
+                self.assertTrue(np.allclose(rbm.numpy_backend.mean_field_inference_opt(x, y, k=k, solver=solver),
+                                            fixed_point))
+
+    def test_reconstruct_stream(self):
+        self.setUpRBM()
+        rbm = self.rbm
+        rbm.track_progress = None
+        np_rand = np.random.RandomState(4)
+        x = np_rand.binomial(n=1, p=0.5, size=(10, 5)).astype(t_float_x)
+
+        # Chunks of 4, the last one padded, all through one compiled sampler
+        chunks = list(rbm.reconstruct_stream(x, k=2, chunk_size=4))
+        self.assertEqual([c.shape for c in chunks], [(4, 5), (4, 5), (2, 5)])
+        self.assertEqual(rbm.inference_fn_cache.misses, 1)
+
+        # Iterators of rows are regrouped, prefetching gives the same chunks
+        rows = (row for row in x)
+        chunks = list(rbm.reconstruct_stream(rows, k=2, chunk_size=4, prefetch=True))
+        self.assertEqual(np.concatenate(chunks).shape, (10, 5))
+        self.assertEqual(rbm.inference_fn_cache.misses, 1)
+
+        chunks = [c for c in utils.prefetch(utils.iterate_chunks([x[:3], x[3:], x[:1]], 4))]
+        self.assertEqual([len(c) for c in chunks], [4, 4, 3])
+        self.assertTrue(np.all(np.concatenate(chunks) == np.concatenate([x, x[:1]])))
+
     def test_reconstruction_cost(self):
         self.setUpRBM()
         rbm = self.rbm
@@ -145,11 +405,381 @@ class SingleRBMTest(unittest.TestCase):
         print res
         pass
 
+    def test_train_fn_cache(self):
+        self.setUpRBM()
+        rbm = self.rbm
+        fn = rbm.get_train_fn(self.tx, None)
+        fn2 = rbm.get_train_fn(theano.shared(self.x[::-1].copy()), None)
+        self.assertTrue(fn is fn2)
+        self.assertEqual(rbm.train_fn_cache.hits, 1)
+        self.assertEqual(rbm.train_fn_cache.misses, 1)
+
+        # New data shape or training parameters need a new function
+        rbm.get_train_fn(self.tx2, None)
+        rbm.train_parameters.learning_rate = 0.1
+        rbm.get_train_fn(self.tx, None)
+        self.assertEqual(rbm.train_fn_cache.misses, 3)
+
+    def test_train_block(self):
+        results = []
+        for batches_per_call in [1, 0, 3]:
+            self.setUpRBM()
+            rbm = self.rbm
+            rbm.train_parameters.momentum_type = NESTEROV
+            rbm.train_parameters.batches_per_call = batches_per_call
+            rbm.train_parameters.epochs = 2
+            cost = rbm.train(self.tx2)
+            results.append((rbm.W.get_value(), rbm.h_bias.get_value(), np.array(cost)))
+
+        # Same updates whether minibatches run one per call or inside a compiled scan
+        for result in results[1:]:
+            for a, b in zip(results[0], result):
+                self.assertTrue(np.allclose(a, b))
+
+    def test_persistent_chains(self):
+        self.setUpRBM()
+        rbm = self.rbm
+        rbm.config.cd_type = PERSISTENT
+        rbm.config.n_chains = 7
+        rbm = RBM(rbm.config)
+        rbm.dropout = True
+        rbm.train_parameters.epochs = 2
+        cost = rbm.train(self.tx2)
+        self.assertTrue(np.all(np.isfinite(cost)))
+
+        # Chains have their own size and carry over to the next call to train
+        chains = rbm.persistent.get_value()
+        self.assertEqual(chains.shape, (7, rbm.h_n))
+        self.assertTrue(np.any(chains))
+        rbm.get_train_fn(self.tx2, None)
+        self.assertTrue(np.all(chains == rbm.persistent.get_value()))
+
+    def setUpTemperedRBM(self, associative=False):
+        self.setUpRBM()
+        config = self.rbm.config
+        config.cd_type = PARALLEL_TEMPERING
+        config.temperatures = [1., 0.75, 0.5, 0.25]
+        config.n_chains = 3
+        config.associative = associative
+        self.rbm = RBM(config)
+        self.rbm.train_parameters.epochs = 2
+
+    def test_swap_replicas(self):
+        self.setUpTemperedRBM()
+        rbm = self.rbm
+        rbm.W.set_value(rbm.np_rand.normal(0, 3, rbm.W.get_value().shape))
+        v = T.matrix('v')
+        parity = T.lscalar('parity')
+        swapped, accepted, attempted = rbm.swap_replicas(parity, v)
+        f = theano.function([parity, v], [swapped[0], accepted, attempted])
+
+        # Identical replicas always swap, only pairs of the given parity are tried
+        same = np.tile(rbm.np_rand.binomial(n=1, p=0.5, size=(3, 5)), (4, 1)).astype(t_float_x)
+        _, accepted, attempted = f(0, same)
+        self.assertTrue(np.all(attempted == [3, 0, 3]))
+        self.assertTrue(np.all(accepted == attempted))
+
+        # Swapped states stay in their chain and come from a neighbouring temperature
+        x = rbm.np_rand.binomial(n=1, p=0.5, size=(12, 5)).astype(t_float_x)
+        for p in [0, 1]:
+            v_swapped, accepted, attempted = f(p, x)
+            self.assertTrue(np.all(attempted == [3 * (p == 0), 3 * (p == 1), 3 * (p == 0)]))
+            before = x.reshape(4, 3, 5)
+            after = v_swapped.reshape(4, 3, 5)
+            for t in xrange(4):
+                for c in xrange(3):
+                    sources = [before[s, c] for s in [t - 1, t, t + 1] if 0 <= s < 4]
+                    self.assertTrue(any(np.all(after[t, c] == src) for src in sources))
+            self.assertTrue(np.all(np.sort(after, axis=0) == np.sort(before, axis=0)))
+
+    def test_train_parallel_tempering(self):
+        for associative in [False, True]:
+            self.setUpTemperedRBM(associative)
+            rbm = self.rbm
+            rbm.dropout = True
+            y = self.tx2 if associative else None
+            cost = rbm.train(self.tx2, y)
+            self.assertTrue(np.all(np.isfinite(cost)))
+            self.assertEqual(rbm.pt_chains.get_value().shape, (12, rbm.v_n))
+            self.assertEqual(rbm.pt_step.get_value(), 20)
+            rates = rbm.get_swap_rates()
+            self.assertEqual(rates.shape, (3,))
+            self.assertTrue(np.all((rates >= 0) & (rates <= 1)))
+
+    def test_train_fast_persistent(self):
+        results = []
+        for cd_type, fast_learning_rate in [(PERSISTENT, 0), (FAST_PERSISTENT, 0), (FAST_PERSISTENT, 0.1)]:
+            self.setUpRBM()
+            config = self.rbm.config
+            config.cd_type = cd_type
+            config.train_params.fast_learning_rate = fast_learning_rate
+            config.train_params.epochs = 2
+            rbm = RBM(config)
+            cost = rbm.train(self.tx2)
+            self.assertTrue(np.all(np.isfinite(cost)))
+            results.append(rbm)
+
+        # Without fast learning FPCD is PCD, otherwise the fast weights steer the chains
+        self.assertTrue(np.all(results[0].W.get_value() == results[1].W.get_value()))
+        self.assertFalse(np.any(results[1].fast_params[0].get_value()))
+        self.assertTrue(np.any(results[2].fast_params[0].get_value()))
+        self.assertFalse(np.allclose(results[0].W.get_value(), results[2].W.get_value()))
+
+    def get_training_state(self, rbm):
+        state = rbm.params + rbm.momentum + [rbm.active_probability_h, rbm.persistent, rbm.bit_i_idx] + \
+            (rbm.fast_params or [])
+        if rbm.cd_type is PARALLEL_TEMPERING:
+            state += [rbm.pt_chains, rbm.pt_step]
+        return [s.get_value() for s in state]
+
+    def test_resume_training(self):
+        for cd_type in [CLASSICAL, PERSISTENT, FAST_PERSISTENT, PARALLEL_TEMPERING]:
+            results = []
+            for resume in [False, True]:
+                self.setUpRBM()
+                config = self.rbm.config
+                config.cd_type = cd_type
+                config.n_chains = 3
+                config.temperatures = [1., 0.5]
+                config.train_params.sparsity_constraint = True
+                config.train_params.dropout = True
+                config.train_params.fast_learning_rate = 0.1
+                config.train_params.epochs = 4
+                rbm = RBM(config)
+                if resume:
+                    # Stop half way, checkpoint and carry on training the restored copy
+                    rbm.train_parameters.epochs = 2
+                    rbm.train(self.tx2)
+                    rbm = cPickle.loads(cPickle.dumps(rbm, protocol=cPickle.HIGHEST_PROTOCOL))
+                    self.assertTrue(np.any(rbm.momentum[0].get_value()))
+                    rbm.train(self.tx2)
+                else:
+                    rbm.train(self.tx2)
+                self.assertEqual(rbm.epoch, 4)
+                results.append(self.get_training_state(rbm))
+
+            # Bit for bit the same as training without interruption
+            for a, b in zip(*results):
+                self.assertTrue(np.array_equal(a, b))
+
     def test_train(self):
         self.setUpRBM()
         rbm = self.rbm
         pass
 
+    def test_monitor_weights(self):
+        self.setUpRBM()
+        rbm = self.rbm
+        rbm.track_progress = ProgressLogger(monitor_weights=True, monitor_every=2)
+        rbm.train_parameters.epochs = 2
+        data = theano.shared(np.random.RandomState(7).binomial(n=1, p=0.5, size=(5, 5)).astype(t_float_x))
+
+        # 5 minibatches per epoch, statistics of batches 0, 2 and 4
+        rbm.train(data)
+        stats = rbm.track_progress.get_weight_stats()
+        self.assertEqual(stats.shape, (6, len(WEIGHT_STATS)))
+        w = rbm.W.get_value()
+        self.assertAlmostEqual(stats[-1, 0], np.mean(w))
+        self.assertAlmostEqual(stats[-1, 1], np.std(w))
+        self.assertAlmostEqual(rbm.track_progress.weight_hist['max'], np.max(stats[:, 3]))
+        self.assertTrue(np.all(stats[:, -1] > 0))
+
+        # Blocks of minibatches inside one call return the same rows
+        rbm.train_parameters.batches_per_call = 0
+        rbm.train(data)
+        self.assertEqual(len(rbm.track_progress.get_weight_stats('avg')), 12)
+        self.assertAlmostEqual(rbm.track_progress.get_weight_stats('avg')[-1], np.mean(rbm.W.get_value()))
+
+    def test_low_rank_weights(self):
+        np_rand = np.random.RandomState(3)
+        x = np_rand.binomial(n=1, p=0.5, size=(4, 5)).astype(t_float_x)
+        h = np_rand.binomial(n=1, p=0.5, size=(4, 10)).astype(t_float_x)
+        self.setUpRBM()
+        config = self.rbm.config
+        config.w_rank = 2
+        rbm = RBM(config)
+        self.assertEqual([p.name for p in rbm.params], ['W_a', 'v_bias', 'h_bias', 'W_b'])
+        w = rbm.get_weights()
+        self.assertEqual(w.shape, (5, 10))
+        self.assertEqual(np.linalg.matrix_rank(w), 2)
+
+        # The same model as the dense RBM whose W is the product
+        config.w_rank = None
+        dense = RBM(config, W=w)
+        tx, th = T.matrix(), T.matrix()
+        f = theano.function([tx, th], [rbm.free_energy(tx), rbm.prop_up(tx)[0], rbm.prop_down(th)[0],
+                                       dense.free_energy(tx), dense.prop_up(tx)[0], dense.prop_down(th)[0]])
+        res = f(x, h)
+        for a, b in zip(res[:3], res[3:]):
+            self.assertTrue(np.allclose(a, b))
+
+        # Preconditioned closed form gradients of the factors, the preconditioners go in on the minibatch side
+        cost = T.mean(rbm.free_energy(tx)) - T.mean(rbm.free_energy(th[:, :5]))
+        grads = rbm.scale_factor_gradients(T.grad(cost, rbm.params, consider_constant=[th]), rbm.get_factor_scales())
+        closed_form = rbm.get_gradients(tx, th[:, :5], factor_scales=rbm.get_factor_scales())
+        res = theano.function([tx, th], grads + closed_form)(x, h)
+        for g, cf in zip(res[:4], res[4:]):
+            self.assertTrue(np.allclose(g, cf))
+
+        config.w_rank = 2
+        config.backend = NUMPY
+        self.assertRaises(Exception, RBM, config)
+
+        # Switched per instance, the numpy backend refuses to train or infer rather than taking W_a for W
+        config.backend = THEANO
+        rbm = RBM(config)
+        rbm.backend = NUMPY
+        self.assertRaises(Exception, rbm.train, self.tx2)
+        self.assertRaises(Exception, rbm.reconstruct, x, k=1)
+
+        # The rank has to be below both layer sizes
+        for w_rank in [0, -1, 5, 12]:
+            config.w_rank = w_rank
+            self.assertRaises(Exception, RBM, config)
+
+        # A factor of lower rank makes its Gram matrix singular, the preconditioner is regularised
+        config.w_rank = 3
+        w_b = np_rand.normal(0, 0.1, (3, 10)).astype(t_float_x)
+        w_b[2] = 0
+        rbm = RBM(config, W=(np_rand.normal(0, 0.1, (5, 3)).astype(t_float_x), w_b))
+        rbm.track_progress = None
+        rbm.train(self.tx2)
+        self.assertTrue(np.all(np.isfinite(rbm.get_weights())))
+
+        for cd_type in [CLASSICAL, PERSISTENT, FAST_PERSISTENT, PARALLEL_TEMPERING]:
+            self.setUpRBM()
+            config = self.rbm.config
+            config.cd_type = cd_type
+            config.n_chains = 3
+            config.temperatures = [1., 0.5]
+            config.w_rank = 2
+            config.train_params.sparsity_constraint = True
+            config.train_params.epochs = 2
+            rbm = RBM(config)
+            # 10 minibatches, the statistics of the last one are those of the trained weights
+            rbm.track_progress = ProgressLogger(monitor_weights=True, monitor_every=9)
+            rbm.train(self.tx2)
+            w = rbm.get_weights()
+            self.assertEqual(np.linalg.matrix_rank(w), 2)
+            self.assertAlmostEqual(rbm.track_progress.get_weight_stats()[-1, 0], np.mean(w))
+
+            # Checkpoints restore the factors
+            restored = cPickle.loads(cPickle.dumps(rbm, protocol=cPickle.HIGHEST_PROTOCOL))
+            self.assertTrue(np.array_equal(restored.get_weights(), w))
+            restored.train(self.tx2)
+            self.assertEqual(restored.epoch, 4)
+
+    def test_async_visualiser(self):
+        visualiser = AsyncVisualiser(max_pending=2)
+        release = threading.Event()
+        rendered = []
+
+        def render(name):
+            release.wait()
+            rendered.append(name)
+
+        # The first frame blocks the thread while the others queue up
+        visualiser.submit('a', render, 'a')
+        time.sleep(0.1)
+        for (key, name) in [('b', 'b1'), ('c', 'c'), ('b', 'b2'), ('d', 'd')]:
+            visualiser.submit(key, render, name)
+        release.set()
+        visualiser.flush()
+
+        # b1 is coalesced into b2, c is the oldest frame when d arrives
+        self.assertEqual(rendered, ['a', 'b2', 'd'])
+        self.assertEqual((visualiser.coalesced, visualiser.dropped, visualiser.rendered), (1, 1, 3))
+        self.assertTrue(visualiser.saved_time() > 0)
+        visualiser.close()
+        self.assertFalse(visualiser.thread.is_alive())
+        self.assertFalse(visualiser in visualiser_module._open)
+
+        # Images are rendered in the background only when asked for
+        self.assertFalse(ProgressLogger().async_plot)
+        logger = ProgressLogger(async_plot=True)
+        logger.render('weight', render, 'w')
+        loaded = cPickle.loads(cPickle.dumps(logger))
+        self.assertTrue(loaded.visualiser is None)
+        self.assertEqual(logger.flush().rendered, 1)
+
+    def test_profiler(self):
+        for backend in [THEANO, NUMPY]:
+            results = []
+            for profile in [False, True]:
+                self.setUpRBM()
+                rbm = self.rbm
+                rbm.backend = backend
+                rbm.dropout = True
+                rbm.train_parameters.epochs = 2
+                p = profiler.Profiler(theano_profile=True, sample_every=3)
+                if profile:
+                    rbm.set_profiler(p)
+                rbm.train(self.tx2)
+                results.append([param.get_value() for param in rbm.params])
+
+            # Profiling does not change training
+            for a, b in zip(*results):
+                self.assertTrue(np.array_equal(a, b))
+
+            summary = p.summary()
+            self.assertEqual(summary.keys(), ['train'])
+            phases = summary['train']
+            for phase in [profiler.POSITIVE, profiler.NEGATIVE, profiler.MONITOR]:
+                self.assertTrue(phases[phase] > 0)
+            self.assertEqual(profiler.COMPILE in phases, backend == THEANO)
+
+            # The numpy backend times the update, the compiled training function leaves it as the rest of a call
+            if backend == THEANO:
+                self.assertTrue(phases[profiler.UPDATE_RESIDUAL] >= 0)
+                self.assertFalse(profiler.UPDATE in phases)
+                estimated = [e for e in p.events if e['phase'] in [profiler.POSITIVE, profiler.UPDATE_RESIDUAL]]
+                self.assertTrue(all(e['args']['estimated'] for e in estimated))
+            else:
+                self.assertTrue(phases[profiler.UPDATE] > 0)
+                self.assertFalse(profiler.UPDATE_RESIDUAL in phases)
+
+            # Phases fit in the span of their scope
+            span = [e for e in p.events if e['phase'] is None][0]
+            self.assertTrue(sum(phases.values()) <= span['duration'])
+
+            theano_summary = json.loads(json.dumps(p.to_dict()))['theano']
+            if backend == THEANO:
+                self.assertEqual(theano_summary['train/train_rbm']['calls'], 20)
+                self.assertTrue(len(theano_summary['train/train_rbm']['ops']) > 0)
+            else:
+                self.assertEqual(theano_summary, {})
+
+            trace = json.loads(json.dumps(p.get_chrome_trace()))['traceEvents']
+            complete = [e for e in trace if e['ph'] == 'X']
+            self.assertEqual(len(complete), len(p.events))
+            self.assertTrue(all(e['dur'] >= 0 for e in complete))
+
+        # Profilers are not pickled
+        self.assertTrue(cPickle.loads(cPickle.dumps(rbm)).profiler is None)
+
+    def test_dropout_mask(self):
+        self.setUpRBM()
+        rbm = self.rbm
+        rbm.dropout_rate = 0.8
+        draw_mask = theano.function([], rbm.get_dropout_mask(10))
+        masks = np.array([draw_mask() for i in xrange(500)])
+        host_masks = rbm.np_rand.binomial(n=1, p=rbm.dropout_rate, size=masks.shape)
+
+        # New mask for every call, same statistics as the masks drawn with numpy
+        self.assertEqual(masks.shape[1:], (10, rbm.h_n))
+        self.assertTrue(np.any(masks[0] != masks[1]))
+        self.assertAlmostEqual(masks.mean(), host_masks.mean(), places=2)
+        self.assertAlmostEqual(masks.var(), host_masks.var(), places=2)
+        self.assertTrue(np.all(np.abs(masks.mean(axis=0) - 0.8) < 0.1))
+
+    def test_train_dropout(self):
+        self.setUpRBM()
+        rbm = self.rbm
+        rbm.dropout = True
+        rbm.train_parameters.epochs = 2
+        cost = rbm.train(self.tx2)
+        self.assertTrue(np.all(np.isfinite(cost)))
+
     def test_dropout(self):
         srng = RandomStreams(seed=234)
 
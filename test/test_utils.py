@@ -1,9 +1,12 @@
 import unittest
 import os
 
+import numpy as np
+
 import datastorage as store
 from models import rbm as RBM
-import dbn as DBN
+from models import DBN
+import utils
 
 
 class UtilsTest(unittest.TestCase):
@@ -35,6 +38,35 @@ class UtilsTest(unittest.TestCase):
         store.move_to_root()
 
 
+class TileRasterImagesTest(unittest.TestCase):
+    def test_tile_raster_images(self):
+        np_rand = np.random.RandomState(1)
+        x = np_rand.normal(size=(7, 6)).astype('float32')
+
+        # 7 images of 2x3 on a 3x3 grid with spacing, the last two tiles stay empty
+        out = utils.tile_raster_images(x, img_shape=(2, 3), tile_shape=(3, 3), tile_spacing=(1, 1))
+        self.assertEqual(out.shape, (8, 11))
+        self.assertEqual(out.dtype, np.uint8)
+        for i in xrange(7):
+            row, col = i / 3, i % 3
+            tile = out[row * 3: row * 3 + 2, col * 4: col * 4 + 3]
+            expected = (utils.scale_to_unit_interval(x[i].reshape(2, 3)) * 255).astype('uint8')
+            self.assertTrue(np.all(tile == expected))
+        self.assertTrue(np.all(out[6:, 4:] == 0))
+        self.assertTrue(np.all(out[2] == 0))
+
+        out = utils.tile_raster_images(x, (2, 3), (3, 3), scale_rows_to_unit_interval=False, output_pixel_vals=False)
+        self.assertEqual(out.dtype, x.dtype)
+        self.assertTrue(np.all(out[:2, :3] == x[0].reshape(2, 3)))
+
+        # One channel per image set, missing channels take their default
+        rgba = utils.tile_raster_images((x, None, x, None), (2, 3), (3, 3), (1, 1))
+        self.assertEqual(rgba.shape, (8, 11, 4))
+        grey = utils.tile_raster_images(x, (2, 3), (3, 3), (1, 1))
+        self.assertTrue(np.all(rgba[:, :, 0] == grey) and np.all(rgba[:, :, 2] == grey))
+        self.assertTrue(np.all(rgba[:, :, 1] == 0) and np.all(rgba[:, :, 3] == 255))
+
+
 if __name__ == '__main__':
     print "Test Utilities"
     unittest.main()
\ No newline at end of file
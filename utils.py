@@ -1,3 +1,6 @@
+import threading
+import Queue
+
 import numpy
 try:
     import PIL.Image as Image
@@ -101,13 +104,12 @@ def tile_raster_images(X, img_shape, tile_shape, tile_spacing=(0, 0),
         assert len(X) == 4
         # Create an output numpy ndarray to store the image
         if output_pixel_vals:
-            out_array = numpy.zeros((out_shape[0], out_shape[1], 4),
-                                    dtype='uint8')
+            dt = 'uint8'
         else:
-            out_array = numpy.zeros((out_shape[0], out_shape[1], 4),
-                                    dtype=X.dtype)
+            dt = [x for x in X if x is not None][0].dtype
+        out_array = numpy.zeros((out_shape[0], out_shape[1], 4), dtype=dt)
 
-        #colors default to 0, alpha defaults to 1 (opaque)
+        # colors default to 0, alpha defaults to 1 (opaque)
         if output_pixel_vals:
             channel_defaults = [0, 0, 0, 255]
         else:
@@ -115,15 +117,8 @@ def tile_raster_images(X, img_shape, tile_shape, tile_spacing=(0, 0),
 
         for i in xrange(4):
             if X[i] is None:
-                # if channel is None, fill it with zeros of the correct
-                # dtype
-                dt = out_array.dtype
-                if output_pixel_vals:
-                    dt = 'uint8'
-                out_array[:, :, i] = numpy.zeros(
-                    out_shape,
-                    dtype=dt
-                ) + channel_defaults[i]
+                # if channel is None, fill it with the default of the channel
+                out_array[:, :, i] = channel_defaults[i]
             else:
                 # use a recurrent call to compute the channel and store it
                 # in the output
@@ -136,43 +131,135 @@ def tile_raster_images(X, img_shape, tile_shape, tile_spacing=(0, 0),
         # if we are dealing with only one channel
         H, W = img_shape
         Hs, Ws = tile_spacing
+        rows, cols = tile_shape
 
-        # generate a matrix to store the output
         dt = X.dtype
         if output_pixel_vals:
             dt = 'uint8'
-        out_array = numpy.zeros(out_shape, dtype=dt)
-
-        for tile_row in xrange(tile_shape[0]):
-            for tile_col in xrange(tile_shape[1]):
-                if tile_row * tile_shape[1] + tile_col < X.shape[0]:
-                    this_x = X[tile_row * tile_shape[1] + tile_col]
-                    if scale_rows_to_unit_interval:
-                        # if we should scale values to be between 0 and 1
-                        # do this by calling the `scale_to_unit_interval`
-                        # function
-                        this_img = scale_to_unit_interval(
-                            this_x.reshape(img_shape))
-                    else:
-                        this_img = this_x.reshape(img_shape)
-                    # add the slice to the corresponding position in the
-                    # output array
-                    c = 1
-                    if output_pixel_vals:
-                        c = 255
-                    out_array[
-                        tile_row * (H + Hs): tile_row * (H + Hs) + H,
-                        tile_col * (W + Ws): tile_col * (W + Ws) + W
-                    ] = this_img * c
-        return out_array
+
+        # Every image at once: scale each row to [0, 1] as scale_to_unit_interval does
+        n = min(X.shape[0], rows * cols)
+        images = X[:n]
+        if scale_rows_to_unit_interval:
+            images = images - images.min(axis=1)[:, numpy.newaxis]
+            # the scale is taken in double precision, like the scalar of the single image version
+            scale = 1.0 / (images.max(axis=1).astype('float64') + 1e-8)
+            images *= scale.astype(images.dtype)[:, numpy.newaxis]
+        if output_pixel_vals:
+            images = images * 255
+
+        # Each tile is an image followed by its spacing, the grid of tiles is then a reshape/transpose away
+        tiles = numpy.zeros((rows * cols, H + Hs, W + Ws), dtype=dt)
+        tiles[:n, :H, :W] = images.reshape(n, H, W)
+        out_array = tiles.reshape(rows, cols, H + Hs, W + Ws).transpose(0, 2, 1, 3)
+        out_array = out_array.reshape(rows * (H + Hs), cols * (W + Ws))
+        return numpy.ascontiguousarray(out_array[:out_shape[0], :out_shape[1]])
 
 
 def get_class_vector(c, n_classes):
-    v = numpy.zeros(10)
+    v = numpy.zeros(n_classes)
     v[c] = 1
     return v
 
 
 def isSharedType(x_in):
     type_s = str(type(x_in))
-    return any(map(lambda x: x in type_s, ['Tensor', 'cuda', 'Shared']))
\ No newline at end of file
+    return any(map(lambda x: x in type_s, ['Tensor', 'cuda', 'Shared']))
+
+
+def iterate_chunks(data, chunk_size, dtype=None):
+    """
+    Yields the rows of data in chunks of chunk_size rows, only the last chunk can be smaller.
+
+    data can be an array (a memmap is read one chunk at a time), a shared variable or an iterable
+    of rows or of arrays of any length, which are regrouped into chunks of chunk_size.
+    """
+    if isSharedType(data):
+        data = data.get_value(borrow=True)
+
+    if isinstance(data, numpy.ndarray):
+        for start in xrange(0, data.shape[0], chunk_size):
+            yield numpy.asarray(data[start:start + chunk_size], dtype=dtype)
+        return
+
+    pending = []
+    n_pending = 0
+    for block in data:
+        block = numpy.atleast_2d(numpy.asarray(block, dtype=dtype))
+        pending.append(block)
+        n_pending += block.shape[0]
+        if n_pending < chunk_size:
+            continue
+
+        rows = numpy.concatenate(pending)
+        for start in xrange(0, n_pending - chunk_size + 1, chunk_size):
+            yield rows[start:start + chunk_size]
+        rest = rows[n_pending - n_pending % chunk_size:]
+        pending = [rest] if len(rest) else []
+        n_pending = len(rest)
+
+    if n_pending:
+        yield numpy.concatenate(pending)
+
+
+def prefetch(iterable, buffer_size=1):
+    """
+    Runs iterable in a background thread, keeping at most buffer_size items ahead of the consumer,
+    so the next chunk is loaded while the current one is processed. Exceptions are re-raised in the consumer.
+    """
+    queue = Queue.Queue(maxsize=buffer_size)
+    stopped = threading.Event()
+    end = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+                if stopped.is_set():
+                    return
+        except Exception as e:
+            queue.put((end, e))
+        else:
+            queue.put((end, None))
+
+    thread = threading.Thread(target=produce, name='prefetch')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item, error = queue.get()
+            if item is end:
+                break
+            yield item
+    finally:
+        # Unblock the producer if the consumer stopped early
+        stopped.set()
+        while thread.is_alive():
+            try:
+                queue.get_nowait()
+            except Queue.Empty:
+                thread.join(0.01)
+
+    if error:
+        raise error
+
+
+def stream(fn, data, chunk_size, dtype=None, pad=False, prefetch_next=False):
+    """
+    Generator of fn applied to data chunk by chunk, peak memory is bounded by chunk_size rather than len(data).
+
+    With pad the last chunk is padded with zero rows to chunk_size (and the output trimmed back),
+    so fn always sees the same shape and compiled functions keyed on the shape are reused.
+    """
+    chunks = iterate_chunks(data, chunk_size, dtype)
+    if prefetch_next:
+        chunks = prefetch(chunks)
+
+    for chunk in chunks:
+        n = chunk.shape[0]
+        if pad and n < chunk_size:
+            padding = numpy.zeros((chunk_size - n,) + chunk.shape[1:], dtype=chunk.dtype)
+            yield fn(numpy.concatenate([chunk, padding]))[:n]
+        else:
+            yield fn(chunk)